@@ -0,0 +1,9 @@
+################################################################################
+#
+# Benchmarks
+#
+# Not installed with the lumina package, run from the repository root:
+#   python -m benchmarks.codec      micro-benchmarks of the RPC codecs
+#   python -m benchmarks.load       synthetic IDA traffic against a local server
+#
+################################################################################
@@ -0,0 +1,86 @@
+import socket, ssl, hashlib
+
+from lumina.lumina_structs import RpcReader, rpc_message_build, RPC_TYPE
+
+################################################################################
+#
+# Lumina client
+#
+# Minimal client speaking the IDA side of the protocol, and the synthetic
+# functions it pushes and pulls.
+#
+################################################################################
+
+def signature(i):
+    """
+    Signature of synthetic function i
+    """
+    return hashlib.md5(b"lumina-%d" % i).digest()
+
+def func_info(i, variant=0, size=64):
+    """
+    func_md_t of synthetic function i, as pushed by IDA. variant selects one of
+    several distinct metadata of the same function, size is the length of its
+    serialized data.
+    """
+    return dict(
+        metadata = dict(
+            func_name = f"sub_{i:x}_{variant}",
+            func_size = 16 + i % 4096,
+            serialized_data = bytes([variant & 0xff]) + signature(i) * (size // 16) + bytes(size % 16),
+        ),
+        signature = dict(version = 1, signature = signature(i)),
+    )
+
+class LuminaError(Exception):
+    pass
+
+class LuminaClient(object):
+    def __init__(self, host, port, tls=False, timeout=60):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if tls:
+            # certificates of test servers are not checked
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            self.sock = context.wrap_socket(self.sock)
+        self.reader = RpcReader(self.sock)
+
+    def request(self, code, expected, **kwargs):
+        self.sock.sendall(rpc_message_build(code, **kwargs))
+        packet, message = self.reader.read_message()
+        if packet.code != expected:
+            raise LuminaError(f"unexpected reply {packet.code} to {code}: {message}")
+        return message
+
+    def helo(self, hexrays_id=0x1337):
+        self.request(RPC_TYPE.RPC_HELO, RPC_TYPE.RPC_OK,
+            hexrays_licence = b"benchmark", hexrays_id = hexrays_id, watermak = 0, field_0x36 = 0)
+
+    def pull(self, signatures):
+        """
+        return the found flags and the number of results of PULL_MD signatures
+        """
+        message = self.request(RPC_TYPE.PULL_MD, RPC_TYPE.PULL_MD_RESULT,
+            flags = 1, ukn_list = [], funcInfos = [dict(version = 1, signature = sig) for sig in signatures])
+        return list(message.found), message.results
+
+    def push(self, infos, hostname="benchmark"):
+        """
+        return the result flags of PUSH_MD func_md_t infos
+        """
+        message = self.request(RPC_TYPE.PUSH_MD, RPC_TYPE.PUSH_MD_RESULT,
+            field_0x10 = 0, idb_filepath = "/tmp/benchmark.i64", input_filepath = "/tmp/benchmark",
+            input_md5 = bytes(16), hostname = hostname, funcInfos = infos,
+            funcEas = [0x401000 + 0x10 * i for i in range(len(infos))])
+        return list(message.resultsFlags)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
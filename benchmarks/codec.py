@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import sys, argparse, random, timeit
+
+import construct as con
+
+from lumina import lumina_structs
+from lumina.lumina_structs import IdaVarInt32, RpcMessage, RPC_TYPE, fast_message_parse, fast_message_build, func_info_build
+from benchmarks.client import func_info
+
+################################################################################
+#
+# Codec micro-benchmarks
+#
+# The fast codec of PULL_MD and PUSH_MD messages (and their results) is
+# checked against the construct definitions on random messages, then both are
+# timed on messages the size of IDA batches.
+#
+################################################################################
+
+def random_int(rnd):
+    # varint length boundaries
+    return rnd.choice([0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 0x1fffffff, 0x20000000, 0xffffffff, rnd.randrange(1 << 32)])
+
+def random_bytes(rnd):
+    return rnd.randbytes(rnd.choice([0, 1, 5, 16, 200, 70000 if rnd.random() < 0.02 else 5]))
+
+def random_string(rnd):
+    return "".join(rnd.choice("abc_é中") for _ in range(rnd.choice([0, 3, 300])))
+
+def random_messages(rnd):
+    """
+    Yield (code, kwargs) of random messages handled by the fast codec
+    """
+    metadata = lambda: dict(func_name = random_string(rnd), func_size = random_int(rnd), serialized_data = random_bytes(rnd))
+    sig = lambda: dict(version = 1, signature = random_bytes(rnd))
+
+    yield RPC_TYPE.PULL_MD, dict(flags = random_int(rnd), ukn_list = [random_int(rnd) for _ in range(rnd.randrange(4))],
+        funcInfos = [sig() for _ in range(rnd.randrange(20))])
+    yield RPC_TYPE.PULL_MD_RESULT, dict(found = [rnd.randrange(2) for _ in range(rnd.randrange(20))],
+        results = [dict(metadata = metadata(), popularity = random_int(rnd)) for _ in range(rnd.randrange(10))])
+    yield RPC_TYPE.PUSH_MD, dict(field_0x10 = random_int(rnd), idb_filepath = random_string(rnd),
+        input_filepath = random_string(rnd), input_md5 = rnd.randbytes(16), hostname = random_string(rnd),
+        funcInfos = [dict(metadata = metadata(), signature = sig()) for _ in range(rnd.randrange(10))],
+        funcEas = [rnd.randrange(1 << 64) for _ in range(rnd.randrange(10))])
+    yield RPC_TYPE.PUSH_MD_RESULT, dict(resultsFlags = [rnd.choice([True, False, 0, 1]) for _ in range(rnd.randrange(20))])
+
+def check_codecs(rounds, seed=0):
+    """
+    Differential check of the fast codec against construct: same bytes, same
+    parsed messages, and truncated messages rejected by both.
+    return the number of checked messages
+    """
+    rnd = random.Random(seed)
+    count = 0
+    for _ in range(rounds):
+        for code, kwargs in random_messages(rnd):
+            data = RpcMessage.build(kwargs, code = code)
+            if fast_message_build(code, **kwargs) != data:
+                raise AssertionError(f"{code}: fast codec built different bytes for {kwargs}")
+
+            reference = RpcMessage.parse(data, code = code)
+            message = fast_message_parse(code, memoryview(data))
+            if message != reference or fast_message_build(code, **message) != data:
+                raise AssertionError(f"{code}: fast codec parsed {message} instead of {reference}")
+
+            for cut in (1, len(data) // 2):
+                if not 0 < cut < len(data):
+                    continue
+                try:
+                    fast_message_parse(code, data[:-cut])
+                except con.ConstructError:
+                    continue
+                try:
+                    RpcMessage.parse(data[:-cut], code = code)
+                except con.ConstructError:
+                    raise AssertionError(f"{code}: fast codec accepted a message truncated by {cut} bytes")
+            count += 1
+    return count
+
+def timed(func, min_time):
+    """
+    return the mean time of a func call in seconds, over at least min_time seconds
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(number, int(number * min_time / elapsed))
+    return min(timer.repeat(3, number)) / number
+
+def benchmarks(batch, size):
+    """
+    Yield (name, construct function, fast function) to time
+    """
+    values = [0x7f, 0x3fff, 0x1fffffff, 0xffffffff]
+    encoded = [IdaVarInt32.build(value) for value in values]
+    yield ("varint32 build", lambda: [IdaVarInt32.build(value) for value in values],
+        lambda: [lumina_structs._build_varint32(bytearray(), value) for value in values])
+    yield ("varint32 parse", lambda: [IdaVarInt32.parse(data) for data in encoded],
+        lambda: [lumina_structs._parse_varint32(memoryview(data), 0) for data in encoded])
+
+    infos = [func_info(i, size = size) for i in range(batch)]
+    messages = {
+        RPC_TYPE.PULL_MD : dict(flags = 1, ukn_list = [], funcInfos = [info["signature"] for info in infos]),
+        RPC_TYPE.PULL_MD_RESULT : dict(found = [1] * batch,
+            results = [dict(metadata = info["metadata"], popularity = i) for i, info in enumerate(infos)]),
+        RPC_TYPE.PUSH_MD : dict(field_0x10 = 0, idb_filepath = "/tmp/a.i64", input_filepath = "/tmp/a",
+            input_md5 = bytes(16), hostname = "host", funcInfos = infos, funcEas = list(range(batch))),
+        RPC_TYPE.PUSH_MD_RESULT : dict(resultsFlags = [1] * batch),
+    }
+    for code, kwargs in messages.items():
+        data = RpcMessage.build(kwargs, code = code)
+        yield (f"{code} build", lambda code=code, kwargs=kwargs: RpcMessage.build(kwargs, code = code),
+            lambda code=code, kwargs=kwargs: fast_message_build(code, **kwargs))
+        yield (f"{code} parse", lambda code=code, data=data: RpcMessage.parse(data, code = code),
+            lambda code=code, data=data: fast_message_parse(code, data))
+
+    # cached pull results are concatenated func_info_t
+    yield ("func_info_t build", lambda: [lumina_structs.func_info_t.build(dict(metadata = info["metadata"], popularity = 1)) for info in infos],
+        lambda: [func_info_build(info["metadata"], 1) for info in infos])
+
+def main():
+    parser = argparse.ArgumentParser(description="Lumina RPC codecs micro-benchmarks")
+    parser.add_argument("--batch", dest="batch", type=int, default=256, help="number of functions per message (default: 256)")
+    parser.add_argument("--size", dest="size", type=int, default=128, help="size of serialized metadata (default: 128)")
+    parser.add_argument("--min-time", dest="min_time", type=float, default=0.5, help="minimum seconds spent per benchmark (default: 0.5)")
+    parser.add_argument("--check", dest="check", type=int, default=300, help="rounds of the differential check run first, 0 to skip (default: 300)")
+    config = parser.parse_args()
+
+    if config.check:
+        print(f"differential check: {check_codecs(config.check)} messages ok")
+
+    print(f"{'benchmark':<28} {'construct':>12} {'fast':>12} {'speedup':>8}")
+    for name, reference, fast in benchmarks(config.batch, config.size):
+        reference_time = timed(reference, config.min_time)
+        fast_time = timed(fast, config.min_time)
+        print(f"{name:<28} {reference_time * 1e6:>10.1f}us {fast_time * 1e6:>10.1f}us {reference_time / fast_time:>7.1f}x")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+import os, sys, time, json, shlex, socket, signal, random, argparse, tempfile, threading, subprocess
+from collections import Counter
+
+from benchmarks.client import LuminaClient, signature, func_info
+
+################################################################################
+#
+# Load generator
+#
+# Drives a local lumina_server with synthetic IDA sessions: a database of
+# --preload functions is created, the server is restarted on it (load time),
+# then --connections clients send HELO and --requests PULL_MD or PUSH_MD of
+# --batch functions each. Pulled signatures are known functions with
+# probability --hit-ratio.
+#
+################################################################################
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# signatures of unknown functions (pull misses) are taken above this index
+UNKNOWN = 1 << 40
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def generate_certificate(directory):
+    """
+    Self-signed certificate for TLS runs, return (certfile, keyfile)
+    """
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+        "-subj", "/CN=lumina-benchmark", "-keyout", key, "-out", cert],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+def process_tree(pid):
+    """
+    pid and its descendants (server workers)
+    """
+    pids = [pid]
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as children:
+                for child in children.read().split():
+                    pids += process_tree(int(child))
+    except OSError:
+        pass
+    return pids
+
+def memory_usage(pid):
+    """
+    return (rss, peak rss) in bytes of pid and its descendants, (None, None) if unknown
+    """
+    rss = peak = 0
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/status") as status:
+                fields = dict(line.split(":", 1) for line in status)
+        except OSError:
+            return None, None
+        rss += int(fields["VmRSS"].split()[0]) * 1024
+        peak += int(fields["VmHWM"].split()[0]) * 1024
+    return rss, peak
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+class ServerProcess(object):
+    """
+    lumina_server subprocess listening on a free local port
+    """
+    def __init__(self, config, db_path, workdir):
+        self.port = free_port()
+        self.tls = config.cert is not None
+        self.args = [sys.executable, "-m", "lumina.lumina_server", db_path, "-p", str(self.port),
+            "-b", config.backend, "-l", "WARNING"]
+        if self.tls:
+            self.args += ["-c", config.cert, "-k", config.key]
+        self.args += shlex.split(config.server_args)
+        self.log_path = os.path.join(workdir, "server.log")
+        self.process = None
+
+    def start(self, timeout=600):
+        """
+        Start the server, return the seconds until it answered a first HELO (database load time)
+        """
+        start = time.perf_counter()
+        with open(self.log_path, "ab") as log:
+            self.process = subprocess.Popen(self.args, cwd=REPOSITORY, stdout=log, stderr=subprocess.STDOUT)
+
+        while time.perf_counter() - start < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server exited with status {self.process.returncode}, see {self.log_path}")
+            try:
+                with self.client() as client:
+                    client.helo()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError("server did not start")
+
+    def client(self):
+        return LuminaClient("127.0.0.1", self.port, self.tls)
+
+    def memory_usage(self):
+        return memory_usage(self.process.pid)
+
+    def stop(self):
+        """
+        Stop the server (database saved), return the seconds it took
+        """
+        start = time.perf_counter()
+        self.process.send_signal(signal.SIGINT)
+        if self.process.wait() != 0:
+            raise RuntimeError(f"server exited with status {self.process.returncode}, see {self.log_path}")
+        return time.perf_counter() - start
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+def run_clients(server, connections, task):
+    """
+    Run task(client, n) in connections threads with HELO done, return the elapsed
+    seconds once all clients are connected
+    """
+    barrier = threading.Barrier(connections + 1)
+    errors = list()
+
+    def run(n):
+        client = None
+        try:
+            client = server.client()
+            client.helo(0x1000 + n)
+        except Exception as e:
+            errors.append(e)
+        barrier.wait()
+        try:
+            if client is not None:
+                task(client, n)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if client is not None:
+                client.close()
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(connections)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+    return elapsed
+
+def preload(server, config):
+    """
+    Push functions [0, config.preload) once, return the elapsed seconds
+    """
+    batches = [range(i, min(i + config.batch, config.preload)) for i in range(0, config.preload, config.batch)]
+
+    def task(client, n):
+        for batch in batches[n::config.connections]:
+            client.push([func_info(i, size = config.size) for i in batch])
+
+    return run_clients(server, config.connections, task)
+
+def workload(server, config):
+    """
+    Run the PULL_MD/PUSH_MD mix, return the results and the Counter of pushes per function
+    """
+    latencies = dict(pull = list(), push = list())
+    pushed = Counter()
+    found = [0, 0]
+    lock = threading.Lock()
+    # pushes go to known functions (new metadata variants), or to new ones if the database is empty
+    known = max(config.preload, config.batch)
+
+    def task(client, n):
+        rnd = random.Random(config.seed + n)
+        pull, push, client_pushed, client_found = list(), list(), Counter(), [0, 0]
+
+        for _ in range(config.requests):
+            if rnd.random() < config.push_ratio:
+                ids = rnd.sample(range(known), config.batch)
+                infos = [func_info(i, rnd.randrange(config.variants), config.size) for i in ids]
+                start = time.perf_counter()
+                client.push(infos)
+                push.append(time.perf_counter() - start)
+                client_pushed.update(ids)
+            else:
+                hits = sum(rnd.random() < config.hit_ratio for _ in range(config.batch))
+                ids = rnd.sample(range(config.preload), min(hits, config.preload))
+                ids += [UNKNOWN + rnd.randrange(UNKNOWN) for _ in range(config.batch - len(ids))]
+                start = time.perf_counter()
+                flags, _ = client.pull([signature(i) for i in ids])
+                pull.append(time.perf_counter() - start)
+                client_found[0] += sum(flags)
+                client_found[1] += len(flags)
+
+        with lock:
+            latencies["pull"] += pull
+            latencies["push"] += push
+            pushed.update(client_pushed)
+            found[0] += client_found[0]
+            found[1] += client_found[1]
+
+    elapsed = run_clients(server, config.connections, task)
+
+    results = dict(elapsed = elapsed, hit_ratio = found[0] / found[1] if found[1] else None)
+    requests = 0
+    for kind, values in latencies.items():
+        requests += len(values)
+        results[kind] = dict(
+            requests = len(values),
+            functions_per_second = len(values) * config.batch / elapsed,
+            p50_ms = percentile(values, 0.50) * 1000,
+            p99_ms = percentile(values, 0.99) * 1000,
+            max_ms = max(values, default=0) * 1000,
+        )
+    results["requests_per_second"] = requests / elapsed
+    return results, pushed
+
+def verify(server, config, pushed, timeout=60):
+    """
+    Check the popularity of every function: pushed once by preload, then by the workload.
+    Checks are retried for timeout seconds, pushes may be written behind (--write-behind).
+    """
+    known = max(config.preload, config.batch)
+    expected = Counter(range(config.preload))
+    expected.update(pushed)
+
+    deadline = time.monotonic() + timeout
+    with server.client() as client:
+        client.helo()
+        start = 0
+        while start < known:
+            ids = range(start, min(start + config.batch, known))
+            flags, results = client.pull([signature(i) for i in ids])
+            popularities = iter([result.popularity for result in results])
+            for i, flag in zip(ids, flags):
+                popularity = next(popularities) if flag else 0
+                if popularity != expected[i]:
+                    if time.monotonic() < deadline:
+                        time.sleep(0.1)
+                        break
+                    raise AssertionError(f"function {i}: popularity {popularity}, expected {expected[i]}")
+            else:
+                start += config.batch
+
+def report(results):
+    print(f"load time: {results['load_time']:.3f}s  rss after load: {results['rss_load'] / 2**20:.1f}MiB"
+        if results["rss_load"] is not None else f"load time: {results['load_time']:.3f}s")
+    workload = results["workload"]
+    print(f"throughput: {workload['requests_per_second']:.0f} requests/s ({workload['elapsed']:.2f}s)"
+        + (f"  pull hit ratio: {workload['hit_ratio']:.2f}" if workload["hit_ratio"] is not None else ""))
+    for kind in ("pull", "push"):
+        stats = workload[kind]
+        if stats["requests"]:
+            print(f"  {kind:<5} {stats['requests']:>7} requests  {stats['functions_per_second']:>9.0f} functions/s"
+                f"  p50 {stats['p50_ms']:.2f}ms  p99 {stats['p99_ms']:.2f}ms  max {stats['max_ms']:.2f}ms")
+    if results["rss_end"] is not None:
+        print(f"rss: {results['rss_end'] / 2**20:.1f}MiB  peak: {results['rss_peak'] / 2**20:.1f}MiB")
+    print(f"stop (save) time: {results['stop_time']:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic IDA load against a local lumina_server")
+    parser.add_argument("--db", dest="db", type=str, default=None, help="database file, kept and reused if it exists (default: new database in a temporary directory)")
+    parser.add_argument("-b", "--backend", dest="backend", type=str, default="auto", help="server database backend (default: auto)")
+    parser.add_argument("--db-name", dest="db_name", type=str, default="benchmark.sqlite", help="file name of temporary databases, selects the auto backend (default: benchmark.sqlite)")
+    parser.add_argument("--server-args", dest="server_args", type=str, default="", help="extra lumina_server arguments, e.g. --server-args=\"--asyncio --workers 4\"")
+    parser.add_argument("--tls", dest="tls", action="store_true", help="serve over TLS with a generated self-signed certificate")
+    parser.add_argument("--cert", dest="cert", type=str, default=None, help="TLS certificate (implies --tls)")
+    parser.add_argument("--key", dest="key", type=str, default=None, help="TLS certificate key")
+    parser.add_argument("--preload", dest="preload", type=int, default=100000, help="functions pushed to a new database before the benchmark (default: 100000)")
+    parser.add_argument("-c", "--connections", dest="connections", type=int, default=16, help="concurrent client connections (default: 16)")
+    parser.add_argument("-n", "--requests", dest="requests", type=int, default=200, help="requests sent per connection (default: 200)")
+    parser.add_argument("--batch", dest="batch", type=int, default=256, help="functions per PULL_MD and PUSH_MD (default: 256)")
+    parser.add_argument("--push-ratio", dest="push_ratio", type=float, default=0.1, help="fraction of PUSH_MD requests (default: 0.1)")
+    parser.add_argument("--hit-ratio", dest="hit_ratio", type=float, default=0.3, help="fraction of pulled functions known by the database (default: 0.3)")
+    parser.add_argument("--variants", dest="variants", type=int, default=4, help="distinct metadata pushed per function (default: 4)")
+    parser.add_argument("--size", dest="size", type=int, default=128, help="size of serialized metadata (default: 128)")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--verify", dest="verify", action="store_true", help="check the popularity of every function after the run (new databases only)")
+    parser.add_argument("--json", dest="json", action="store_true", help="print results as json")
+    config = parser.parse_args()
+
+    if config.cert is not None and config.key is None:
+        parser.error("--cert requires --key")
+    if config.verify and config.db is not None and os.path.exists(config.db):
+        parser.error("--verify requires a new database")
+
+    with tempfile.TemporaryDirectory(prefix="lumina-benchmark.") as workdir:
+        if config.tls and config.cert is None:
+            config.cert, config.key = generate_certificate(workdir)
+
+        db_path = config.db or os.path.join(workdir, config.db_name)
+        server = ServerProcess(config, db_path, workdir)
+        results = dict()
+        try:
+            if not os.path.exists(db_path):
+                server.start()
+                results["preload_time"] = preload(server, config) if config.preload else 0
+                server.stop()
+
+            results["load_time"] = server.start()
+            results["rss_load"], _ = server.memory_usage()
+            results["workload"], pushed = workload(server, config)
+            results["rss_end"], results["rss_peak"] = server.memory_usage()
+            if config.verify:
+                verify(server, config, pushed)
+            results["stop_time"] = server.stop()
+        finally:
+            server.kill()
+
+    if config.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+        if config.verify:
+            print("verify: ok")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+import sys, math, time, threading
+
+################################################################################
+#
+# Signature filter
+#
+# Bloom filter of the signatures of a database, checked before pull lookups:
+# most pulled signatures were never pushed, they are answered without probing
+# an on-disk backend. The filter is built in the background at load time and
+# rebuilt larger when the database outgrows it. Deleted signatures stay in the
+# filter until the next rebuild, they only cost a lookup.
+#
+################################################################################
+
+HASH_MASK = (1 << sys.hash_info.width) - 1
+
+class BloomFilter(object):
+    """
+    Probes are derived from the builtin hash of signatures (bytes): it is cached
+    by bytes objects and salted per process, filters are never saved.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        # optimal number of bits and probes for capacity items
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.probes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, signature):
+        # double hashing: probe i is h1 + i * h2
+        h = hash(signature) & HASH_MASK
+        step, size, bits = (h >> 32) | 1, self.size, self.bits
+        for _ in range(self.probes):
+            position = h % size
+            bits[position >> 3] |= 1 << (position & 7)
+            h += step
+
+    def __contains__(self, signature):
+        h = hash(signature) & HASH_MASK
+        step, size, bits = (h >> 32) | 1, self.size, self.bits
+        for _ in range(self.probes):
+            position = h % size
+            if not bits[position >> 3] >> (position & 7) & 1:
+                # half the bits are set: most misses stop at the first probes
+                return False
+            h += step
+        return True
+
+class SignatureFilter(object):
+    # minimum number of signatures a filter is sized for
+    MIN_CAPACITY = 1 << 20
+    # signatures added per lock acquisition while building
+    BUILD_BATCH = 10000
+
+    def __init__(self, logger, storage, error_rate=0.01):
+        self.logger = logger
+        self.storage = storage
+        self.error_rate = error_rate
+        # bit updates are read-modify-write: serialized by the lock
+        self.lock = threading.Lock()
+        # filter used by lookups once built, and filter being built
+        self.bloom = None
+        self.building = None
+        self.capacity = 0
+        self.count = 0
+        self.skipped = 0
+        self.false_positives = 0
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Build a new filter in the background, the current one is used until then
+        """
+        with self.lock:
+            if self.building is not None:
+                return
+            # placeholder until the filter is sized (see build)
+            self.building = True
+
+        builder = threading.Thread(target=self.build, name="lumina-filter", daemon=True)
+        builder.start()
+
+    def build(self):
+        try:
+            start = time.perf_counter()
+            count = self.storage.count()
+            capacity = max(self.MIN_CAPACITY, 2 * count)
+            bloom = BloomFilter(capacity, self.error_rate)
+            with self.lock:
+                # signatures pushed from now on are added by add_many, previous ones are listed below
+                self.building = bloom
+                self.count = count
+
+            batch = list()
+            for signature in self.storage.iter_signatures():
+                batch.append(signature)
+                if len(batch) >= self.BUILD_BATCH:
+                    with self.lock:
+                        for signature in batch:
+                            bloom.add(signature)
+                    batch = list()
+            with self.lock:
+                for signature in batch:
+                    bloom.add(signature)
+                self.bloom = bloom
+                self.capacity = capacity
+
+            self.logger.info(f"signature filter built: {count} signatures, {len(bloom.bits) >> 20} MiB, "
+                f"{time.perf_counter() - start:.1f}s")
+        except Exception:
+            # lookups keep going to the storage, retried on next growth
+            self.logger.exception("failed to build signature filter")
+        finally:
+            with self.lock:
+                self.building = None
+
+    def add_many(self, signatures, new=0):
+        """
+        Add pushed signatures, once they are stored. new is the number of new signatures
+        """
+        with self.lock:
+            for bloom in (self.bloom, self.building):
+                if isinstance(bloom, BloomFilter):
+                    for signature in signatures:
+                        bloom.add(signature)
+            self.count += new
+            grow = self.bloom is not None and self.count > self.capacity
+
+        if grow:
+            self.rebuild()
+
+    def candidates(self, signatures):
+        """
+        return the indexes of signatures that may be stored, or None until the filter is built
+        """
+        bloom = self.bloom
+        if bloom is None:
+            return None
+
+        candidates = [i for i, signature in enumerate(signatures) if signature in bloom]
+        with self.lock:
+            self.skipped += len(signatures) - len(candidates)
+        return candidates
+
+    def false_positive(self, count):
+        with self.lock:
+            self.false_positives += count
+
+    def stats(self):
+        return dict(capacity = self.capacity, count = self.count, skipped = self.skipped, false_positives = self.false_positives)
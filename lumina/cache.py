@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict, Counter
+
+#######################################
+#
+# Metadata cache
+#
+# Bounded LRU cache of serialized func_info_t (metadata and popularity) of the
+# most pulled signatures, invalidated when a signature is pushed.
+#######################################
+
+class MetadataCache(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # a value read from the database while the signature is pushed must not be
+        # cached: invalidations are numbered, and the ones that happened while
+        # lookups were in flight are kept until they end
+        self.clock = 0
+        self.readers = Counter()
+        self.invalidated = dict()
+
+    def get_many(self, signatures):
+        """
+        return (values, token): cached values (None if missing), and the token to pass
+        to put_many once missing values have been read from the database
+        """
+        with self.lock:
+            values = list()
+            for signature in signatures:
+                value = self.entries.get(signature)
+                if value is not None:
+                    self.entries.move_to_end(signature)
+                values.append(value)
+
+            misses = values.count(None)
+            self.hits += len(values) - misses
+            self.misses += misses
+
+            self.readers[self.clock] += 1
+            return values, self.clock
+
+    def put_many(self, values, token):
+        """
+        Cache {signature: value} read from the database since get_many returned token
+        """
+        with self.lock:
+            for signature, value in values.items():
+                if self.invalidated.get(signature, -1) > token:
+                    continue
+                self.entries[signature] = value
+                self.entries.move_to_end(signature)
+
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+            self.readers[token] -= 1
+            if not self.readers[token]:
+                del self.readers[token]
+
+            if not self.readers:
+                self.invalidated.clear()
+            elif len(self.invalidated) > self.capacity:
+                oldest = min(self.readers)
+                self.invalidated = {signature: clock for signature, clock in self.invalidated.items() if clock > oldest}
+
+    def invalidate_many(self, signatures):
+        """
+        Drop signatures, must be called once the database is updated
+        """
+        with self.lock:
+            self.clock += 1
+            for signature in signatures:
+                self.entries.pop(signature, None)
+                if self.readers:
+                    self.invalidated[signature] = self.clock
+
+    def stats(self):
+        return dict(size = len(self.entries), hits = self.hits, misses = self.misses)
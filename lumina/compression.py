@@ -0,0 +1,89 @@
+import zlib
+from collections import Counter
+
+#######################################
+#
+# Metadata compression
+#
+# serialized_data blobs (type information, comments, frame layout) make most of
+# the database, but a single blob is too small for deflate to find much to
+# reuse. Records are compressed with raw deflate and a preset dictionary trained
+# on records of the database: most blobs share the same structure.
+#
+# Compression is decided per record when it is written: records of signatures
+# pushed at least hot_popularity times are kept uncompressed, and so are records
+# that would not get smaller.
+#######################################
+
+# deflate window: longer dictionaries are not used
+DICTIONARY_SIZE = 32 << 10
+# records sampled to train a dictionary, and minimum number of samples
+TRAINING_SAMPLES = 4096
+MIN_TRAINING_SAMPLES = 256
+# length of the segments counted by train_dictionary
+SEGMENT_SIZE = 8
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """
+    Build a preset dictionary from sample records: the samples sharing the most
+    segments with other samples, most representative last (deflate encodes closer
+    matches with shorter codes).
+    return the dictionary, empty if there are too few samples
+    """
+    samples = [bytes(sample) for sample in samples]
+    if len(samples) < MIN_TRAINING_SAMPLES:
+        return b""
+
+    # number of samples holding each segment
+    segments = [{sample[i:i + SEGMENT_SIZE] for i in range(len(sample) - SEGMENT_SIZE + 1)} for sample in samples]
+    counts = Counter(segment for sample_segments in segments for segment in sample_segments)
+
+    def score(i):
+        return sum(counts[segment] - 1 for segment in segments[i]) / (len(samples[i]) + 1)
+
+    chosen = list()
+    covered = set()
+    total = 0
+    for i in sorted(range(len(samples)), key=score, reverse=True):
+        if total + len(samples[i]) > size:
+            continue
+        # skip samples mostly made of segments already in the dictionary
+        if not segments[i] or len(segments[i] - covered) * 2 < len(segments[i]):
+            continue
+        chosen.append(samples[i])
+        covered |= segments[i]
+        total += len(samples[i])
+
+    return b"".join(reversed(chosen))
+
+class RecordCodec(object):
+    """
+    Raw deflate with a preset dictionary
+    """
+    def __init__(self, level=6, dictionary=b"", hot_popularity=0):
+        """
+        level: zlib compression level (1-9)
+        hot_popularity: records of signatures pushed at least this number of times are
+        not compressed (0: every record is compressed)
+        """
+        self.level = level
+        self.dictionary = bytes(dictionary)
+        self.hot_popularity = hot_popularity
+        # loading the dictionary costs more than compressing a record: records are
+        # compressed by copies of a compressor holding it
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=self.dictionary) if self.dictionary \
+            else zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    def compress(self, record, popularity=0):
+        """
+        return the compressed record, or None if it should be kept uncompressed
+        """
+        if self.hot_popularity and popularity >= self.hot_popularity:
+            return None
+        compressor = self.compressor.copy()
+        data = compressor.compress(record) + compressor.flush()
+        return data if len(data) < len(record) else None
+
+    def decompress(self, data):
+        decompressor = zlib.decompressobj(-15, zdict=self.dictionary) if self.dictionary else zlib.decompressobj(-15)
+        return decompressor.decompress(data) + decompressor.flush()
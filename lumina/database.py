@@ -1,109 +1,231 @@
-import os, json
-from base64 import b64encode, b64decode
+import os, time, threading
+
+try:
+    from lumina.storage import open_storage, encode_delete
+    from lumina.cache import MetadataCache
+    from lumina.bloom import SignatureFilter
+    from lumina.writer import WriteBehindQueue
+    from lumina.replication import ReplicationLog, encode_batches
+    from lumina.lumina_structs import func_info_build
+except ImportError:
+    # local import for standalone use
+    from storage import open_storage, encode_delete
+    from cache import MetadataCache
+    from bloom import SignatureFilter
+    from writer import WriteBehindQueue
+    from replication import ReplicationLog, encode_batches
+    from lumina_structs import func_info_build
 
 class LuminaDatabase(object):
-    def __init__(self, logger, db_file):
+    def __init__(self, logger, db_path, backend="auto", history=None, cache_size=0, filter_error_rate=0, write_behind=0,
+        replication_log_size=0, write_timeout=60, **options):
+        """
+        cache_size: number of pulled signatures kept serialized in memory (0 disables the cache)
+        filter_error_rate: false positive rate of the signature filter of on-disk backends (0 disables the filter)
+        write_behind: maximum number of pushed functions queued by the write-behind writer (0 writes pushes
+        before answering)
+        replication_log_size: bytes of pushes and deletes kept in the replication log for replicas
+        (0 disables the log)
+        write_timeout: seconds a push waits for room in the write-behind queue
+        options are passed to the storage backend (fsync, snapshot_interval)
+        """
         self.logger = logger
-        self.logger.info(f"loading database {os.path.abspath(db_file.name)}")
-        self.load(db_file)
-
-
-    def load(self, db_file):
-        self.db_file = db_file
-        self.db_file.seek(0, os.SEEK_SET)
-
-        if os.stat(self.db_file.name).st_size == 0:
-            # create new db
-            self.db = dict()
-        else:
-            try:
-                self.db = json.load(self.db_file)
-            except Exception as e:
-                self.logger.exception(e)
-                self.db_file.close()
-                self.db = None
-                raise
+        self.logger.info(f"loading database {os.path.abspath(db_path)}")
+        self.load(db_path, backend, history, **options)
+        self.cache = MetadataCache(cache_size) if cache_size else None
+        self.filter = None
+        if filter_error_rate and self.storage.filtered:
+            self.filter = SignatureFilter(logger, self.storage, filter_error_rate)
+        self.replication = None
+        if replication_log_size:
+            self.replication = ReplicationLog(logger, db_path + ".repl", replication_log_size, self.storage.count() == 0)
+        # updates are logged in the order they are applied
+        self.replication_lock = threading.Lock()
+        self.writer = WriteBehindQueue(logger, self, write_behind, write_timeout) if write_behind else None
+
+    def load(self, db_path, backend="auto", history=None, **options):
+        self.db_path = db_path
+        self.storage = open_storage(self.logger, db_path, backend, history, **options)
+        self.logger.info(f"using {self.storage.name} storage backend")
 
     def save(self):
-        try:
-            self.logger.info(f"saving database to {self.db_file.name}")
-            self.db_file.seek(0, os.SEEK_SET)
-            json.dump(self.db, self.db_file)
-        except Exception as e:
-            self.logger.exception(e)
-            raise
-        return True
+        if self.writer is not None and not self.writer.flush():
+            self.logger.warning("saving the database without the pushes still queued (failed write)")
+        return self.storage.save()
 
     def close(self, save=False):
-        if save:
-            self.save()
-        self.db_file.close()
-        self.db = None
-
-    def push(self, info):
+        if self.storage is None:
+            return
+        if self.writer is not None:
+            # queued pushes are written first
+            self.writer.close()
+        if self.replication is not None:
+            self.replication.close()
+        if self.cache is not None:
+            self.logger.info("metadata cache: {size} entries, {hits} hits, {misses} misses".format(**self.cache.stats()))
+        if self.filter is not None:
+            self.logger.info("signature filter: {skipped} lookups skipped, {false_positives} false positives".format(**self.filter.stats()))
+        self.storage.close(save=save)
+        self.storage = None
+
+    def check_version(self, signatures):
+        for sig in signatures:
+            if sig.version != 1:
+                self.logger.warning(f"Signature version {sig.version} not supported. Results might be inconsistent")
+                break
+
+    def push(self, info, pusher=None):
         """
         return True on new insertion, else False
         """
+        return self.push_many([info], pusher)[0]
+
+    def pull(self, signature):
+        """
+        return function metadata or None if not found
+        """
+        return self.pull_many([signature])[0]
 
-        # Signature and metadata contains non string data that need to be encoded:
-        sig_version = info.signature.version
-        signature = b64encode(info.signature.signature).decode("ascii")
-        metadata = {
-            "func_name"         : info.metadata.func_name,
-            "func_size"         : info.metadata.func_size,
-            "serialized_data"   : b64encode(info.metadata.serialized_data).decode("ascii"),
-        }
+    def push_many(self, infos, pusher=None):
+        """
+        Push a list of func_md_t in a single storage operation. pusher identifies the client.
+        return a list of flags: True on new insertion, else False
+        """
+        self.check_version(info.signature for info in infos)
 
-        if sig_version != 1:
-            self.logger.warning("Signature version {sig_version} not supported. Results might be inconsistent")
+        entries = [(info.signature.signature, {
+                "func_name"         : info.metadata.func_name,
+                "func_size"         : info.metadata.func_size,
+                "serialized_data"   : info.metadata.serialized_data,
+            }) for info in infos]
+
+        if self.writer is not None:
+            return self.writer.push(entries, pusher)
+        return self.write_batches([(entries, pusher)])[0]
+
+    def write_batches(self, batches, now=None, replicated=None):
+        """
+        Write a list of (entries, pusher) in a single storage operation, entries are (signature, metadata).
+        now is the push time (default: current time), replicated the replication position of replicas
+        (see Storage.push_batches).
+        return the list of flags of each batch
+        """
+        now = int(time.time()) if now is None else now
+        if self.replication is None:
+            results = self.storage.push_batches(batches, now, replicated)
+        else:
+            with self.replication_lock:
+                results = self.storage.push_batches(batches, now, replicated)
+                self.replication.append(encode_batches(now, batches))
+
+        signatures = [bytes(signature) for entries, _ in batches for signature, _ in entries]
+        if self.cache is not None:
+            self.cache.invalidate_many(signatures)
+        if self.filter is not None:
+            # once stored: the filter being built may not list them yet
+            self.filter.add_many(signatures, sum(sum(flags) for flags in results))
+        return results
+
+    def lookup(self, signatures):
+        """
+        storage.pull_many of signatures (bytes), without looking up those ruled out by the filter
+        """
+        candidates = self.filter.candidates(signatures) if self.filter is not None else None
+        if candidates is None:
+            return self.storage.pull_many(signatures)
+
+        results = [None] * len(signatures)
+        if candidates:
+            found = 0
+            for i, db_entry in zip(candidates, self.storage.pull_many([signatures[i] for i in candidates])):
+                results[i] = db_entry
+                found += db_entry is not None
+            self.filter.false_positive(len(candidates) - found)
+        return results
+
+    def pull_many(self, signatures):
+        """
+        Query a list of func_sig_t in a single storage operation.
+        return a list of function metadata or None if not found
+        """
+        self.check_version(signatures)
 
+        return [{"metadata": db_entry[0], "popularity": db_entry[1]} if db_entry else None
+            for db_entry in self.lookup([bytes(sig.signature) for sig in signatures])]
 
-        # insert into database
-        new_sig = False
-        db_entry = self.db.get(signature, None)
+    def pull_encoded(self, signatures):
+        """
+        Query a list of func_sig_t.
+        return a list of serialized func_info_t (bytes) or None if not found
+        """
+        self.check_version(signatures)
+        signatures = [bytes(sig.signature) for sig in signatures]
 
-        if db_entry is None:
-            db_entry = {
-                "metadata": list(), # collision/merge not implemented yet. just keep every push queries
-                "popularity" : 0
-            }
-            self.db[signature] = db_entry
-            new_sig = True
+        if self.cache is None:
+            return [func_info_build(*db_entry) if db_entry else None for db_entry in self.lookup(signatures)]
 
-        db_entry["metadata"].append(metadata)
-        db_entry["popularity"] += 1
+        results, token = self.cache.get_many(signatures)
+        fetched = dict()
+        try:
+            missing = [i for i, result in enumerate(results) if result is None]
+            if missing:
+                for i, db_entry in zip(missing, self.lookup([signatures[i] for i in missing])):
+                    if db_entry:
+                        results[i] = fetched[signatures[i]] = func_info_build(*db_entry)
+        finally:
+            self.cache.put_many(fetched, token)
 
-        return new_sig
+        return results
 
-    def pull(self,signature):
+    def get_popularity(self, signatures):
         """
-        return function metadata or None if not found
+        return the popularity of each func_sig_t (0 if not found)
         """
+        self.check_version(signatures)
 
-        sig_version = signature.version
-        signature = b64encode(signature.signature).decode("ascii")
+        return [db_entry[1] if db_entry else 0
+            for db_entry in self.lookup([bytes(sig.signature) for sig in signatures])]
 
-        if sig_version != 1:
-            self.logger.warning("Signature version {sig_version} not supported. Results might be inconsistent")
+    def delete_many(self, signatures):
+        """
+        Delete a list of func_sig_t.
+        return a list of flags: True if deleted, False if not found
+        """
+        self.check_version(signatures)
+        signatures = [bytes(sig.signature) for sig in signatures]
 
-        # query database
-        db_entry = self.db.get(signature, None)
+        if self.writer is not None and not self.writer.flush():
+            # pushes answered before the delete are written before it
+            raise RuntimeError("pushed functions queued before the delete could not be written")
+        return self.remove(signatures)
 
-        if db_entry:
-            # take last signature (arbitrary choice)
-            metadata = db_entry["metadata"][-1]
+    def remove(self, signatures, replicated=None):
+        """
+        storage.delete_many of signatures (bytes)
+        """
+        if self.replication is None:
+            results = self.storage.delete_many(signatures, replicated)
+        else:
+            with self.replication_lock:
+                results = self.storage.delete_many(signatures, replicated)
+                self.replication.append([encode_delete(signatures)])
 
-            # Decode signature (take that last match for a result)
-            metadata = {
-                "func_name"         : metadata["func_name"],
-                "func_size"         : metadata["func_size"],
-                "serialized_data"   : b64decode(metadata["serialized_data"]),
-            }
+        if self.cache is not None:
+            self.cache.invalidate_many(signatures)
+        return results
 
-            result = {
-                "metadata"   : metadata,
-                "popularity" : db_entry["popularity"]
-            }
+    def count(self):
+        """
+        return the number of signatures in the database
+        """
+        return self.storage.count()
 
-            return result
-        return None
\ No newline at end of file
+    def scan(self, cursor=None, limit=1000):
+        """
+        Page through the database, cursor is returned by the previous call (None for the first page).
+        return (entries, cursor): list of (signature, metadata, popularity), and the cursor of
+        the next page (None after the last page)
+        """
+        entries = self.storage.scan(cursor, limit)
+        cursor = entries[-1][0] if len(entries) == limit else None
+        return entries, cursor
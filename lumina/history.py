@@ -0,0 +1,108 @@
+import zlib
+
+#######################################
+#
+# Metadata history
+#
+# Each signature keeps a bounded list of distinct metadata (variants). Pushing
+# metadata identical to an existing variant only updates its counters, and the
+# variant returned to pullers (best) is updated incrementally at push time.
+#######################################
+
+# maximum number of distinct pushers tracked per variant
+MAX_PUSHERS = 64
+
+class Variant(object):
+    """
+    Distinct metadata pushed for a signature.
+    record identifies the content (packed record, or its digest for on-disk backends)
+    """
+    __slots__ = ("record", "count", "last_seen", "pushers", "id")
+
+    def __init__(self, record, count=0, last_seen=0, pushers=(), id=None):
+        self.record = record
+        self.count = count
+        self.last_seen = last_seen
+        self.pushers = pushers
+        self.id = id
+
+
+# variant scores, the variant with the highest score is returned by pull (ties go
+# to the last pushed variant)
+POLICIES = {
+    "frequent"  : lambda variant: (variant.count, variant.last_seen),
+    "recent"    : lambda variant: (variant.last_seen,),
+    "pushers"   : lambda variant: (len(variant.pushers), variant.count, variant.last_seen),
+}
+
+class HistoryPolicy(object):
+    def __init__(self, max_history=8, policy="frequent"):
+        if max_history < 1:
+            raise ValueError("history must keep at least one metadata")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown history policy {policy}")
+
+        self.max_history = max_history
+        self.policy = policy
+        self.score = POLICIES[policy]
+
+    def add(self, entry, record, pusher=None, now=0):
+        """
+        Add a pushed record to entry (entry.variants, entry.best).
+        return (variant, created, evicted): variant holding the record, True if it is
+        a new variant, and the variant evicted to respect max_history (or None)
+        """
+        created = False
+        evicted = None
+
+        for variant in entry.variants:
+            if variant.record == record:
+                break
+        else:
+            variant = Variant(record)
+            entry.variants.append(variant)
+            created = True
+
+        variant.count += 1
+        variant.last_seen = max(variant.last_seen, now)
+        if pusher is not None and len(variant.pushers) < MAX_PUSHERS:
+            pusher = zlib.crc32(pusher.encode("utf8"))
+            if pusher not in variant.pushers:
+                variant.pushers += (pusher,)
+
+        # only the pushed variant score changed
+        if entry.best is None or (variant is not entry.best and self.score(variant) >= self.score(entry.best)):
+            entry.best = variant
+
+        if len(entry.variants) > self.max_history:
+            evicted = min((v for v in entry.variants if v is not entry.best), key=self.score)
+            entry.variants.remove(evicted)
+
+        return variant, created, evicted
+
+    def sorted(self, entry):
+        """
+        return entry variants ordered by score (best last)
+        """
+        return sorted(entry.variants, key=lambda v: (v is entry.best, self.score(v)))
+
+    def merge(self, entry, other):
+        """
+        Merge the variants of other (same signature, from another database) into entry
+        """
+        for variant in other.variants:
+            for existing in entry.variants:
+                if existing.record == variant.record:
+                    existing.count += variant.count
+                    existing.last_seen = max(existing.last_seen, variant.last_seen)
+                    pushers = tuple(pusher for pusher in variant.pushers if pusher not in existing.pushers)
+                    existing.pushers = (existing.pushers + pushers)[:MAX_PUSHERS]
+                    break
+            else:
+                entry.variants.append(Variant(variant.record, variant.count, variant.last_seen, variant.pushers))
+
+        # ties go to the last merged variant
+        entry.best = max(reversed(entry.variants), key=self.score)
+        while len(entry.variants) > self.max_history:
+            evicted = min((v for v in entry.variants if v is not entry.best), key=self.score)
+            entry.variants.remove(evicted)
@@ -0,0 +1,91 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+#######################################
+#
+# Client limits
+#
+# Concurrent sessions per client (ip address or hexrays_id), and the scheduler
+# sharing database work between sessions.
+#######################################
+
+class SessionCounter(object):
+    """
+    Concurrent sessions per key, at most limit each (0: unlimited)
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.counts = dict()
+
+    def acquire(self, key):
+        """
+        return True if a session of key may start, else False
+        """
+        with self.lock:
+            count = self.counts.get(key, 0)
+            if self.limit and count >= self.limit:
+                return False
+            self.counts[key] = count + 1
+            return True
+
+    def release(self, key):
+        with self.lock:
+            count = self.counts[key] - 1
+            if count:
+                self.counts[key] = count
+            else:
+                del self.counts[key]
+
+class FairScheduler(object):
+    """
+    Database work runs in chunks, each one holding one of a fixed number of slots.
+    Slots are handed over to waiters in arrival order: a session needing a slot waits
+    for at most one chunk of each session queued before it, so a large push split in
+    chunks is interleaved with the small pulls of other sessions.
+    """
+    # funcInfos per chunk
+    CHUNK_SIZE = 1024
+
+    def __init__(self, slots):
+        self.lock = threading.Lock()
+        self.free = slots
+        # locks of waiting threads, released to hand over a slot
+        self.waiters = deque()
+
+    def acquire(self):
+        with self.lock:
+            if self.free and not self.waiters:
+                self.free -= 1
+                return
+            waiter = threading.Lock()
+            waiter.acquire()
+            self.waiters.append(waiter)
+        waiter.acquire()
+
+    def release(self):
+        with self.lock:
+            if self.waiters:
+                # the slot is not freed, a releasing session queues behind waiters
+                self.waiters.popleft().release()
+            else:
+                self.free += 1
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def run(self, func, items):
+        """
+        return func(items), called on chunks of items one slot at a time
+        """
+        results = list()
+        for start in range(0, len(items), self.CHUNK_SIZE):
+            with self.slot():
+                results += func(items[start:start + self.CHUNK_SIZE])
+        return results
@@ -0,0 +1,191 @@
+import time, asyncio, threading
+from construct import Container
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from lumina.lumina_structs import RPC_HEADER_SIZE, RPC_TYPE, PacketTooLarge, rpc_header_parse, rpc_message_decode, rpc_message_build
+    from lumina.session import LuminaSession, LuminaServerMixIn
+    from lumina.metrics import LuminaMetrics, RequestTimer
+except ImportError:
+    # local import for standalone use
+    from lumina_structs import RPC_HEADER_SIZE, RPC_TYPE, PacketTooLarge, rpc_header_parse, rpc_message_decode, rpc_message_build
+    from session import LuminaSession, LuminaServerMixIn
+    from metrics import LuminaMetrics, RequestTimer
+
+
+################################################################################
+#
+# asyncio server core
+#
+# Connections are served by a single event loop. Packet parsing, database work
+# and reply building run in a thread pool so the loop keeps accepting and
+# reading while a large PUSH_MD is processed. The pool has a thread per session
+# slot: requests only queue in the fair scheduler of database work (--threads).
+#
+################################################################################
+
+class LuminaAsyncServer(LuminaServerMixIn):
+    def __init__(self, database, config, logger):
+        self.config = config
+        self.database = database
+        self.logger = logger
+        self.server_address = (config.ip, config.port)
+
+        self.init_tls()
+        self.init_limits()
+        self.init_replication()
+        self.metrics = LuminaMetrics(database, self.replica, self.upstream)
+        self.executor = ThreadPoolExecutor(max_workers=config.max_sessions, thread_name_prefix="lumina")
+        self.loop = None
+        self.stop_event = None
+        self.stopped = threading.Event()
+
+    async def recv_packet(self, reader):
+        header = await asyncio.wait_for(reader.readexactly(RPC_HEADER_SIZE), self.config.idle_timeout)
+        if not self.useTLS and header.startswith(b'\x16\x03\x01'):
+            self.logger.error("TLS client HELLO detected on plaintext mode. Check IDA configuration and cert. Aborting")
+            return None
+
+        received = time.perf_counter()
+        length, code = rpc_header_parse(header)
+        if self.config.max_packet_size and length > self.config.max_packet_size:
+            raise PacketTooLarge(length, self.config.max_packet_size)
+        data = await asyncio.wait_for(reader.readexactly(length), self.config.idle_timeout)
+        return Container(length = length, code = code, data = memoryview(data), received = received)
+
+    def process_packet(self, session, packet, timer):
+        """
+        Decode an RPC packet, handle it and return (message, serialized reply)
+        """
+        with timer.time("parse"):
+            message = rpc_message_decode(packet.code, packet.data)
+        # lazy formatting: messages are only formatted when debug logging is enabled
+        self.logger.debug("got new RPC Packet (code = %s, data=%s", packet.code, message)
+
+        with timer.time("db"):
+            code, kwargs = session.handle_message(packet, message)
+
+        self.logger.debug("sending RPC Packet (code = %s, data=%s", code, kwargs)
+        with timer.time("build"):
+            return message, rpc_message_build(code, **kwargs)
+
+    async def handle_client(self, reader, writer):
+        fromaddr = writer.get_extra_info("peername")
+        self.logger.debug("new client %s:%s", *fromaddr[:2])
+
+        session = None
+        try:
+            if not self.admit(fromaddr):
+                return
+            if self.sessions.locked():
+                self.reject_session(fromaddr)
+                return
+
+            session = LuminaSession(self, fromaddr)
+            async with self.sessions:
+                await self.serve_session(session, reader, writer)
+        finally:
+            if session is not None:
+                session.close()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def serve_session(self, session, reader, writer):
+        fromaddr = session.client_address
+        self.metrics.sessions.inc()
+        try:
+            while not session.closed:
+                packet = await self.recv_packet(reader)
+                if packet is None:
+                    break
+                timer = RequestTimer(self.metrics.phases, packet.received)
+                timer.observe("recv", time.perf_counter() - packet.received)
+                message, reply = await self.loop.run_in_executor(self.executor, self.process_packet, session, packet, timer)
+
+                start = time.perf_counter()
+                writer.write(reply)
+                # backpressure: wait for the client to consume the reply
+                await writer.drain()
+                timer.observe("send", time.perf_counter() - start)
+                self.log_slow_request(session, packet, message, timer)
+
+                if session.subscription is not None:
+                    # the connection now streams the replication log to a replica
+                    await self.stream_replication(session, writer)
+                    break
+
+        except asyncio.IncompleteReadError:
+            self.logger.debug("client %s:%s disconnected", *fromaddr[:2])
+        except asyncio.TimeoutError:
+            self.logger.debug("client %s:%s idle timeout", *fromaddr[:2])
+        except PacketTooLarge as e:
+            self.logger.warning(f"client {fromaddr[0]}:{fromaddr[1]} closed: {e}")
+            self.metrics.rejected.inc("packet")
+            writer.write(rpc_message_build(RPC_TYPE.RPC_NOTIFY, message = "Packet too large"))
+        except Exception:
+            self.logger.exception(f"error while handling client {fromaddr[0]}:{fromaddr[1]}")
+        finally:
+            self.metrics.sessions.dec()
+
+    def next_stream_packet(self, stream):
+        """
+        return the next serialized message of a replication stream, None at its end
+        """
+        message = next(stream, None)
+        if message is None:
+            return None
+        code, kwargs = message
+        return rpc_message_build(code, **kwargs)
+
+    async def stream_replication(self, session, writer):
+        stream = session.replication_stream()
+        try:
+            while True:
+                # reads of the log wait for new records: run in the pool
+                data = await self.loop.run_in_executor(self.executor, self.next_stream_packet, stream)
+                if data is None:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError) as e:
+            self.logger.info(f"replica {session.client_address[0]} disconnected: {e}")
+        finally:
+            # still running in the pool if the task was cancelled: it ends with the log
+            if not stream.gi_running:
+                stream.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.sessions = asyncio.Semaphore(self.config.max_sessions)
+
+        server = await asyncio.start_server(self.handle_client,
+                                            host = self.config.ip,
+                                            port = self.config.port,
+                                            ssl = self.tls.context if self.useTLS else None,
+                                            ssl_handshake_timeout = self.config.tls_handshake_timeout if self.useTLS else None,
+                                            reuse_address = True,
+                                            reuse_port = self.config.workers > 1)
+        self.server_address = server.sockets[0].getsockname()[:2]
+        self.logger.info(f"Server started (asyncio). Listening on {self.server_address[0]}:{self.server_address[1]} (TLS={'ON' if self.useTLS else 'OFF'})")
+
+        async with server:
+            await self.stop_event.wait()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=True)
+            self.stopped.set()
+
+    def shutdown(self, save=True):
+        self.logger.info("Server stopped")
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+            self.stopped.wait()
+        self.stop_replication()
+        self.database.close(save=save)
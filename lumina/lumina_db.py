@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+
+import os, sys, glob, shutil, logging, argparse, tempfile, itertools
+from collections import deque
+from multiprocessing import Pool
+
+try:
+    from lumina.storage import (Entry, SqliteStorage, MmapStorage, STORAGE_BACKENDS, guess_backend, open_storage,
+        read_snapshot_header, write_snapshot_header, iter_snapshot_entries, iter_json_entries,
+        encode_entry, encode_json_entry, SortedIndex, IndexWriter, ENTRY_HEADER, VARIANT_HEADER, COMPRESSED_RECORD)
+    from lumina.history import HistoryPolicy, POLICIES
+    from lumina.router import HashRing
+    from lumina.compression import RecordCodec, train_dictionary, TRAINING_SAMPLES
+    from lumina.lumina_structs import RPC_TYPE, RPC_HEADER_SIZE, rpc_header_parse, rpc_message_decode
+except ImportError:
+    # local import for standalone use
+    from storage import (Entry, SqliteStorage, MmapStorage, STORAGE_BACKENDS, guess_backend, open_storage,
+        read_snapshot_header, write_snapshot_header, iter_snapshot_entries, iter_json_entries,
+        encode_entry, encode_json_entry, SortedIndex, IndexWriter, ENTRY_HEADER, VARIANT_HEADER, COMPRESSED_RECORD)
+    from history import HistoryPolicy, POLICIES
+    from router import HashRing
+    from compression import RecordCodec, train_dictionary, TRAINING_SAMPLES
+    from lumina_structs import RPC_TYPE, RPC_HEADER_SIZE, rpc_header_parse, rpc_message_decode
+
+logger = logging.getLogger("lumina")
+
+################################################################################
+#
+# Offline database tool
+#
+# Databases are converted and merged in two passes run by a process pool:
+#   - split: the entries of each source are spread over partition files by signature
+#     range (signatures are hashes, so partitions are balanced)
+#   - merge: the entries of each partition are merged (see HistoryPolicy.merge) and
+#     written in the destination format, in signature order
+# Only a partition per process is held in memory. Partitions are then concatenated
+# into the destination database, which is sorted as a whole. When resharding, the
+# merge pass writes the entries of each shard of the ring (see router.py) to
+# separate outputs, concatenated into a database per shard.
+#
+# With --compression-level, a compression dictionary is trained on records sampled
+# from the sources before the merge, and records are compressed by the merge pass.
+#
+################################################################################
+
+def iter_database(path, history):
+    """
+    Yield (signature, Entry) of a database file (any backend), variants hold packed records
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found")
+    if any(os.path.getsize(segment) for segment in glob.glob(glob.escape(path) + ".wal.*")):
+        raise ValueError(f"{path} has a write-ahead log: start and stop the server once to include it in the database")
+
+    backend = guess_backend(path)
+    if backend == SqliteStorage.name:
+        storage = SqliteStorage(logger, path, history)
+        try:
+            yield from storage.iter_entries()
+        finally:
+            storage.close()
+        return
+
+    if backend == MmapStorage.name:
+        index = SortedIndex(path)
+        for signature, offset in index.iter_from():
+            yield signature, index.read_entry(offset)
+        return
+
+    with open(path, "rb") as db_file:
+        header = read_snapshot_header(db_file)
+        if header is None:
+            yield from iter_json_entries(db_file, history)
+        else:
+            count, _, _, dictionary = header
+            yield from iter_snapshot_entries(db_file, count, RecordCodec(dictionary=dictionary))
+
+def sample_records(sources, history):
+    """
+    return up to TRAINING_SAMPLES records of the first entries of each source
+    """
+    records = list()
+    for path in sources:
+        entries = iter_database(path, history)
+        records += [entry.best.record for _, entry in itertools.islice(entries, TRAINING_SAMPLES // len(sources) + 1)]
+        entries.close()
+    return records[:TRAINING_SAMPLES]
+
+def signature_partition(signature, partitions):
+    return int.from_bytes(signature[:4].ljust(4, b"\x00"), "big") * partitions >> 32
+
+def part_path(workdir, source, partition):
+    return os.path.join(workdir, f"{source}.{partition}.part")
+
+def output_path(workdir, partition, destination=0):
+    return os.path.join(workdir, f"{partition}.{destination}.out")
+
+def split_source(job):
+    """
+    Pool task: spread the entries of a source database over partition files.
+    return the number of entries
+    """
+    path, source, workdir, partitions, history_args = job
+    history = HistoryPolicy(*history_args)
+
+    parts = [open(part_path(workdir, source, partition), "wb") for partition in range(partitions)]
+    count = 0
+    try:
+        for signature, entry in iter_database(path, history):
+            parts[signature_partition(signature, partitions)].write(encode_entry(signature, entry, history))
+            count += 1
+    finally:
+        for part in parts:
+            part.close()
+
+    logger.info(f"{path}: {count} entries")
+    return count
+
+def merge_partition(job):
+    """
+    Pool task: merge the entries of a partition from every source, and write them in the
+    format of their destination backend (binary snapshot entries, or json items). With
+    shards, entries are written to the destination of the shard owning them.
+    return the number of entries of each destination
+    """
+    partition, workdir, sources, backends, shards, history_args, codec_args = job
+    history = HistoryPolicy(*history_args)
+    ring = HashRing(shards) if shards else None
+    # sqlite compresses the entries it imports
+    codecs = [RecordCodec(*codec_args) if codec_args and backend not in ("json", SqliteStorage.name) else None for backend in backends]
+
+    entries = dict()
+    for source in range(sources):
+        path = part_path(workdir, source, partition)
+        with open(path, "rb") as part:
+            for signature, entry in iter_snapshot_entries(part):
+                merged = entries.get(signature)
+                if merged is None:
+                    merged = entries[signature] = Entry()
+                merged.popularity += entry.popularity
+                history.merge(merged, entry)
+        os.unlink(path)
+
+    outputs = [open(output_path(workdir, partition, destination), "wb") for destination in range(len(backends))]
+    counts = [0] * len(outputs)
+    try:
+        for signature in sorted(entries):
+            destination = ring.node_index(signature) if ring is not None else 0
+            if backends[destination] == "json":
+                if counts[destination]:
+                    outputs[destination].write(b", ")
+                outputs[destination].write(encode_json_entry(signature, entries[signature], history))
+            else:
+                outputs[destination].write(encode_entry(signature, entries[signature], history, codecs[destination]))
+            counts[destination] += 1
+    finally:
+        for output in outputs:
+            output.close()
+
+    return counts
+
+def iter_entry_data(part):
+    """
+    Yield (signature, serialized entry) of the binary snapshot entries of a merged partition
+    """
+    while True:
+        header = part.read(ENTRY_HEADER.size)
+        if not header:
+            break
+        size, _, nvariants = ENTRY_HEADER.unpack(header)
+        data = [header, part.read(size)]
+        for _ in range(nvariants):
+            variant_header = part.read(VARIANT_HEADER.size)
+            _, _, npushers, record_size = VARIANT_HEADER.unpack(variant_header)
+            data += [variant_header, part.read(4 * npushers + (record_size & ~COMPRESSED_RECORD))]
+        yield data[1], b"".join(data)
+
+def write_database(path, backend, workdir, counts, history, destination=0, codec_args=None):
+    """
+    Concatenate the merged partitions of a destination into a new database.
+    codec_args: (level, dictionary, hot popularity) of the compressed records
+    """
+    outputs = [output_path(workdir, partition, destination) for partition, count in enumerate(counts) if count]
+    dictionary = codec_args[1] if codec_args else b""
+
+    if backend == SqliteStorage.name:
+        options = dict(compression_level = codec_args[0], hot_popularity = codec_args[2]) if codec_args else dict()
+        storage = SqliteStorage(logger, path, history, **options)
+        try:
+            if dictionary:
+                storage.add_dictionary(dictionary)
+            for output in outputs:
+                with open(output, "rb") as part:
+                    storage.import_entries(iter_snapshot_entries(part))
+        finally:
+            storage.close()
+        return
+
+    with open(path, "wb") as db_file:
+        if backend == MmapStorage.name:
+            writer = IndexWriter(db_file, dictionary=dictionary)
+            for output in outputs:
+                with open(output, "rb") as part:
+                    for signature, data in iter_entry_data(part):
+                        writer.add(signature, data)
+            writer.finish()
+            db_file.flush()
+            os.fsync(db_file.fileno())
+            return
+
+        if backend == "json":
+            db_file.write(b"{")
+        else:
+            write_snapshot_header(db_file, sum(counts), dictionary=dictionary)
+
+        for i, output in enumerate(outputs):
+            if backend == "json" and i:
+                db_file.write(b", ")
+            with open(output, "rb") as part:
+                shutil.copyfileobj(part, db_file)
+
+        if backend == "json":
+            db_file.write(b"}")
+        db_file.flush()
+        os.fsync(db_file.fileno())
+
+def merge(sources, destination, backend, config):
+    """
+    Merge source databases into destination (a new file), return the number of entries
+    """
+    return rebuild(sources, [destination], backend, config)[0]
+
+def reshard(sources, destinations, shards, backend, config):
+    """
+    Merge source databases (the shards of the current ring) and split their entries by
+    consistent hashing: destinations[i] (a new file) gets the signatures of shards[i].
+    return the number of entries of each destination
+    """
+    return rebuild(sources, destinations, backend, config, shards)
+
+def rebuild(sources, destinations, backend, config, shards=None):
+    backends = [guess_backend(destination) if backend == "auto" else backend for destination in destinations]
+    history_args = (config.history, config.policy)
+
+    codec_args = None
+    if config.compression_level and any(backend != "json" for backend in backends):
+        dictionary = train_dictionary(sample_records(sources, HistoryPolicy(*history_args)))
+        if dictionary:
+            logger.info(f"trained a {len(dictionary)} bytes compression dictionary")
+            codec_args = (config.compression_level, dictionary, config.hot_popularity)
+
+    directory = os.path.dirname(os.path.abspath(destinations[0]))
+    with tempfile.TemporaryDirectory(prefix=".lumina_db.", dir=directory) as workdir, Pool(config.jobs) as pool:
+        pool.map(split_source, [(path, source, workdir, config.partitions, history_args)
+            for source, path in enumerate(sources)], chunksize=1)
+
+        partition_counts = pool.map(merge_partition, [(partition, workdir, len(sources), backends, shards, history_args, codec_args)
+            for partition in range(config.partitions)], chunksize=1)
+
+        totals = list()
+        for index, (destination, backend) in enumerate(zip(destinations, backends)):
+            counts = [partition_count[index] for partition_count in partition_counts]
+            tmp_path = destination + ".tmp"
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            write_database(tmp_path, backend, workdir, counts, HistoryPolicy(*history_args), index, codec_args)
+            os.replace(tmp_path, destination)
+            logger.info(f"{destination}: {sum(counts)} entries ({backend})")
+            totals.append(sum(counts))
+
+    return totals
+
+def read_packets(path):
+    """
+    Pool task: parse a captured RPC stream (one or several packets).
+    return the [(pusher, [(signature, metadata)])] of its PUSH_MD packets
+    """
+    with open(path, "rb") as packets_file:
+        data = packets_file.read()
+
+    pushes = list()
+    hexrays_id = 0
+    pos = 0
+    while pos < len(data):
+        length, code = rpc_header_parse(data[pos:pos + RPC_HEADER_SIZE])
+        payload = data[pos + RPC_HEADER_SIZE:pos + RPC_HEADER_SIZE + length]
+        if len(payload) != length:
+            raise ValueError(f"{path}: truncated packet at offset {pos}")
+        pos += RPC_HEADER_SIZE + length
+
+        if code == RPC_TYPE.RPC_HELO:
+            hexrays_id = rpc_message_decode(code, payload).hexrays_id
+        elif code == RPC_TYPE.PUSH_MD:
+            message = rpc_message_decode(code, payload)
+            # same pusher identity as a live session
+            pusher = f"{hexrays_id:x}/{message.hostname}"
+            pushes.append((pusher, [(bytes(info.signature.signature), {
+                    "func_name"         : info.metadata.func_name,
+                    "func_size"         : info.metadata.func_size,
+                    "serialized_data"   : bytes(info.metadata.serialized_data),
+                }) for info in message.funcInfos]))
+
+    return pushes
+
+def bounded_imap(pool, func, items, window):
+    """
+    Ordered pool.imap keeping at most window results in memory
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def replay(database, files, backend, config):
+    """
+    Push the PUSH_MD packets of captured files into database (created if needed)
+    """
+    history = HistoryPolicy(config.history, config.policy)
+    # a single final save: the write-ahead log does not need to be synced
+    storage = open_storage(logger, database, backend, history, fsync="never", snapshot_interval=0,
+        compression_level=config.compression_level, hot_popularity=config.hot_popularity)
+
+    functions = 0
+    try:
+        with Pool(config.jobs) as pool:
+            for path, pushes in zip(files, bounded_imap(pool, read_packets, files, 2 * config.jobs)):
+                for pusher, entries in pushes:
+                    storage.push_many(entries, pusher)
+                    functions += len(entries)
+                logger.debug(f"{path}: {len(pushes)} PUSH_MD")
+    finally:
+        storage.close(save=True)
+
+    logger.info(f"{database}: {functions} functions pushed from {len(files)} files")
+
+
+def main():
+    log_handler = logging.StreamHandler(sys.stdout)
+    log_handler.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s"))
+    logger.addHandler(log_handler)
+
+    backends = ["auto"] + list(STORAGE_BACKENDS)
+
+    parser = argparse.ArgumentParser(description="Offline lumina database tool. Servers must be stopped, except for the sqlite sources of convert, merge and reshard")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count(), help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--partitions", dest="partitions", type=int, default=64, help="number of partitions the databases are split into, a worker holds a partition in memory (default: 64)")
+    parser.add_argument("--history", dest="history", type=int, default=8, help="maximum number of distinct metadata kept per signature (default: 8)")
+    parser.add_argument("--policy", dest="policy", type=str, choices=list(POLICIES), default="frequent", help="metadata returned to pull queries, see lumina_server (default: frequent)")
+    parser.add_argument("--compression-level", dest="compression_level", type=int, choices=range(10), default=0, metavar="{0-9}", help="zlib level of the metadata of the databases written (memory, mmap and sqlite backends), 0 writes uncompressed databases (default: 0)")
+    parser.add_argument("--hot-popularity", dest="hot_popularity", type=int, default=0, help="with --compression-level, metadata of signatures pushed at least this number of times is written uncompressed (default: 0)")
+    parser.add_argument("-l", "--log", dest="log_level", type=str, choices=["NOTSET", "DEBUG", "INFO", "WARNING"], default="INFO", help="log level bases on python logging value (default:info)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("convert", help="convert a database to another backend")
+    command.add_argument("source", type=str, help="source database file")
+    command.add_argument("destination", type=str, help="new database file")
+    command.add_argument("-b", "--backend", dest="backend", type=str, choices=backends, default="auto", help="destination backend. auto: json for .json files, else sqlite (default: auto)")
+
+    command = commands.add_parser("merge", help="merge several databases into a new one")
+    command.add_argument("destination", type=str, help="new database file")
+    command.add_argument("sources", type=str, nargs="+", help="source database files")
+    command.add_argument("-b", "--backend", dest="backend", type=str, choices=backends, default="auto", help="destination backend. auto: json for .json files, else sqlite (default: auto)")
+
+    command = commands.add_parser("dedup", help="rewrite a database, merging identical metadata and applying --history and --policy. The original is kept as <db>.bak, its server must be stopped")
+    command.add_argument("database", type=str, help="database file")
+
+    command = commands.add_parser("reshard", help="merge the databases of the shards of a router and split them over a new list of shards (see --shards of lumina_server)")
+    command.add_argument("--shards", dest="shards", type=str, required=True, help="comma separated host:port of the new shards, named as in the --shards option of the routers")
+    command.add_argument("--destinations", dest="destinations", type=str, required=True, help="comma separated new database files, one per shard in the same order")
+    command.add_argument("sources", type=str, nargs="+", help="database files of the current shards")
+    command.add_argument("-b", "--backend", dest="backend", type=str, choices=backends, default="auto", help="destination backend. auto: json for .json files, else sqlite (default: auto)")
+
+    command = commands.add_parser("replay", help="push the PUSH_MD packets of captured RPC streams into a database")
+    command.add_argument("database", type=str, help="database file, created if needed")
+    command.add_argument("files", type=str, nargs="+", help="files of raw RPC packets (as sent by IDA, after TLS)")
+    command.add_argument("-b", "--backend", dest="backend", type=str, choices=backends, default="auto", help="database backend (default: auto)")
+
+    config = parser.parse_args()
+    logger.setLevel(config.log_level)
+
+    if config.command in ("convert", "merge"):
+        sources = [config.source] if config.command == "convert" else config.sources
+        if os.path.exists(config.destination):
+            parser.error(f"{config.destination} already exists")
+        merge(sources, config.destination, config.backend, config)
+
+    elif config.command == "dedup":
+        backend = guess_backend(config.database)
+        # pushes of a running server would be written to the original file
+        if backend == SqliteStorage.name and os.path.exists(config.database + "-wal"):
+            parser.error(f"{config.database} is open (sqlite -wal file): stop its server first")
+        tmp_path = config.database + ".dedup"
+        merge([config.database], tmp_path, backend, config)
+        if backend == SqliteStorage.name and os.path.exists(config.database + "-wal"):
+            os.unlink(tmp_path)
+            parser.error(f"{config.database} was opened during the dedup: stop its server first")
+
+        # sqlite -wal and -shm files follow the original, they must not be attached to the new file
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(config.database + suffix):
+                os.replace(config.database + suffix, config.database + ".bak" + suffix)
+        os.replace(tmp_path, config.database)
+        logger.info(f"original database kept as {config.database}.bak")
+
+    elif config.command == "reshard":
+        shards = config.shards.split(",")
+        destinations = config.destinations.split(",")
+        if len(destinations) != len(shards):
+            parser.error("--destinations must list a database file per shard")
+        for destination in destinations:
+            if os.path.exists(destination):
+                parser.error(f"{destination} already exists")
+        reshard(config.sources, destinations, shards, config.backend, config)
+
+    elif config.command == "replay":
+        replay(config.database, config.files, config.backend, config)
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,33 @@
 #!/usr/bin/python3
 
-import os, sys, argparse, logging, signal, threading
+import os, sys, time, argparse, logging, signal, threading
 
 from socketserver import ThreadingMixIn, TCPServer, BaseRequestHandler
 import socket, ssl
 
 try:
-    from lumina.lumina_structs import rpc_message_parse, rpc_message_build, RPC_TYPE
+    from lumina.lumina_structs import RpcReader, PacketTooLarge, rpc_message_build, rpc_message_decode, RPC_TYPE
     from lumina.database import LuminaDatabase
+    from lumina.storage import STORAGE_BACKENDS, serving_backend
+    from lumina.history import HistoryPolicy
+    from lumina.session import LuminaSession, LuminaServerMixIn
+    from lumina.lumina_async import LuminaAsyncServer
+    from lumina.router import ShardedDatabase
+    from lumina.tls import create_client_context
+    from lumina.metrics import LuminaMetrics, RequestTimer, start_metrics_server
+    from lumina.profiler import SamplingProfiler
 except ImportError:
     # local import for standalone use
-    from lumina_structs import rpc_message_parse, rpc_message_build, RPC_TYPE
+    from lumina_structs import RpcReader, PacketTooLarge, rpc_message_build, rpc_message_decode, RPC_TYPE
     from database import LuminaDatabase
+    from storage import STORAGE_BACKENDS, serving_backend
+    from history import HistoryPolicy
+    from session import LuminaSession, LuminaServerMixIn
+    from lumina_async import LuminaAsyncServer
+    from router import ShardedDatabase
+    from tls import create_client_context
+    from metrics import LuminaMetrics, RequestTimer, start_metrics_server
+    from profiler import SamplingProfiler
 
 
 ################################################################################
@@ -24,135 +40,316 @@ class LuminaRequestHandler(BaseRequestHandler):
     def __init__(self, request, client_address, server):
         self.logger = server.logger
         self.database = server.database
+        self.metrics = server.metrics
+        self.reader = RpcReader(request, max_length = server.config.max_packet_size)
+        # phases of the current request
+        self.timer = RequestTimer(self.metrics.phases)
         super().__init__(request, client_address, server)
 
 
     def sendMessage(self, code, **kwargs):
-        self.logger.debug(f"sending RPC Packet (code = {code}, data={kwargs}")
+        # lazy formatting: messages are only formatted when debug logging is enabled
+        self.logger.debug("sending RPC Packet (code = %s, data=%s", code, kwargs)
 
-        data = rpc_message_build(code, **kwargs)
-        self.request.send(data)
+        with self.timer.time("build"):
+            data = rpc_message_build(code, **kwargs)
+        with self.timer.time("send"):
+            self.request.sendall(data)
 
     def recvMessage(self):
-        packet, message = rpc_message_parse(self.request)
-        self.logger.debug(f"got new RPC Packet (code = {packet.code}, data={message}")
+        packet = self.reader.read_packet()
+        self.timer = RequestTimer(self.metrics.phases, packet.received)
+        self.timer.observe("recv", time.perf_counter() - packet.received)
+        with self.timer.time("parse"):
+            message = rpc_message_decode(packet.code, packet.data)
+        self.logger.debug("got new RPC Packet (code = %s, data=%s", packet.code, message)
         return packet, message
 
-    def handle(self):
-
-        #
-        # Get first RPC packet (RPC_HELO)
-        #
-
-        packet, message = self.recvMessage()
-
-        if packet.code != RPC_TYPE.RPC_HELO:
-            self.sendMessage(RPC_TYPE.RPC_NOTIFY, message = 'Expected helo')
-            return
-
-        if self.server.check_client(message):
-            self.sendMessage(RPC_TYPE.RPC_OK)
-        else:
-            self.sendMessage(RPC_TYPE.RPC_NOTIFY, message = 'Invalid license')
-            return
-
-        #
-        # Receive and handle request command:
-        #
-        packet, message = self.recvMessage()
-
-        if packet.code == RPC_TYPE.PUSH_MD:
-            results = list()
-            for _, info in enumerate(message.funcInfos):
-                results.append(self.database.push(info))
-
-            self.sendMessage(RPC_TYPE.PUSH_MD_RESULT, resultsFlags = results)
-
-        elif packet.code == RPC_TYPE.PULL_MD:
-            found = list()
-            results = list()
-
-            for sig in message.funcInfos:
-                metadata = self.database.pull(sig)
-                if metadata:
-                    found.append(1)
-                    results.append(metadata)
-                else:
-                    found.append(0)
-
-            self.sendMessage(RPC_TYPE.PULL_MD_RESULT, found = found, results =results)
-
-        else:
-            self.logger("[-] ERROR: message handler not implemented")
-            self.sendMessage(RPC_TYPE.RPC_NOTIFY, message = "Unknown command")
-            #self.sendMessage(RPC_TYPE.RPC_FAIL, status = -1, message = "not implemented")
-
-        return
+    def startSession(self):
+        """
+        Plaintext check or TLS handshake, run by the connection thread: a slow client
+        does not delay the accept loop.
+        return False if the connection must be closed
+        """
+        if not self.server.useTLS:
+            self.logger.debug("Starting plaintext session")
+            # extra check: make sure client does no try to initiate a TLS session (or parsing would hang)
+            self.request.settimeout(self.server.config.idle_timeout)
+            try:
+                data = self.request.recv(3, socket.MSG_PEEK)
+            except OSError:
+                return False
+            if data == b'\x16\x03\x01':
+                self.logger.error("TLS client HELLO detected on plaintext mode. Check IDA configuration and cert. Aborting")
+                return False
+            return True
+
+        self.logger.debug("Starting TLS session")
+        self.request.settimeout(self.server.config.tls_handshake_timeout)
+        start = time.perf_counter()
+        try:
+            self.request.do_handshake()
+        except (OSError, ValueError) as e:
+            self.metrics.tls_failures.inc()
+            self.logger.warning(f"TLS handshake with {self.client_address[0]}:{self.client_address[1]} failed: {e}. Check IDA configuration and cert")
+            return False
+        self.metrics.tls_handshakes.observe(time.perf_counter() - start)
+        return True
 
-class LuminaServer(ThreadingMixIn, TCPServer):
+    def handle(self):
+        # admitted by the accept loop (see LuminaServer.verify_request): the session holds
+        # a session slot from before its TLS handshake
+        session = LuminaSession(self.server, self.client_address)
+        try:
+            if self.startSession():
+                self.serveSession(session)
+        finally:
+            session.close()
+            self.server.sessions.release()
+
+    def serveSession(self, session):
+        self.request.settimeout(self.server.config.idle_timeout)
+        self.metrics.sessions.inc()
+
+        try:
+            while not session.closed:
+                try:
+                    packet, message = self.recvMessage()
+                except EOFError:
+                    self.logger.debug("client %s:%s disconnected", *self.client_address[:2])
+                    break
+                except socket.timeout:
+                    self.logger.debug("client %s:%s idle timeout", *self.client_address[:2])
+                    break
+                except PacketTooLarge as e:
+                    self.logger.warning(f"client {self.client_address[0]}:{self.client_address[1]} closed: {e}")
+                    self.metrics.rejected.inc("packet")
+                    self.sendMessage(RPC_TYPE.RPC_NOTIFY, message = "Packet too large")
+                    break
+
+                with self.timer.time("db"):
+                    code, kwargs = session.handle_message(packet, message)
+                self.sendMessage(code, **kwargs)
+                self.server.log_slow_request(session, packet, message, self.timer)
+
+                if session.subscription is not None:
+                    # the connection now streams the replication log to a replica
+                    self.streamReplication(session)
+                    break
+        finally:
+            self.metrics.sessions.dec()
+
+    def streamReplication(self, session):
+        try:
+            for code, kwargs in session.replication_stream():
+                self.sendMessage(code, **kwargs)
+        except OSError as e:
+            self.logger.info("replica %s:%s disconnected: %s", *self.client_address[:2], e)
+
+class LuminaServer(LuminaServerMixIn, ThreadingMixIn, TCPServer):
     def __init__(self, database, config, logger, bind_and_activate=True):
-        super().__init__((config.ip, config.port), LuminaRequestHandler, bind_and_activate)
         self.config = config
+        super().__init__((config.ip, config.port), LuminaRequestHandler, bind_and_activate)
         self.database = database
         self.logger = logger
-        self.useTLS = False
-
-        if self.config.cert:
-            if self.config.cert_key is None:
-                raise ValueError("Missing certificate key argument")
+        self.sessions = threading.BoundedSemaphore(config.max_sessions)
+        self.init_tls()
+        self.init_limits()
+        self.init_replication()
+        self.metrics = LuminaMetrics(database, self.replica, self.upstream)
+
+    def verify_request(self, request, client_address):
+        # run by the accept loop: clients over the limits are closed before a thread
+        # is started for them
+        if not self.admit(client_address):
+            return False
+        if not self.sessions.acquire(blocking = False):
+            self.reject_session(client_address)
+            return False
+        return True
 
-            self.useTLS = True
+    def server_bind(self):
+        if self.config.workers > 1:
+            # every worker process binds its own socket, the kernel balances connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
     def get_request(self):
         client_socket, fromaddr = self.socket.accept()
 
-        self.logger.debug(f"new client {fromaddr[0]}:{fromaddr[1]}")
-        if not self.useTLS:
-            self.logger.debug("Starting plaintext session")
-            # extra check: make sure client does no try to initiate a TLS session (or parsing would hang)
-            data = client_socket.recv(3, socket.MSG_PEEK)
-            if data == b'\x16\x03\x01':
-                self.logger.error("TLS client HELLO detected on plaintext mode. Check IDA configuration and cert. Aborting")
-                client_socket.close()
-                raise OSError("NO TLS")
-
+        self.logger.debug("new client %s:%s", *fromaddr[:2])
         if self.useTLS:
-            self.logger.debug("Starting TLS session")
-            try:
-                client_socket = ssl.wrap_socket(client_socket,
-                                                ssl_version = ssl.PROTOCOL_TLSv1_2,
-                                                server_side = True,
-                                                certfile=self.config.cert.name,
-                                                keyfile=self.config.cert_key.name)
-
-            except Exception:
-                self.logger.exception("TLS connection failed. Check IDA configuration and cert")
-                raise
+            # no I/O here: the handshake is run by the connection thread (startSession)
+            client_socket = self.tls.context.wrap_socket(client_socket, server_side = True, do_handshake_on_connect = False)
 
         return client_socket, fromaddr
 
     def shutdown(self, save=True):
         self.logger.info("Server stopped")
         super().shutdown()
+        self.stop_replication()
         self.database.close(save=save)
 
     def serve_forever(self):
         self.logger.info(f"Server started. Listening on {self.server_address[0]}:{self.server_address[1]} (TLS={'ON' if self.useTLS else 'OFF'})")
         super().serve_forever()
 
-    def check_client(self, message):
-        """
-        Return True if user is authozied, else False
-        """
-        # check (message.hexrays_licence, message.hexrays_id, message.watermak, message.field_0x36)
-        self.logger.debug("RPC client accepted")
-        return True
-
 def signal_handler(sig, frame, server):
+    # ignore ctrl-c sent to the whole process group while stopping
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
     print('Ctrl+C caught. Exiting')
     server.shutdown(save=True)
     sys.exit(0)
 
+def open_database(config, logger):
+    if config.shards:
+        ssl_context = create_client_context(config.upstream_ca) if config.upstream_tls else None
+        return ShardedDatabase(logger, config.shards.split(","), ssl_context, config.idle_timeout)
+
+    history = HistoryPolicy(config.history, config.policy)
+    # caches and filters of other workers would not be updated by pushes
+    cache_size = config.cache_size if config.workers == 1 else 0
+    filter_error_rate = config.filter_error_rate if config.workers == 1 else 0
+    return LuminaDatabase(logger, config.db, config.backend, history, cache_size, filter_error_rate, config.write_behind,
+        config.replication_log << 20, config.idle_timeout, fsync=config.fsync, snapshot_interval=config.snapshot_interval,
+        compression_level=config.compression_level, hot_popularity=config.hot_popularity)
+
+def create_server(config, logger):
+    database = open_database(config, logger)
+    if config.use_asyncio:
+        return LuminaAsyncServer(database, config, logger)
+
+    TCPServer.allow_reuse_address = True
+    return LuminaServer(database, config, logger)
+
+def run_server(server):
+    metrics_server = None
+    if server.config.metrics_port:
+        metrics_server = start_metrics_server(server.metrics, server.config.ip, server.config.metrics_port)
+        server.logger.info(f"Metrics available on http://{server.config.ip}:{server.config.metrics_port}/metrics")
+
+    # set ctrl-c handler
+    signal.signal(signal.SIGINT, lambda sig,frame:signal_handler(sig, frame, server))
+    signal.signal(signal.SIGTERM, lambda sig,frame:signal_handler(sig, frame, server))
+    signal.signal(signal.SIGHUP, lambda sig,frame:server.reload_tls())
+
+    profiler = None
+    if server.config.profile:
+        profiler = SamplingProfiler(server.logger, server.config.profile)
+        signal.signal(signal.SIGUSR1, lambda sig,frame:profiler.dump())
+
+    # start server
+    try:
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = False
+        server_thread.start()
+        server_thread.join()
+
+        server.database.close(save=True)
+    finally:
+        # also reached by the SystemExit of signal_handler, once the server is shut down
+        if profiler is not None:
+            profiler.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+def run_workers(config, logger):
+    """
+    Fork config.workers server processes sharing the listening port (SO_REUSEPORT)
+    """
+
+    # create database before forking, workers only open it
+    open_database(config, logger).close()
+
+    workers = list()
+    for index in range(config.workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            if config.metrics_port:
+                # every worker serves its own metrics
+                config.metrics_port += index
+            try:
+                run_server(create_server(config, logger))
+            except SystemExit:
+                pass
+            except Exception:
+                logger.exception("worker failed")
+                status = 1
+            finally:
+                os._exit(status)
+
+        workers.append(pid)
+
+    def stop_workers(sig, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def forward_signal(sig, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    # certificate reload and profile dumps are handled by each worker
+    signal.signal(signal.SIGHUP, forward_signal)
+    signal.signal(signal.SIGUSR1, forward_signal)
+
+    for pid in workers:
+        os.waitpid(pid, 0)
+
+
+def create_parser():
+    """
+    return the command line parser of the server
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", type=str, nargs="?", help="database file (not used with --shards)")
+    parser.add_argument("-b", "--backend", dest="backend", type=str, choices=["auto", "sqlite", "memory", "mmap", "json"], default="auto", help="database storage backend. auto detects existing file format, new .json files use memory, others sqlite. json databases are migrated to memory unless json is selected (its pushes are lost if the server is killed), mmap converts memory and json databases (default: auto)")
+    parser.add_argument("--history", dest="history", type=int, default=8, help="maximum number of distinct metadata kept per signature (default: 8)")
+    parser.add_argument("--policy", dest="policy", type=str, choices=["frequent", "recent", "pushers"], default="frequent", help="metadata returned to pull queries: most pushed, most recently pushed or pushed by most clients (default: frequent)")
+    parser.add_argument("--fsync", dest="fsync", type=str, choices=["always", "interval", "never"], default="interval", help="sync pushes to disk before answering, every second, or leave it to the OS (default: interval)")
+    parser.add_argument("--snapshot-interval", dest="snapshot_interval", type=float, default=300, help="memory, mmap and json backends: seconds between background snapshots (mmap: compactions) of the database, 0 to only save on exit (default: 300)")
+    parser.add_argument("--compression-level", dest="compression_level", type=int, choices=range(10), default=0, metavar="{0-9}", help="memory, mmap and sqlite backends: zlib level of the metadata written, compressed with a dictionary trained on the database. Records are decompressed when pulled. 0 disables compression (default: 0)")
+    parser.add_argument("--hot-popularity", dest="hot_popularity", type=int, default=0, help="with --compression-level, metadata of signatures pushed at least this number of times is stored uncompressed. 0 compresses every signature (default: 0)")
+    parser.add_argument("--write-behind", dest="write_behind", type=int, default=0, help="answer pushes before writing them: up to this number of pushed functions are queued and written together in the background. Queued pushes are lost if the server is killed. 0 disables (default: 0)")
+    parser.add_argument("--cache-size", dest="cache_size", type=int, default=65536, help="number of most pulled signatures kept ready to send, 0 disables the cache. Disabled with several workers (default: 65536)")
+    parser.add_argument("--filter-error-rate", dest="filter_error_rate", type=float, default=0.01, help="sqlite and mmap backends: false positive rate of the in-memory signature filter answering pulls of unknown signatures without a lookup, 0 disables the filter. Disabled with several workers (default: 0.01)")
+    parser.add_argument("--admin", dest="admin", action="store_true", help="allow clients to delete, list and dump database entries (DEL_ENTRIES, SHOW_ENTRIES and DUMP_MD commands). Only use on a trusted network")
+    parser.add_argument("-i", "--ip", dest="ip", type=str, default="127.0.0.1", help="listening ip address (default: 127.0.0.1")
+    parser.add_argument("-p", "--port", dest="port", type=int, default=4443, help="listening port (default: 4443")
+    parser.add_argument("-c", "--cert", dest="cert", type=argparse.FileType('r'), default = None, help="proxy certfile (no cert means TLS OFF). The certificate and key are reloaded on SIGHUP")
+    parser.add_argument("-k", "--key", dest="cert_key",type=argparse.FileType('r'), default = None, help="certificate private key")
+    parser.add_argument("--tls-handshake-timeout", dest="tls_handshake_timeout", type=float, default=10, help="close TLS connections not done with their handshake after this number of seconds (default: 10)")
+    parser.add_argument("-t", "--idle-timeout", dest="idle_timeout", type=float, default=60, help="close client sessions idle for this number of seconds (default: 60)")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1, help="number of server processes sharing the listening port. Requires a multiprocess safe backend (sqlite) (default: 1)")
+    parser.add_argument("--asyncio", dest="use_asyncio", action="store_true", help="serve clients from an asyncio event loop instead of one thread per connection")
+    parser.add_argument("--max-sessions", dest="max_sessions", type=int, default=256, help="maximum number of concurrent client sessions, including TLS handshakes. Extra clients are disconnected (default: 256)")
+    parser.add_argument("--max-ip-sessions", dest="max_ip_sessions", type=int, default=0, help="maximum number of concurrent sessions per client ip address, 0 for no limit (default: 0)")
+    parser.add_argument("--max-id-sessions", dest="max_id_sessions", type=int, default=0, help="maximum number of concurrent sessions per hexrays_id (license), 0 for no limit (default: 0)")
+    parser.add_argument("--max-packet-size", dest="max_packet_size", type=int, default=64 << 20, help="maximum size of a request in bytes, clients sending larger requests are disconnected. 0 for no limit (default: 64 MiB)")
+    parser.add_argument("--max-funcs", dest="max_funcs", type=int, default=200000, help="maximum number of functions pushed or pulled by a single request, 0 for no limit (default: 200000)")
+    parser.add_argument("--threads", dest="threads", type=int, default=8, help="number of database requests processed concurrently. Large requests are split in chunks of 1024 functions queued fairly with other clients' requests (default: 8)")
+    parser.add_argument("--replication-log", dest="replication_log", type=int, default=0, help="primary: keep this number of MiB of pushes and deletes in a replication log streamed to replicas, 0 disables replication (default: 0)")
+    parser.add_argument("--replicas", dest="replicas", type=str, default=None, help="primary: comma separated ip addresses of the replicas allowed to follow the replication log. Replicas are refused unless listed, or the server is started with --admin (default: none)")
+    parser.add_argument("--replica-of", dest="replica_of", type=str, default=None, help="run as a read-only replica of the primary server at host:port: its replication log is applied to the database and pushes are forwarded to it")
+    parser.add_argument("--upstream", dest="upstream", type=str, default=None, help="comma separated host:port of servers holding the same database (replicas), signatures missing from the database are pulled from them in parallel")
+    parser.add_argument("--shards", dest="shards", type=str, default=None, help="run as a router without database: comma separated host:port of the shard servers, requests are split over them by consistent hashing of signatures. Shards must be listed with the same names on every router")
+    parser.add_argument("--upstream-tls", dest="upstream_tls", action="store_true", help="connect to the primary, upstream and shard servers with TLS")
+    parser.add_argument("--upstream-ca", dest="upstream_ca", type=str, default=None, help="check the certificates of the primary, upstream and shard servers against this CA file (default: not checked)")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, default=0, help="serve Prometheus metrics on http://<ip>:<port>/metrics, worker n of --workers uses port + n. 0 disables (default: 0)")
+    parser.add_argument("--slow-request", dest="slow_request", type=float, default=0, help="log requests taking longer than this number of milliseconds, with their command, size, client and the time spent in each phase. 0 disables (default: 0)")
+    parser.add_argument("--profile", dest="profile", type=str, default=None, help="sample the stacks of every thread, SIGUSR1 writes the stacks sampled since the previous dump to a file of this directory (flame graph folded format)")
+    parser.add_argument("-l", "--log", dest="log_level", type=str, choices=["NOTSET", "DEBUG", "INFO", "WARNING"], default="INFO", help="log level bases on python logging value (default:info)")
+    return parser
 
 def main():
     # default log handler is stdout. You can add a FileHandler or any handler you want
@@ -163,33 +360,44 @@ def main():
     logger.setLevel(logging.DEBUG)
 
     # Parse command line
-    parser = argparse.ArgumentParser()
-    parser.add_argument("db", type=argparse.FileType('a+'), default="", help="database file")
-    parser.add_argument("-i", "--ip", dest="ip", type=str, default="127.0.0.1", help="listening ip address (default: 127.0.0.1")
-    parser.add_argument("-p", "--port", dest="port", type=int, default=4443, help="listening port (default: 4443")
-    parser.add_argument("-c", "--cert", dest="cert", type=argparse.FileType('r'), default = None, help="proxy certfile (no cert means TLS OFF).")
-    parser.add_argument("-k", "--key", dest="cert_key",type=argparse.FileType('r'), default = None, help="certificate private key")
-    parser.add_argument("-l", "--log", dest="log_level", type=str, choices=["NOTSET", "DEBUG", "INFO", "WARNING"], default="INFO", help="log level bases on python logging value (default:info)")
+    parser = create_parser()
     config = parser.parse_args()
 
 
     logger.setLevel(config.log_level)
 
-    # create db & server
-    database = LuminaDatabase(logger, config.db)
-    TCPServer.allow_reuse_address = True
-    server = LuminaServer(database, config, logger)
-
-    # set ctrl-c handler
-    signal.signal(signal.SIGINT, lambda sig,frame:signal_handler(sig, frame, server))
-
-    # start server
-    server_thread = threading.Thread(target=server.serve_forever)
-    server_thread.daemon = False
-    server_thread.start()
-    server_thread.join()
+    if config.shards and (config.replication_log or config.replica_of or config.upstream):
+        parser.error("a router (--shards) can not replicate nor pull from upstream servers, configure the shards instead")
+    if not config.shards and config.db is None:
+        parser.error("a database file is required")
+
+    if config.profile and not os.path.isdir(config.profile):
+        parser.error(f"profile directory {config.profile} does not exist")
+
+    if config.backend == "json":
+        logger.warning("json backend: pushes are only saved by snapshots, pushes since the last snapshot are lost if the server is killed")
+
+    if config.workers > 1 and (config.replication_log or config.replica_of):
+        parser.error("replication requires a single worker")
+    if config.replica_of:
+        backend = serving_backend(config.db) if config.backend == "auto" else config.backend
+        if not STORAGE_BACKENDS[backend].replicable:
+            parser.error(f"the {backend} backend can not store the replication position of a replica")
+    if config.replication_log and not config.replicas and not config.admin:
+        logger.warning("no replica is allowed to follow the replication log, list them with --replicas")
+
+    if config.workers > 1:
+        # routers hold no database
+        backend = None if config.shards else serving_backend(config.db) if config.backend == "auto" else config.backend
+        if backend is not None and not STORAGE_BACKENDS[backend].multiprocess_safe:
+            parser.error(f"{backend} backend can not be shared by several workers")
+
+        log_handler.setFormatter(logging.Formatter("[%(asctime)s] [%(process)d] [%(levelname)s] %(message)s"))
+        run_workers(config, logger)
+        return
 
-    server.database.close(save=True)
+    # create db & server
+    run_server(create_server(config, logger))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,4 +1,4 @@
-import socket
+import socket, struct, time
 import construct as con
 from construct import (
     Byte, Bytes, Int8ub, Int16ub, Int16ul, Int16sb, Int32ub, Int32ul, Int64ub,
@@ -225,7 +225,13 @@ RPC_TYPE = con.Enum(Byte,
     DUMP_MD = 0x1c,
     DUMP_MD_RESULT = 0x1d,
     CLEAN_DB = 0x1e,
-    DEBUGCTL = 0x1f
+    DEBUGCTL = 0x1f,
+    # replication between servers, specific to this server
+    REPL_SUBSCRIBE = 0x20,
+    REPL_RECORDS = 0x21,
+    # database size, specific to this server
+    COUNT_ENTRIES = 0x22,
+    COUNT_ENTRIES_RESULT = 0x23,
 )
 
 RpcMessage_FAIL = con.Struct(
@@ -272,6 +278,87 @@ RpcMessage_PUSH_MD_RESULT = con.Struct(
     "resultsFlags" / ObjectList(IdaVarInt32),       # status for each function pushed
 )
 
+#
+# Administration messages: the layouts used by IDA are unknown, those below are
+# specific to this server. SHOW_ENTRIES and DUMP_MD page through the database:
+# send the cursor of the previous result until an empty cursor is returned.
+#
+
+# database entry summary
+func_entry_t = con.Struct(
+    "signature" / func_sig_t,
+    "func_name" / CString("utf8"),
+    "func_size" / IdaVarInt32,
+    "popularity" / IdaVarInt32,
+    )
+
+# func_md_t with popularity
+func_dump_t = con.Struct(
+    "metadata" / func_metadata,
+    "signature" / func_sig_t,
+    "popularity" / IdaVarInt32,
+    )
+
+RpcMessage_GET_POP = con.Struct(
+    "funcInfos" / ObjectList(func_sig_t),           # list of func_sig_t
+)
+
+RpcMessage_GET_POP_RESULT = con.Struct(
+    "popularities" / ObjectList(IdaVarInt32),       # popularity of each signature (0 if not found)
+)
+
+RpcMessage_DEL_ENTRIES = con.Struct(
+    "funcInfos" / ObjectList(func_sig_t),           # list of func_sig_t to delete
+)
+
+RpcMessage_DEL_ENTRIES_RESULT = con.Struct(
+    "resultsFlags" / ObjectList(IdaVarInt32),       # 1 if the signature was deleted, 0 if not found
+)
+
+RpcMessage_SHOW_ENTRIES = con.Struct(
+    "cursor" / VarBuff,                             # empty for the first page
+    "limit" / IdaVarInt32,                          # maximum number of entries (capped by the server)
+)
+
+RpcMessage_SHOW_ENTRIES_RESULT = con.Struct(
+    "entries" / ObjectList(func_entry_t),
+    "cursor" / VarBuff,                             # cursor of the next page, empty after the last one
+)
+
+RpcMessage_DUMP_MD = con.Struct(
+    "cursor" / VarBuff,                             # empty for the first page
+    "limit" / IdaVarInt32,                          # maximum number of entries (capped by the server)
+)
+
+RpcMessage_DUMP_MD_RESULT = con.Struct(
+    "funcInfos" / ObjectList(func_dump_t),
+    "cursor" / VarBuff,                             # cursor of the next page, empty after the last one
+)
+
+RpcMessage_COUNT_ENTRIES = con.Struct()
+
+RpcMessage_COUNT_ENTRIES_RESULT = con.Struct(
+    "count" / IdaVarInt64,                          # signatures in the database
+)
+
+#
+# Replication messages: a replica sends REPL_SUBSCRIBE, the primary answers RPC_OK
+# then streams REPL_RECORDS messages (empty ones while it is idle) until the
+# connection is closed. Records are encoded as in replication.py.
+#
+
+RpcMessage_REPL_SUBSCRIBE = con.Struct(
+    "log_id" / VarBuff,                             # replication log of the position, empty for a new replica
+    "position" / IdaVarInt64,                       # first record to send, 0 for a new replica
+)
+
+RpcMessage_REPL_RECORDS = con.Struct(
+    "log_id" / VarBuff,                             # replication log of the primary
+    "position" / IdaVarInt64,                       # position of the first record
+    "end" / IdaVarInt64,                            # position of the next record appended to the log
+    "records" / ObjectList(VarBuff),
+)
+
 
 
 # Generic RPC message 'union'
@@ -285,24 +372,266 @@ RpcMessage = con.Switch(this.code,
             RPC_TYPE.PULL_MD_RESULT : RpcMessage_PULL_MD_RESULT,
             RPC_TYPE.PUSH_MD : RpcMessage_PUSH_MD,
             RPC_TYPE.PUSH_MD_RESULT : RpcMessage_PUSH_MD_RESULT,
-            #RPC_TYPE.GET_POP : RpcMessage_GET_POP,
-            #RPC_TYPE.GET_POP_RESULT : RpcMessage_GET_POP_RESULT,
+            RPC_TYPE.GET_POP : RpcMessage_GET_POP,
+            RPC_TYPE.GET_POP_RESULT : RpcMessage_GET_POP_RESULT,
             #RPC_TYPE.LIST_PEERS : RpcMessage_LIST_PEERS,
             #RPC_TYPE.LIST_PEERS_RESULT : RpcMessage_LIST_PEERS_RESULT,
             #RPC_TYPE.KILL_SESSIONS : RpcMessage_KILL_SESSIONS,
             #RPC_TYPE.KILL_SESSIONS_RESULT : RpcMessage_KILL_SESSIONS_RESULT,
-            #RPC_TYPE.DEL_ENTRIES : RpcMessage_DEL_ENTRIES,
-            #RPC_TYPE.DEL_ENTRIES_RESULT : RpcMessage_DEL_ENTRIES_RESULT,
-            #RPC_TYPE.SHOW_ENTRIES : RpcMessage_SHOW_ENTRIES,
-            #RPC_TYPE.SHOW_ENTRIES_RESULT : RpcMessage_SHOW_ENTRIES_RESULT,
-            #RPC_TYPE.DUMP_MD : RpcMessage_DUMP_MD,
-            #RPC_TYPE.DUMP_MD_RESULT : RpcMessage_DUMP_MD_RESULT,
+            RPC_TYPE.DEL_ENTRIES : RpcMessage_DEL_ENTRIES,
+            RPC_TYPE.DEL_ENTRIES_RESULT : RpcMessage_DEL_ENTRIES_RESULT,
+            RPC_TYPE.SHOW_ENTRIES : RpcMessage_SHOW_ENTRIES,
+            RPC_TYPE.SHOW_ENTRIES_RESULT : RpcMessage_SHOW_ENTRIES_RESULT,
+            RPC_TYPE.DUMP_MD : RpcMessage_DUMP_MD,
+            RPC_TYPE.DUMP_MD_RESULT : RpcMessage_DUMP_MD_RESULT,
             #RPC_TYPE.CLEAN_DB : RpcMessage_CLEAN_DB,
             #RPC_TYPE.DEBUGCTL : RpcMessage_DEBUGCTL,
+            RPC_TYPE.REPL_SUBSCRIBE : RpcMessage_REPL_SUBSCRIBE,
+            RPC_TYPE.REPL_RECORDS : RpcMessage_REPL_RECORDS,
+            RPC_TYPE.COUNT_ENTRIES : RpcMessage_COUNT_ENTRIES,
+            RPC_TYPE.COUNT_ENTRIES_RESULT : RpcMessage_COUNT_ENTRIES_RESULT,
         },
         default = None
     )
 
+#######################################
+#
+# Fast codec
+#
+# Hand written (de)serialization of the hot messages (PULL_MD, PUSH_MD and their
+# results). It works directly on a memoryview with precomputed varint tables and
+# must produce the same results as the construct definitions above, which remain
+# the reference implementation.
+#######################################
+
+# IdaVarInt32 first byte -> number of extra bytes / mask of the first byte
+_VARINT32_EXTRA = bytes([0, 0, 0, 0, 1, 1, 3, 4][b >> 5] for b in range(0x100))
+_VARINT32_MASK = bytes([0xff, 0xff, 0xff, 0xff, 0x7f, 0x7f, 0x3f, 0x00][b >> 5] for b in range(0x100))
+
+# IdaVarInt32 encoding of small values (1 or 2 bytes)
+_VARINT32_SMALL = [bytes([x]) for x in range(0x80)] + [(x | 0x8000).to_bytes(2, "big") for x in range(0x80, 0x4000)]
+
+def _parse_varint32(view, pos):
+    b = view[pos]
+    extra = _VARINT32_EXTRA[b]
+    num = b & _VARINT32_MASK[b]
+    pos += 1
+    if extra == 1:
+        return (num << 8) | view[pos], pos + 1
+    elif extra:
+        end = pos + extra
+        if end > len(view):
+            raise con.StreamError("stream read less than specified amount")
+        return (num << (8 * extra)) | int.from_bytes(view[pos:end], "big"), end
+    return num, pos
+
+def _parse_varint64(view, pos):
+    low, pos = _parse_varint32(view, pos)
+    high, pos = _parse_varint32(view, pos)
+    return (high << 32) | low, pos
+
+def _parse_bytes(view, pos, size):
+    # zero-copy: blobs are returned as slices of the packet buffer
+    end = pos + size
+    if end > len(view):
+        raise con.StreamError("stream read less than specified amount")
+    return view[pos:end], end
+
+def _parse_varbuff(view, pos):
+    size, pos = _parse_varint32(view, pos)
+    return _parse_bytes(view, pos, size)
+
+def _parse_cstring(view, pos):
+    # look for the null terminator chunk by chunk to avoid copying the whole buffer
+    end = pos
+    while True:
+        chunk = view[end:end + 0x100].tobytes()
+        if not chunk:
+            raise con.StreamError("stream read less than specified amount")
+        idx = chunk.find(b"\x00")
+        if idx != -1:
+            end += idx
+            break
+        end += len(chunk)
+
+    return str(view[pos:end], "utf8"), end + 1
+
+def _parse_func_sig(view, pos):
+    version, pos = _parse_varint32(view, pos)
+    if version != 1:
+        raise con.ConstError(f"parsing expected 1 but parsed {version}")
+    signature, pos = _parse_varbuff(view, pos)
+    return Container(version = version, signature = signature), pos
+
+def _parse_func_metadata(view, pos):
+    func_name, pos = _parse_cstring(view, pos)
+    func_size, pos = _parse_varint32(view, pos)
+    serialized_data, pos = _parse_varbuff(view, pos)
+    return Container(func_name = func_name, func_size = func_size, serialized_data = serialized_data), pos
+
+def _parse_func_info(view, pos):
+    metadata, pos = _parse_func_metadata(view, pos)
+    popularity, pos = _parse_varint32(view, pos)
+    return Container(metadata = metadata, popularity = popularity), pos
+
+def _parse_func_md(view, pos):
+    metadata, pos = _parse_func_metadata(view, pos)
+    signature, pos = _parse_func_sig(view, pos)
+    return Container(metadata = metadata, signature = signature), pos
+
+def _parse_list(parse_item, view, pos):
+    count, pos = _parse_varint32(view, pos)
+    items = con.ListContainer()
+    for _ in range(count):
+        item, pos = parse_item(view, pos)
+        items.append(item)
+    return items, pos
+
+def _parse_pull_md(view, pos):
+    flags, pos = _parse_varint32(view, pos)
+    ukn_list, pos = _parse_list(_parse_varint32, view, pos)
+    funcInfos, pos = _parse_list(_parse_func_sig, view, pos)
+    return Container(flags = flags, ukn_list = ukn_list, funcInfos = funcInfos), pos
+
+def _parse_pull_md_result(view, pos):
+    found, pos = _parse_list(_parse_varint32, view, pos)
+    results, pos = _parse_list(_parse_func_info, view, pos)
+    return Container(found = found, results = results), pos
+
+def _parse_push_md(view, pos):
+    field_0x10, pos = _parse_varint32(view, pos)
+    idb_filepath, pos = _parse_cstring(view, pos)
+    input_filepath, pos = _parse_cstring(view, pos)
+    input_md5, pos = _parse_bytes(view, pos, 16)
+    hostname, pos = _parse_cstring(view, pos)
+    funcInfos, pos = _parse_list(_parse_func_md, view, pos)
+    funcEas, pos = _parse_list(_parse_varint64, view, pos)
+    return Container(field_0x10 = field_0x10, idb_filepath = idb_filepath, input_filepath = input_filepath,
+        input_md5 = input_md5, hostname = hostname, funcInfos = funcInfos, funcEas = funcEas), pos
+
+def _parse_push_md_result(view, pos):
+    resultsFlags, pos = _parse_list(_parse_varint32, view, pos)
+    return Container(resultsFlags = resultsFlags), pos
+
+
+def _build_varint32(out, x):
+    if 0 <= x < 0x4000:
+        out += _VARINT32_SMALL[x]
+    elif 0x4000 <= x <= 0x1FFFFFFF:
+        out += (x | 0xC0000000).to_bytes(4, "big")
+    elif 0x1FFFFFFF < x <= 0xFFFFFFFF:
+        out += b"\xff"
+        out += x.to_bytes(4, "big")
+    elif x < 0:
+        raise IntegerError(f"cannot build from negative number: {x!r}")
+    else:
+        raise IntegerError(f"cannot build from number above integer range: {x!r}")
+
+def _build_varint64(out, x):
+    if not 0 <= x <= 0xFFFFFFFFFFFFFFFF:
+        raise IntegerError(f"cannot build from number out of range: {x!r}")
+    _build_varint32(out, x & 0xFFFFFFFF)
+    _build_varint32(out, x >> 32)
+
+def _build_varbuff(out, data):
+    _build_varint32(out, len(data))
+    out += data
+
+def _build_cstring(out, string):
+    out += string.encode("utf8")
+    out += b"\x00"
+
+def _build_func_sig(out, sig):
+    version = sig.get("version")
+    if version is not None and version != 1:
+        raise con.ConstError(f"building expected 1 but got {version}")
+    out += b"\x01"
+    _build_varbuff(out, sig["signature"])
+
+def _build_func_metadata(out, metadata):
+    _build_cstring(out, metadata["func_name"])
+    _build_varint32(out, metadata["func_size"])
+    _build_varbuff(out, metadata["serialized_data"])
+
+def _build_func_info(out, info):
+    if isinstance(info, bytes):
+        # already serialized (see func_info_build)
+        out += info
+        return
+    _build_func_metadata(out, info["metadata"])
+    popularity = info.get("popularity")
+    _build_varint32(out, 0 if popularity is None else popularity)
+
+def _build_func_md(out, md):
+    _build_func_metadata(out, md["metadata"])
+    _build_func_sig(out, md["signature"])
+
+def _build_list(build_item, out, items):
+    _build_varint32(out, len(items))
+    for item in items:
+        build_item(out, item)
+
+def _build_pull_md(out, msg):
+    _build_varint32(out, msg["flags"])
+    _build_list(_build_varint32, out, msg["ukn_list"])
+    _build_list(_build_func_sig, out, msg["funcInfos"])
+
+def _build_pull_md_result(out, msg):
+    _build_list(_build_varint32, out, msg["found"])
+    _build_list(_build_func_info, out, msg["results"])
+
+def _build_push_md(out, msg):
+    _build_varint32(out, msg["field_0x10"])
+    _build_cstring(out, msg["idb_filepath"])
+    _build_cstring(out, msg["input_filepath"])
+    if len(msg["input_md5"]) != 16:
+        raise con.StreamError("bytes object of wrong length, expected 16")
+    out += msg["input_md5"]
+    _build_cstring(out, msg["hostname"])
+    _build_list(_build_func_md, out, msg["funcInfos"])
+    _build_list(_build_varint64, out, msg["funcEas"])
+
+def _build_push_md_result(out, msg):
+    _build_list(_build_varint32, out, msg["resultsFlags"])
+
+
+# message code -> (parser, builder)
+FAST_CODECS = {
+    RPC_TYPE.PULL_MD : (_parse_pull_md, _build_pull_md),
+    RPC_TYPE.PULL_MD_RESULT : (_parse_pull_md_result, _build_pull_md_result),
+    RPC_TYPE.PUSH_MD : (_parse_push_md, _build_push_md),
+    RPC_TYPE.PUSH_MD_RESULT : (_parse_push_md_result, _build_push_md_result),
+}
+
+def fast_message_parse(code, data):
+    """
+    Deserialize a message from a bytes-like object using the fast codec
+    """
+    parse, _ = FAST_CODECS[code]
+    view = memoryview(data)
+    try:
+        message, pos = parse(view, 0)
+    except IndexError:
+        raise con.StreamError("stream read less than specified amount")
+    return message
+
+def fast_message_build(code, **kwargs):
+    """
+    Serialize a message using the fast codec
+    """
+    _, build = FAST_CODECS[code]
+    out = bytearray()
+    build(out, kwargs)
+    return bytes(out)
+
+def func_info_build(metadata, popularity):
+    """
+    Serialize a func_info_t, the bytes can be used as PULL_MD_RESULT results items
+    """
+    out = bytearray()
+    _build_func_info(out, dict(metadata = metadata, popularity = popularity))
+    return bytes(out)
+
 # RPC packet common header
 rpc_packet_t = con.Struct(
     "length" / Rebuild(Hex(Int32ub), len_(this.data)),
@@ -310,15 +639,87 @@ rpc_packet_t = con.Struct(
     "data" / con.HexDump(con.Bytes(this.length))
     )
 
+RPC_HEADER_SIZE = 5
+
+def rpc_header_parse(header):
+    """
+    Return (length, code) of an RPC packet header
+    """
+    length, = struct.unpack_from(">I", header)
+    return length, RPC_TYPE.parse(header[4:5])
+
+def rpc_message_decode(code, data):
+    """
+    Deserialize an RPC message payload from a bytes-like object
+    """
+    if code in FAST_CODECS:
+        return fast_message_parse(code, data)
+    return RpcMessage.parse(data, code = code)
+
+class PacketTooLarge(Exception):
+    """
+    Raised for RPC packets over the maximum length, their payload is not read
+    """
+    def __init__(self, length, max_length):
+        super().__init__(f"packet of {length} bytes exceeds the maximum of {max_length} bytes")
+        self.length = length
+
+class RpcReader(object):
+    """
+    Read RPC packets from a socket. Payloads are received (recv_into) in a reusable
+    buffer and decoded in place: blobs of the returned message are slices of
+    this buffer, only valid until the next read.
+    """
+
+    def __init__(self, sock, bufsize=0x10000, max_length=0):
+        """
+        max_length: maximum payload length, larger packets raise PacketTooLarge (0: unlimited)
+        """
+        self.sock = sock
+        self.bufsize = bufsize
+        self.max_length = max_length
+        self.header = bytearray(RPC_HEADER_SIZE)
+        self.buffer = bytearray(bufsize)
+
+    def recv_exactly(self, view):
+        while view:
+            size = self.sock.recv_into(view)
+            if size == 0:
+                raise EOFError("connection closed by peer")
+            view = view[size:]
+
+    def read_packet(self):
+        """
+        Receive an RPC packet, its payload is not decoded.
+        packet.received is the time (perf_counter) its header was received
+        """
+        self.recv_exactly(memoryview(self.header))
+        received = time.perf_counter()
+        length, code = rpc_header_parse(self.header)
+        if self.max_length and length > self.max_length:
+            raise PacketTooLarge(length, self.max_length)
+
+        # large packets get their own buffer so it is not kept for the whole connection
+        buffer = self.buffer if length <= self.bufsize else bytearray(length)
+        data = memoryview(buffer)[:length]
+        self.recv_exactly(data)
+
+        return Container(length = length, code = code, data = data, received = received)
+
+    def read_message(self):
+        packet = self.read_packet()
+        return packet, rpc_message_decode(packet.code, packet.data)
+
 def rpc_message_build(code, **kwargs):
     """
     Build and serialize an RPC packet
     """
-    data = RpcMessage.build(kwargs, code = code)
+    if code in FAST_CODECS:
+        data = fast_message_build(code, **kwargs)
+    else:
+        data = RpcMessage.build(kwargs, code = code)
 
-    return rpc_packet_t.build(Container(code = code,
-        data = data)
-    )
+    return struct.pack(">I", len(data)) + RPC_TYPE.build(code) + data
 
 def rpc_message_parse(source):
     """
@@ -330,15 +731,13 @@ def rpc_message_parse(source):
     elif isinstance(source, bytes):
         # parse source as bytes
         packet = rpc_packet_t.parse(source)
+    elif isinstance(source, socket.socket):
+        return RpcReader(source).read_message()
     else:
         # parse source as file-like object
-        if isinstance(source, socket.socket):
-            # construct requires a file-like object with read/write methods:
-            source = source.makefile(mode='rb')
-
         packet = rpc_packet_t.parse_stream(source)
 
-    message = RpcMessage.parse(packet.data , code = packet.code)
+    message = rpc_message_decode(packet.code, packet.data)
     # Warning: parsing return a Container object wich hold a io.BytesIO to the socket
     # see https://github.com/construct/construct/issues/852
     return packet, message
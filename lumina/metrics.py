@@ -0,0 +1,256 @@
+import os, time, bisect, threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+################################################################################
+#
+# Metrics
+#
+# Counters, gauges and histograms rendered in the Prometheus text format, and
+# served in plaintext on /metrics (--metrics-port). Updates only take a lock
+# and increment a value: they are always collected.
+#
+################################################################################
+
+# request phases, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# signatures per request
+SIZE_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096, 16384)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class Metric(object):
+    type = "untyped"
+
+    def __init__(self, name, help, labels=(), function=None):
+        """
+        labels: names of the labels, their values are passed to updates.
+        function: called at render time to get the value of a metric without labels
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = dict()
+        if not labels:
+            # exported before the first update
+            self.values[()] = self.zero()
+
+    def zero(self):
+        return 0
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        """
+        Yield (name suffix, labels, value)
+        """
+        if self.function is not None:
+            yield "", "", self.function()
+            return
+
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in sorted(values):
+            yield "", self.format_labels(labels), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{self.name}{suffix}{labels} {value}" for suffix, labels, value in self.samples()]
+        return "\n".join(lines) + "\n"
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount = -amount)
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        super().__init__(name, help, labels)
+
+    def zero(self):
+        # per bucket counts (last one is +Inf), sum
+        return [[0] * (len(self.buckets) + 1), 0]
+
+    def observe(self, value, *labels):
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = self.zero()
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, (list(counts), total)) for labels, (counts, total) in self.values.items()]
+
+        for labels, (counts, total) in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield "_bucket", self.format_labels(labels, [("le", bound)]), cumulative
+            yield "_sum", self.format_labels(labels), total
+            yield "_count", self.format_labels(labels), cumulative
+
+
+class RequestTimer(object):
+    """
+    Time spent in each phase of a request, observed by the phases histogram and
+    kept for the slow request log
+    """
+    def __init__(self, phases, start=None):
+        """
+        start: perf_counter time the request was received (default: now)
+        """
+        self.phases = phases
+        self.start = time.perf_counter() if start is None else start
+        self.durations = dict()
+
+    def observe(self, phase, duration):
+        self.durations[phase] = self.durations.get(phase, 0) + duration
+        self.phases.observe(duration, phase)
+
+    @contextmanager
+    def time(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+class LuminaMetrics(object):
+    """
+    Metrics of a server process
+    """
+    def __init__(self, database, replica=None, upstream=None):
+        self.database = database
+
+        self.requests = Counter("lumina_requests_total", "RPC requests received, by command", ("command",))
+        self.signatures = Histogram("lumina_request_signatures", "signatures per request, by command", ("command",), SIZE_BUCKETS)
+        self.pulled = Counter("lumina_pulled_signatures_total", "signatures queried by PULL_MD, by result (hit, upstream or miss)", ("result",))
+        self.phases = Histogram("lumina_request_phase_seconds", "time spent per request phase (recv, parse, db, build, send)", ("phase",))
+        self.sessions = Gauge("lumina_active_sessions", "connected client sessions")
+        self.tls_handshakes = Histogram("lumina_tls_handshake_seconds", "duration of TLS handshakes")
+        self.tls_failures = Counter("lumina_tls_handshake_failures_total", "failed TLS handshakes")
+        self.rejected = Counter("lumina_rejected_total", "sessions or requests over the limits, by reason (sessions, packet, funcs)", ("reason",))
+
+        self.metrics = [self.requests, self.signatures, self.pulled, self.phases, self.sessions,
+            self.tls_handshakes, self.tls_failures, self.rejected,
+            Gauge("lumina_database_signatures", "signatures in the database", function=database.count),
+            Gauge("lumina_database_file_bytes", "size of the database file", function=lambda: os.path.getsize(database.db_path))]
+
+        if database.cache is not None:
+            self.metrics += [
+                Gauge("lumina_cache_entries", "pull results in the metadata cache", function=lambda: database.cache.stats()["size"]),
+                Counter("lumina_cache_hits_total", "pulled signatures found in the metadata cache", function=lambda: database.cache.stats()["hits"]),
+                Counter("lumina_cache_misses_total", "pulled signatures read from the database", function=lambda: database.cache.stats()["misses"]),
+            ]
+
+        if database.writer is not None:
+            self.metrics += [
+                Gauge("lumina_write_queue_functions", "pushed functions waiting to be written (--write-behind)", function=lambda: database.writer.stats()["queued"]),
+                Counter("lumina_write_failures_total", "failed writes of queued pushes, retried (--write-behind)", function=lambda: database.writer.stats()["failures"]),
+            ]
+
+        if database.filter is not None:
+            self.metrics += [
+                Gauge("lumina_filter_capacity", "signatures the signature filter is sized for (0 until built)", function=lambda: database.filter.stats()["capacity"]),
+                Counter("lumina_filter_skipped_total", "pulled signatures ruled out by the signature filter", function=lambda: database.filter.stats()["skipped"]),
+                Counter("lumina_filter_false_positives_total", "pulled signatures passed by the signature filter but not found", function=lambda: database.filter.stats()["false_positives"]),
+            ]
+
+        if database.replication is not None:
+            self.metrics += [
+                Gauge("lumina_replication_log_end", "position of the next record of the replication log", function=lambda: database.replication.stats()["end"]),
+                Gauge("lumina_replication_log_bytes", "size of the replication log files", function=lambda: database.replication.stats()["size"]),
+            ]
+
+        if replica is not None:
+            self.metrics += [
+                Gauge("lumina_replica_position", "position of the next record of the primary log to apply", function=lambda: replica.stats()["position"]),
+                Gauge("lumina_replica_lag_records", "records of the primary log not applied yet", function=lambda: replica.stats()["lag"]),
+            ]
+
+        if upstream is not None:
+            self.metrics.append(Counter("lumina_upstream_errors_total", "failed pulls from upstream servers", function=lambda: upstream.errors))
+
+    def render(self):
+        output = list()
+        for metric in self.metrics:
+            try:
+                output.append(metric.render())
+            except Exception:
+                # database closed or file missing: the metric is skipped
+                continue
+        return "".join(output)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not logged
+        pass
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics, address):
+        super().__init__(address, MetricsRequestHandler)
+        self.metrics = metrics
+
+def start_metrics_server(metrics, ip, port):
+    """
+    Serve metrics on http://ip:port/metrics from a background thread
+    """
+    server = MetricsServer(metrics, (ip, port))
+    thread = threading.Thread(target=server.serve_forever, name="lumina-metrics", daemon=True)
+    thread.start()
+    return server
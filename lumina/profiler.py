@@ -0,0 +1,77 @@
+import os, sys, time, threading
+from collections import Counter
+
+#######################################
+#
+# Sampling profiler
+#
+# --profile: a background thread samples the Python stack of every thread at a
+# fixed interval and counts identical stacks. Threads waiting for I/O or a lock
+# are sampled too (wall clock profile): time spent reading clients, parsing,
+# querying the database or waiting for it shows as the share of its stacks.
+# A dump (SIGUSR1) writes the stacks counted since the previous dump in the
+# folded format of flame graph tools (flamegraph.pl, speedscope), one
+# "outermost;...;innermost count" line per stack.
+#######################################
+
+# seconds between samples
+SAMPLE_INTERVAL = 0.01
+
+class SamplingProfiler(object):
+    def __init__(self, logger, directory, interval=SAMPLE_INTERVAL):
+        """
+        directory: where dumps are written, as profile-<pid>-<date>.folded
+        """
+        self.logger = logger
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.samples = 0
+        self.window_start = time.time()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="lumina-profiler", daemon=True)
+        self.thread.start()
+        self.logger.info(f"sampling stacks every {interval * 1000:g} ms, send SIGUSR1 to write them to {directory}")
+
+    @staticmethod
+    def fold(frame):
+        """
+        return the stack of frame as "outermost;...;innermost"
+        """
+        names = list()
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def run(self):
+        ident = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            stacks = [self.fold(frame) for thread, frame in sys._current_frames().items() if thread != ident]
+            with self.lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def dump(self):
+        """
+        Write the stacks sampled since the previous dump and start a new window
+        return the path of the dump
+        """
+        with self.lock:
+            stacks, samples, start = self.stacks, self.samples, self.window_start
+            self.stacks = Counter()
+            self.samples = 0
+            self.window_start = time.time()
+
+        path = os.path.join(self.directory, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.logger.info(f"profile of the last {time.time() - start:.0f} seconds ({samples} samples) written to {path}")
+        return path
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,416 @@
+import os, bisect, socket, threading, zlib
+
+try:
+    from lumina.lumina_structs import RPC_TYPE
+    from lumina.wal import RECORD_HEADER, fsync_directory
+    from lumina.storage import WAL_DELETE, encode_push, decode_push, decode_delete, pack_metadata, unpack_metadata
+    from lumina.upstream import UpstreamConnection, UpstreamPool, UpstreamError
+except ImportError:
+    # local import for standalone use
+    from lumina_structs import RPC_TYPE
+    from wal import RECORD_HEADER, fsync_directory
+    from storage import WAL_DELETE, encode_push, decode_push, decode_delete, pack_metadata, unpack_metadata
+    from upstream import UpstreamConnection, UpstreamPool, UpstreamError
+
+################################################################################
+#
+# Replication
+#
+# A primary numbers the pushes and deletes applied to its database in a
+# replication log, streamed to its replicas in REPL_RECORDS messages. Replicas
+# apply the records to their own database, serve pulls from it and forward
+# pushes to the primary. Records use the write-ahead log encoding (see
+# storage.py), log files are <db>.repl.<position of their first record> and the
+# random id of the log is kept in <db>.repl.id, with "complete" if the log was
+# created along with an empty database: only then can a new replica with an empty
+# database follow it from its first record.
+#
+# A replica stores the position of each record with its writes (same transaction
+# or write-ahead log record, see Storage.push_batches) and resumes from there
+# after a crash. <db>.replica holds the position of a replica seeded with a copy
+# of the primary database, until records are applied.
+#
+################################################################################
+
+# replication log files are rotated at this size
+SEGMENT_SIZE = 64 << 20
+# maximum size of the records of a REPL_RECORDS message
+MAX_MESSAGE_SIZE = 4 << 20
+# seconds between REPL_RECORDS messages of an idle primary, a replica reconnects
+# after missing HEARTBEAT_TIMEOUT seconds of messages
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+# seconds between connection attempts of a replica
+RECONNECT_DELAY = 5
+
+class ReplicationError(Exception):
+    """
+    Raised for replica positions the primary can not stream from
+    """
+    pass
+
+def encode_batches(now, batches):
+    """
+    return the records of pushed (entries, pusher) batches
+    """
+    return [encode_push(now, pusher, [(bytes(signature), pack_metadata(metadata["func_name"], metadata["func_size"], metadata["serialized_data"]))
+        for signature, metadata in entries]) for entries, pusher in batches]
+
+
+class ReplicationLog(object):
+    def __init__(self, logger, path, max_size, empty=False):
+        """
+        max_size: bytes of records kept for replicas, older log files are deleted
+        empty: True if the database is empty (see load_id)
+        """
+        self.logger = logger
+        self.path = path
+        self.max_size = max_size
+        self.cond = threading.Condition()
+        self.closed = False
+        self.log_id, self.complete = self.load_id(empty)
+        # position of the first record of each log file, and their size
+        self.segments = list()
+        self.sizes = dict()
+        # position of the next record
+        self.end = 1
+        self.file = None
+        self.open()
+
+    def segment_path(self, first):
+        return f"{self.path}.{first:012d}"
+
+    def load_id(self, empty):
+        """
+        return the log id, and True if the log holds every update of the database
+        (a new log is complete if the database is empty)
+        """
+        id_path = self.path + ".id"
+        if os.path.exists(id_path):
+            with open(id_path, "r") as id_file:
+                fields = id_file.read().split()
+            return fields[0], fields[1:] == ["complete"]
+
+        log_id = os.urandom(8).hex()
+        if not empty:
+            self.logger.warning("replication log created for a database that is not empty: new replicas must be seeded with a copy of it")
+        with open(id_path + ".tmp", "w") as id_file:
+            id_file.write(f"{log_id} {'complete' if empty else 'partial'}\n")
+            id_file.flush()
+            os.fsync(id_file.fileno())
+        os.replace(id_path + ".tmp", id_path)
+        fsync_directory(id_path)
+        return log_id, empty
+
+    def open(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + "."
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                first = int(name[len(prefix):])
+                self.segments.append(first)
+                self.sizes[first] = os.path.getsize(self.segment_path(first))
+        self.segments.sort()
+
+        if not self.segments:
+            self.segments.append(self.end)
+            self.sizes[self.end] = 0
+
+        # count the records of the last file, a torn record (crash while appending) is truncated
+        last = self.segments[-1]
+        self.file = open(self.segment_path(last), "a+b")
+        self.file.seek(0)
+        count = 0
+        offset = 0
+        while True:
+            header = self.file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            size, crc = RECORD_HEADER.unpack(header)
+            payload = self.file.read(size)
+            if len(payload) != size or zlib.crc32(payload) != crc:
+                break
+            offset += RECORD_HEADER.size + size
+            count += 1
+
+        if offset != self.sizes[last]:
+            self.logger.warning(f"truncating torn replication log record in {self.segment_path(last)} at offset {offset}")
+            self.file.truncate(offset)
+            self.sizes[last] = offset
+        self.end = last + count
+        self.logger.info(f"replication log {self.log_id}: records {self.segments[0]} to {self.end - 1}")
+
+    def append(self, records):
+        """
+        Append records, in the order they were applied to the database.
+        Records are flushed to the OS, log files are synced when rotated
+        """
+        with self.cond:
+            if self.closed:
+                return
+            data = b"".join(RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record for record in records)
+            self.file.write(data)
+            self.file.flush()
+            self.end += len(records)
+            self.sizes[self.segments[-1]] += len(data)
+
+            if self.sizes[self.segments[-1]] >= SEGMENT_SIZE:
+                self.rotate()
+            self.cond.notify_all()
+
+    def rotate(self):
+        """
+        Start a new log file and delete the oldest ones over max_size (called with the lock held).
+        Replicas reading a deleted file keep it open until they are done with it
+        """
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = open(self.segment_path(self.end), "a+b")
+        self.segments.append(self.end)
+        self.sizes[self.end] = 0
+        fsync_directory(self.path)
+
+        while len(self.segments) > 1 and sum(self.sizes.values()) > self.max_size:
+            first = self.segments.pop(0)
+            del self.sizes[first]
+            os.unlink(self.segment_path(first))
+
+    def reader(self, log_id, position):
+        """
+        return a LogReader streaming from position of log log_id (empty log_id and
+        position 0 for a new replica), or raise ReplicationError
+        """
+        with self.cond:
+            if log_id and log_id != self.log_id:
+                raise ReplicationError(f"replica of another log ({log_id}, this primary has {self.log_id}): reseed the replica")
+            if not position:
+                if not self.complete:
+                    raise ReplicationError("the database was not empty when the log was created: seed the replica with a copy of the primary database and its position")
+                if self.segments[0] != 1:
+                    raise ReplicationError(f"the log starts at record {self.segments[0]}: seed the replica with a copy of the primary database and its position")
+                position = 1
+            if position > self.end:
+                raise ReplicationError(f"replica at record {position} is ahead of the log (next record {self.end}): reseed the replica")
+            if position < self.segments[0]:
+                raise ReplicationError(f"record {position} was deleted from the log (first record {self.segments[0]}): reseed the replica")
+        return LogReader(self, position)
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.cond.notify_all()
+        self.logger.info(f"replication log {self.log_id} closed, next record {self.end}")
+
+    def stats(self):
+        return dict(first = self.segments[0], end = self.end, size = sum(self.sizes.values()))
+
+class LogReader(object):
+    """
+    Sequential reader of the replication log, for a replica session
+    """
+    def __init__(self, log, position):
+        self.log = log
+        self.position = position
+        self.file = None
+        self.segment = None
+
+    def read(self, timeout=HEARTBEAT_INTERVAL):
+        """
+        return the records following the previous read (at most MAX_MESSAGE_SIZE bytes),
+        waiting up to timeout for new ones: an empty list if none, None once the log is closed
+        """
+        log = self.log
+        with log.cond:
+            if self.position == log.end and not log.closed:
+                log.cond.wait(timeout)
+            if log.closed:
+                self.close()
+                return None
+            end = log.end
+            segments = list(log.segments)
+
+        records = list()
+        size = 0
+        while self.position < end and size < MAX_MESSAGE_SIZE:
+            index = bisect.bisect_right(segments, self.position) - 1
+            if index >= 0:
+                segment = segments[index]
+            elif self.segment is not None and self.segment <= self.position:
+                # oldest files are deleted first: the open file was deleted, it is still readable
+                segment = self.segment
+            else:
+                raise ReplicationError(f"record {self.position} was deleted from the log")
+
+            if segment != self.segment:
+                self.seek(segment)
+            header = self.file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # end of a deleted file, the following one was deleted too
+                raise ReplicationError(f"record {self.position} was deleted from the log")
+            record_size, _ = RECORD_HEADER.unpack(header)
+            records.append(self.file.read(record_size))
+            self.position += 1
+            size += record_size
+        return records
+
+    def seek(self, segment):
+        """
+        Open the log file starting at record segment, at self.position
+        """
+        self.close()
+        try:
+            self.file = open(self.log.segment_path(segment), "rb")
+        except FileNotFoundError:
+            raise ReplicationError(f"record {self.position} was deleted from the log")
+        self.segment = segment
+        for _ in range(self.position - segment):
+            record_size, _ = RECORD_HEADER.unpack(self.file.read(RECORD_HEADER.size))
+            self.file.seek(record_size, os.SEEK_CUR)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.segment = None
+
+
+class Replica(object):
+    """
+    Follow the replication log of a primary from a background thread, and forward
+    pushes to it
+    """
+    def __init__(self, logger, database, address, ssl_context=None):
+        self.logger = logger
+        self.database = database
+        self.address = address
+        self.ssl_context = ssl_context
+        self.state_path = database.db_path + ".replica"
+        # position stored with the records applied, else the seeded one
+        self.log_id, self.position = database.storage.replicated or self.load_state()
+        # next record of the primary log, as of the last message
+        self.end = self.position
+        self.pool = UpstreamPool(address, ssl_context)
+        self.connection = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.follow_loop, name="lumina-replica", daemon=True)
+        self.thread.start()
+
+    def load_state(self):
+        """
+        return the log id and next record of the saved position ("", 0 for a new replica)
+        """
+        if not os.path.exists(self.state_path):
+            return "", 0
+        with open(self.state_path, "r") as state_file:
+            log_id, position = state_file.read().split()
+        return log_id, int(position)
+
+    def save_state(self):
+        with open(self.state_path + ".tmp", "w") as state_file:
+            state_file.write(f"{self.log_id} {self.position}\n")
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def follow_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                self.follow()
+            except ReplicationError as e:
+                self.logger.error(f"replication from {self.address[0]}:{self.address[1]} stopped: {e}")
+            except (OSError, EOFError, UpstreamError) as e:
+                if not self.stop_event.is_set():
+                    self.logger.warning(f"replication from {self.address[0]}:{self.address[1]} interrupted: {e}")
+            except Exception:
+                self.logger.exception(f"replication from {self.address[0]}:{self.address[1]} failed")
+            finally:
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+            self.stop_event.wait(RECONNECT_DELAY)
+
+    def follow(self):
+        self.connection = UpstreamConnection(self.address, self.ssl_context, HEARTBEAT_TIMEOUT)
+        if self.stop_event.is_set():
+            return
+
+        self.connection.request(RPC_TYPE.REPL_SUBSCRIBE, RPC_TYPE.RPC_OK, log_id = self.log_id.encode("ascii"), position = self.position)
+        self.logger.info(f"replicating {self.address[0]}:{self.address[1]} from record {self.position or 1}")
+
+        while not self.stop_event.is_set():
+            try:
+                message = self.connection.read(RPC_TYPE.REPL_RECORDS)
+            except UpstreamError as e:
+                # a NOTIFY explains why the primary refused the subscription
+                raise ReplicationError(str(e))
+
+            log_id = bytes(message.log_id).decode("ascii")
+            if self.log_id and log_id != self.log_id:
+                raise ReplicationError(f"primary log changed from {self.log_id} to {log_id}")
+            if self.position and message.position != self.position:
+                raise ReplicationError(f"expected record {self.position}, received {message.position}")
+
+            self.apply(log_id, message.position, message.records)
+            self.log_id = log_id
+            self.position = message.position + len(message.records)
+            self.end = message.end
+            if message.records or not os.path.exists(self.state_path):
+                self.save_state()
+
+    def apply(self, log_id, position, records):
+        """
+        Apply records in order, position is the log position of the first one: consecutive
+        pushes of the same second are written together, along with their position
+        """
+        batches = list()
+        batches_now = None
+        for record in records:
+            if record[:1] == WAL_DELETE:
+                if batches:
+                    self.database.write_batches(batches, batches_now, (log_id, position - len(batches)))
+                    batches = list()
+                self.database.remove(decode_delete(record), (log_id, position))
+                position += 1
+                continue
+
+            now, pusher, entries = decode_push(record)
+            if batches and now != batches_now:
+                self.database.write_batches(batches, batches_now, (log_id, position - len(batches)))
+                batches = list()
+            batches.append(([(signature, unpack_metadata(record)) for signature, record in entries], pusher))
+            batches_now = now
+            position += 1
+
+        if batches:
+            self.database.write_batches(batches, batches_now, (log_id, position - len(batches)))
+
+    def push(self, message, pusher):
+        """
+        Forward a PUSH_MD message to the primary, pusher identifies the client.
+        return its result flags
+        """
+        with self.pool.connection() as connection:
+            # the primary records the client identity passed as hostname, as with a router
+            reply = connection.request(RPC_TYPE.PUSH_MD, RPC_TYPE.PUSH_MD_RESULT,
+                field_0x10 = message.field_0x10, idb_filepath = message.idb_filepath, input_filepath = message.input_filepath,
+                input_md5 = message.input_md5, hostname = pusher, funcInfos = message.funcInfos, funcEas = message.funcEas)
+            return list(reply.resultsFlags)
+
+    def close(self):
+        self.stop_event.set()
+        connection = self.connection
+        if connection is not None:
+            # interrupt a blocking read
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.thread.join()
+        self.pool.close()
+        self.logger.info(f"replica stopped at record {self.position} of log {self.log_id or '(none)'}")
+
+    def stats(self):
+        return dict(position = self.position, lag = max(0, self.end - self.position))
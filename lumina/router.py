@@ -0,0 +1,241 @@
+import bisect, struct, hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from lumina.lumina_structs import RPC_TYPE
+    from lumina.upstream import UpstreamPool, UpstreamError, parse_address
+except ImportError:
+    # local import for standalone use
+    from lumina_structs import RPC_TYPE
+    from upstream import UpstreamPool, UpstreamError, parse_address
+
+################################################################################
+#
+# Shard router
+#
+# A router (--shards) holds no database: the signatures of each request are
+# spread over shard servers by a consistent hash ring, the parts are sent to the
+# shards in parallel with the usual protocol and their results are reassembled
+# in request order. Each shard owns VNODES points of the ring: adding a shard
+# only moves the signatures of the ring intervals it takes over (about 1/n of the
+# database for the n-th shard), the other signatures keep their shard.
+#
+################################################################################
+
+# points of each shard on the ring
+VNODES = 256
+
+# SHOW_ENTRIES / DUMP_MD cursor of a router: shard index (u16), then the cursor of the shard
+SHARD_CURSOR = struct.Struct(">H")
+
+def ring_hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+class HashRing(object):
+    def __init__(self, nodes, vnodes=VNODES):
+        """
+        nodes: shard names (host:port as given on the command line), the ring only
+        depends on them, not on their order
+        """
+        if len(set(nodes)) != len(nodes):
+            raise ValueError("duplicate shard in the ring")
+
+        self.nodes = list(nodes)
+        points = sorted((ring_hash(f"{node}#{i}".encode("utf8")), index)
+            for index, node in enumerate(self.nodes) for i in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.owners = [index for _, index in points]
+
+    def node_index(self, signature):
+        """
+        return the index of the node owning signature: the first point following its hash
+        """
+        i = bisect.bisect_right(self.points, ring_hash(signature))
+        return self.owners[i if i < len(self.points) else 0]
+
+    def partition(self, signatures):
+        """
+        return {node index: indexes of its signatures}
+        """
+        parts = dict()
+        for i, signature in enumerate(signatures):
+            parts.setdefault(self.node_index(signature), list()).append(i)
+        return parts
+
+
+class ShardedDatabase(object):
+    """
+    LuminaDatabase interface over shard servers.
+    Shards must be started with --admin for DEL_ENTRIES, SHOW_ENTRIES and DUMP_MD.
+    """
+    # no local cache, signature filter, write-behind queue or replication log
+    cache = None
+    filter = None
+    writer = None
+    replication = None
+
+    def __init__(self, logger, shards, ssl_context=None, timeout=60):
+        self.logger = logger
+        self.db_path = None
+        self.ring = HashRing(shards)
+        self.pools = [UpstreamPool(parse_address(shard), ssl_context, timeout) for shard in shards]
+        self.executor = ThreadPoolExecutor(max_workers=8 * len(shards), thread_name_prefix="lumina-router")
+        self.logger.info(f"routing requests to {len(shards)} shards: {', '.join(shards)}")
+
+    def dispatch(self, signatures, request):
+        """
+        Call request(pool, indexes) in parallel for the signatures (bytes) of each shard.
+        return a list of (indexes, result)
+        """
+        parts = self.ring.partition(signatures)
+        futures = [(part, self.executor.submit(self.request, self.pools[index], request, part)) for index, part in parts.items()]
+        return [(part, future.result()) for part, future in futures]
+
+    def request(self, pool, request, part):
+        try:
+            return request(pool, part)
+        except (OSError, EOFError) as e:
+            raise UpstreamError(f"shard {pool.address[0]}:{pool.address[1]} failed: {e}")
+
+    def check_version(self, signatures):
+        for sig in signatures:
+            if sig.version != 1:
+                self.logger.warning(f"Signature version {sig.version} not supported. Results might be inconsistent")
+                break
+
+    def push_many(self, infos, pusher=None):
+        """
+        Push a list of func_md_t to their shards. pusher identifies the client.
+        return a list of flags: True on new insertion, else False
+        """
+        self.check_version(info.signature for info in infos)
+
+        def push(pool, part):
+            with pool.connection() as connection:
+                # the client identity is passed as hostname, recorded as is by the shard (upstream session)
+                message = connection.request(RPC_TYPE.PUSH_MD, RPC_TYPE.PUSH_MD_RESULT,
+                    field_0x10 = 0, idb_filepath = "", input_filepath = "", input_md5 = bytes(16),
+                    hostname = pusher or "", funcInfos = [infos[i] for i in part], funcEas = [0] * len(part))
+                return list(message.resultsFlags)
+
+        results = [False] * len(infos)
+        for part, flags in self.dispatch([bytes(info.signature.signature) for info in infos], push):
+            for i, flag in zip(part, flags):
+                results[i] = bool(flag)
+        return results
+
+    def pull_encoded(self, signatures):
+        """
+        Query a list of func_sig_t.
+        return a list of serialized func_info_t (bytes) or None if not found
+        """
+        self.check_version(signatures)
+        signatures = [bytes(sig.signature) for sig in signatures]
+
+        def pull(pool, part):
+            try:
+                return pool.pull([signatures[i] for i in part])
+            except (OSError, EOFError, UpstreamError) as e:
+                # answered as unknown
+                self.logger.warning(f"pull from shard {pool.address[0]}:{pool.address[1]} failed: {e}")
+                return [None] * len(part)
+
+        results = [None] * len(signatures)
+        for part, func_infos in self.dispatch(signatures, pull):
+            for i, func_info in zip(part, func_infos):
+                results[i] = func_info
+        return results
+
+    def get_popularity(self, signatures):
+        """
+        return the popularity of each func_sig_t (0 if not found)
+        """
+        self.check_version(signatures)
+        signatures = [bytes(sig.signature) for sig in signatures]
+
+        def get_popularity(pool, part):
+            with pool.connection() as connection:
+                message = connection.request(RPC_TYPE.GET_POP, RPC_TYPE.GET_POP_RESULT,
+                    funcInfos = [dict(signature = signatures[i]) for i in part])
+                return list(message.popularities)
+
+        results = [0] * len(signatures)
+        for part, popularities in self.dispatch(signatures, get_popularity):
+            for i, popularity in zip(part, popularities):
+                results[i] = popularity
+        return results
+
+    def delete_many(self, signatures):
+        """
+        Delete a list of func_sig_t.
+        return a list of flags: True if deleted, False if not found
+        """
+        self.check_version(signatures)
+        signatures = [bytes(sig.signature) for sig in signatures]
+
+        def delete(pool, part):
+            with pool.connection() as connection:
+                message = connection.request(RPC_TYPE.DEL_ENTRIES, RPC_TYPE.DEL_ENTRIES_RESULT,
+                    funcInfos = [dict(signature = signatures[i]) for i in part])
+                return list(message.resultsFlags)
+
+        results = [False] * len(signatures)
+        for part, flags in self.dispatch(signatures, delete):
+            for i, flag in zip(part, flags):
+                results[i] = bool(flag)
+        return results
+
+    def count(self):
+        """
+        return the number of signatures of all shards (COUNT_ENTRIES of each shard)
+        """
+        def count(pool, part):
+            with pool.connection() as connection:
+                return connection.request(RPC_TYPE.COUNT_ENTRIES, RPC_TYPE.COUNT_ENTRIES_RESULT).count
+
+        futures = [self.executor.submit(self.request, pool, count, None) for pool in self.pools]
+        return sum(future.result() for future in futures)
+
+    def scan(self, cursor=None, limit=1000):
+        """
+        Page through the shards one after the other (DUMP_MD of each shard).
+        return (entries, cursor), see LuminaDatabase.scan
+        raise ValueError if cursor was not returned by a previous call
+        """
+        index = 0
+        shard_cursor = b""
+        if cursor:
+            if len(cursor) < SHARD_CURSOR.size:
+                raise ValueError("truncated cursor")
+            index, = SHARD_CURSOR.unpack_from(cursor)
+            if index >= len(self.pools):
+                raise ValueError(f"cursor of shard {index}, only {len(self.pools)} shards")
+            shard_cursor = bytes(cursor[SHARD_CURSOR.size:])
+
+        def dump(pool, part):
+            with pool.connection() as connection:
+                message = connection.request(RPC_TYPE.DUMP_MD, RPC_TYPE.DUMP_MD_RESULT, cursor = shard_cursor, limit = limit)
+                entries = [(bytes(info.signature.signature), {
+                        "func_name"         : info.metadata.func_name,
+                        "func_size"         : info.metadata.func_size,
+                        "serialized_data"   : bytes(info.metadata.serialized_data),
+                    }, info.popularity) for info in message.funcInfos]
+                return entries, bytes(message.cursor)
+
+        entries, shard_cursor = self.request(self.pools[index], dump, None)
+        if shard_cursor:
+            cursor = SHARD_CURSOR.pack(index) + shard_cursor
+        elif index + 1 < len(self.pools):
+            # pages of the next shard follow, even if this page is empty
+            cursor = SHARD_CURSOR.pack(index + 1)
+        else:
+            cursor = None
+        return entries, cursor
+
+    def save(self):
+        return True
+
+    def close(self, save=False):
+        self.executor.shutdown(wait=False)
+        for pool in self.pools:
+            pool.close()
@@ -0,0 +1,379 @@
+try:
+    from lumina.lumina_structs import RPC_TYPE
+    from lumina.limits import SessionCounter, FairScheduler
+    from lumina.replication import Replica, ReplicationError
+    from lumina.upstream import UpstreamServers, UpstreamError, parse_address, UPSTREAM_LICENCE
+    from lumina.tls import ServerTLS, create_client_context
+    from lumina.writer import WriteBehindError
+except ImportError:
+    # local import for standalone use
+    from lumina_structs import RPC_TYPE
+    from limits import SessionCounter, FairScheduler
+    from replication import Replica, ReplicationError
+    from upstream import UpstreamServers, UpstreamError, parse_address, UPSTREAM_LICENCE
+    from tls import ServerTLS, create_client_context
+    from writer import WriteBehindError
+
+
+################################################################################
+#
+# Server common code
+#
+################################################################################
+
+class LuminaServerMixIn(object):
+    """
+    Code shared by every server core
+    """
+
+    def init_tls(self):
+        self.useTLS = False
+        self.tls = None
+        if self.config.cert:
+            if self.config.cert_key is None:
+                raise ValueError("Missing certificate key argument")
+
+            self.useTLS = True
+            # shared by every connection, so clients can resume their TLS sessions
+            self.tls = ServerTLS(self.logger, self.config.cert.name, self.config.cert_key.name)
+
+    def reload_tls(self):
+        """
+        Reload the certificate and key (SIGHUP)
+        """
+        if self.tls is not None:
+            self.tls.reload()
+
+    def init_limits(self):
+        # per process: each worker of --workers has its own limits
+        self.ip_sessions = SessionCounter(self.config.max_ip_sessions)
+        self.id_sessions = SessionCounter(self.config.max_id_sessions)
+        self.scheduler = FairScheduler(self.config.threads)
+
+    def init_replication(self):
+        config = self.config
+        ssl_context = create_client_context(config.upstream_ca) if config.upstream_tls else None
+
+        self.replica = None
+        if config.replica_of:
+            self.replica = Replica(self.logger, self.database, parse_address(config.replica_of), ssl_context)
+
+        self.upstream = None
+        if config.upstream:
+            addresses = [parse_address(address) for address in config.upstream.split(",")]
+            self.upstream = UpstreamServers(self.logger, addresses, ssl_context, config.idle_timeout)
+
+    def stop_replication(self):
+        if self.replica is not None:
+            self.replica.close()
+        if self.upstream is not None:
+            self.upstream.close()
+
+    def admit(self, client_address):
+        """
+        Per address limit, checked as soon as a connection is accepted. The address of an
+        admitted client is counted until its session is closed (LuminaSession.close)
+        return True if the client may start a session, else False
+        """
+        if not self.ip_sessions.acquire(client_address[0]):
+            self.logger.warning(f"client {client_address[0]}:{client_address[1]} closed: too many sessions from its address (--max-ip-sessions)")
+            self.metrics.rejected.inc("sessions")
+            return False
+        return True
+
+    def reject_session(self, client_address):
+        """
+        Close a client admitted while every session slot is taken
+        """
+        self.ip_sessions.release(client_address[0])
+        self.logger.warning(f"client {client_address[0]}:{client_address[1]} closed: no free session slot (--max-sessions)")
+        self.metrics.rejected.inc("sessions")
+
+    def log_slow_request(self, session, packet, message, timer):
+        """
+        Log a request that took longer than --slow-request, with the time spent in each phase
+        """
+        elapsed = timer.elapsed()
+        if not self.config.slow_request or elapsed * 1000 < self.config.slow_request:
+            return
+
+        details = [f"{packet.code}", f"{packet.length} bytes"]
+        if message is not None and "funcInfos" in message:
+            details.append(f"{len(message.funcInfos)} functions")
+        if packet.code == RPC_TYPE.PUSH_MD and message is not None:
+            details += [f"hostname {message.hostname!r}", f"input_md5 {bytes(message.input_md5).hex()}"]
+        phases = ", ".join(f"{phase} {duration * 1000:.1f}" for phase, duration in timer.durations.items())
+        client = f"{session.client_address[0]}:{session.client_address[1]}"
+        if session.hexrays_id is not None:
+            client += f" ({session.hexrays_id:x})"
+        self.logger.warning(f"slow request from {client}: {', '.join(details)}, {elapsed * 1000:.1f} ms ({phases} ms)")
+
+    def check_client(self, message):
+        """
+        Return True if user is authozied, else False
+        """
+        # check (message.hexrays_licence, message.hexrays_id, message.watermak, message.field_0x36)
+        self.logger.debug("RPC client accepted")
+        return True
+
+    def check_admin(self, session):
+        """
+        Return True if client session may delete, list or dump database entries, else False
+        """
+        return self.config.admin
+
+    def check_replica(self, session):
+        """
+        Return True if client session may follow the replication log, else False:
+        replicas listed by --replicas, or any client allowed administration commands
+        """
+        if self.config.replicas and session.client_address[0] in self.config.replicas.split(","):
+            return True
+        return self.check_admin(session)
+
+
+################################################################################
+#
+# Client session
+#
+# Protocol state of a client connection, independent of the server I/O model
+# (thread per connection or asyncio).
+#
+################################################################################
+
+# administration commands (see check_admin)
+ADMIN_COMMANDS = (RPC_TYPE.DEL_ENTRIES, RPC_TYPE.SHOW_ENTRIES, RPC_TYPE.DUMP_MD)
+# maximum number of entries of a SHOW_ENTRIES or DUMP_MD page
+MAX_PAGE_SIZE = 1000
+
+class LuminaSession(object):
+    def __init__(self, server, client_address):
+        self.server = server
+        self.logger = server.logger
+        self.database = server.database
+        self.client_address = client_address
+        self.authenticated = False
+        self.closed = False
+        self.hexrays_id = None
+        # session of a router or replica (see upstream.py): not counted by the per
+        # license limit, its pushes carry the identity of the client as hostname
+        self.upstream = False
+        self.id_registered = False
+        # LogReader of a replica, once subscribed (see replication_stream)
+        self.subscription = None
+        # the address was counted when the client was admitted (see LuminaServerMixIn.admit)
+        self.ip_registered = True
+
+    def close(self):
+        """
+        Release the session limits, once the connection is closed
+        """
+        if self.ip_registered:
+            self.server.ip_sessions.release(self.client_address[0])
+            self.ip_registered = False
+        if self.id_registered:
+            self.server.id_sessions.release(self.hexrays_id)
+            self.id_registered = False
+
+    def handle_message(self, packet, message):
+        """
+        Handle a received RPC message and return the (code, kwargs) reply to send.
+        self.closed is set once the connection must be closed after the reply.
+        """
+        metrics = self.server.metrics
+        metrics.requests.inc(str(packet.code))
+        if message is not None and "funcInfos" in message:
+            metrics.signatures.observe(len(message.funcInfos), str(packet.code))
+
+        #
+        # First RPC packet must be RPC_HELO
+        #
+        if not self.authenticated and packet.code != RPC_TYPE.RPC_HELO:
+            self.closed = True
+            return RPC_TYPE.RPC_NOTIFY, dict(message = 'Expected helo')
+
+        if packet.code == RPC_TYPE.RPC_HELO:
+            if not self.server.check_client(message):
+                self.closed = True
+                return RPC_TYPE.RPC_NOTIFY, dict(message = 'Invalid license')
+
+            if self.id_registered:
+                # helo sent again
+                self.server.id_sessions.release(self.hexrays_id)
+                self.id_registered = False
+            self.authenticated = False
+            self.upstream = bytes(message.hexrays_licence) == UPSTREAM_LICENCE
+            if not self.upstream:
+                if not self.server.id_sessions.acquire(message.hexrays_id):
+                    self.logger.warning(f"too many sessions of {message.hexrays_id:x}")
+                    metrics.rejected.inc("sessions")
+                    self.closed = True
+                    return RPC_TYPE.RPC_NOTIFY, dict(message = 'Too many sessions')
+                self.id_registered = True
+
+            self.authenticated = True
+            self.hexrays_id = message.hexrays_id
+            return RPC_TYPE.RPC_OK, dict()
+
+        max_funcs = self.server.config.max_funcs
+        if max_funcs and message is not None and len(message.get("funcInfos", ())) > max_funcs:
+            self.logger.warning(f"{packet.code} of {len(message.funcInfos)} functions rejected (--max-funcs {max_funcs})")
+            metrics.rejected.inc("funcs")
+            return RPC_TYPE.RPC_NOTIFY, dict(message = f"Too many functions in a single request (maximum {max_funcs})")
+
+        # database work is split in chunks shared with other sessions
+        scheduler = self.server.scheduler
+
+        #
+        # Handle request commands until the client disconnects:
+        #
+        if packet.code == RPC_TYPE.PUSH_MD:
+            pusher = message.hostname if self.upstream else f"{self.hexrays_id:x}/{message.hostname}"
+            if self.server.replica is not None:
+                # applied by the primary, then replicated back
+                try:
+                    results = self.server.replica.push(message, pusher)
+                except (OSError, EOFError, UpstreamError) as e:
+                    self.logger.error(f"failed to forward push to the primary: {e}")
+                    return RPC_TYPE.RPC_NOTIFY, dict(message = "Primary server unavailable, push again later")
+                return RPC_TYPE.PUSH_MD_RESULT, dict(resultsFlags = results)
+
+            try:
+                results = scheduler.run(lambda infos: self.database.push_many(infos, pusher), message.funcInfos)
+            except UpstreamError as e:
+                return self.shard_failure(e)
+            except WriteBehindError as e:
+                self.logger.error(f"push of {len(message.funcInfos)} functions failed: {e}")
+                return RPC_TYPE.RPC_NOTIFY, dict(message = "Database busy, push again later")
+
+            return RPC_TYPE.PUSH_MD_RESULT, dict(resultsFlags = results)
+
+        elif packet.code == RPC_TYPE.PULL_MD:
+            # results are serialized func_info_t
+            pulled = scheduler.run(self.database.pull_encoded, message.funcInfos)
+            hits = len(pulled) - pulled.count(None)
+
+            upstream = self.server.upstream
+            missing = [i for i, func_info in enumerate(pulled) if func_info is None]
+            if upstream is not None and missing:
+                for i, func_info in zip(missing, upstream.pull([bytes(message.funcInfos[i].signature) for i in missing])):
+                    pulled[i] = func_info
+
+            found = list()
+            results = list()
+            for func_info in pulled:
+                if func_info:
+                    found.append(1)
+                    results.append(func_info)
+                else:
+                    found.append(0)
+
+            metrics.pulled.inc("hit", amount = hits)
+            metrics.pulled.inc("upstream", amount = len(results) - hits)
+            metrics.pulled.inc("miss", amount = len(found) - len(results))
+
+            return RPC_TYPE.PULL_MD_RESULT, dict(found = found, results = results)
+
+        elif packet.code == RPC_TYPE.REPL_SUBSCRIBE and not self.server.check_replica(self):
+            self.logger.warning(f"replication rejected for {self.client_address[0]} (--replicas)")
+            return RPC_TYPE.RPC_NOTIFY, dict(message = "Replication is not allowed from your address")
+
+        elif packet.code == RPC_TYPE.REPL_SUBSCRIBE:
+            replication = self.database.replication
+            if replication is None:
+                return RPC_TYPE.RPC_NOTIFY, dict(message = "Replication is disabled (--replication-log)")
+
+            try:
+                self.subscription = replication.reader(bytes(message.log_id).decode("ascii", "replace"), message.position)
+            except ReplicationError as e:
+                self.logger.warning(f"replication rejected for {self.client_address[0]}: {e}")
+                return RPC_TYPE.RPC_NOTIFY, dict(message = str(e))
+
+            self.logger.info(f"replica {self.client_address[0]} following from record {self.subscription.position}")
+            return RPC_TYPE.RPC_OK, dict()
+
+        elif packet.code == RPC_TYPE.DEL_ENTRIES and self.server.replica is not None:
+            return RPC_TYPE.RPC_NOTIFY, dict(message = "Read-only replica, delete entries on the primary server")
+
+        elif packet.code in ADMIN_COMMANDS and not self.server.check_admin(self):
+            self.logger.warning(f"{packet.code} rejected: administration commands are disabled")
+            return RPC_TYPE.RPC_NOTIFY, dict(message = "Administration commands are disabled")
+
+        elif packet.code == RPC_TYPE.GET_POP:
+            try:
+                popularities = scheduler.run(self.database.get_popularity, message.funcInfos)
+            except UpstreamError as e:
+                return self.shard_failure(e)
+
+            return RPC_TYPE.GET_POP_RESULT, dict(popularities = popularities)
+
+        elif packet.code == RPC_TYPE.DEL_ENTRIES:
+            try:
+                results = scheduler.run(self.database.delete_many, message.funcInfos)
+            except UpstreamError as e:
+                return self.shard_failure(e)
+            self.logger.info(f"{sum(results)} entries deleted by {self.hexrays_id:x}")
+
+            return RPC_TYPE.DEL_ENTRIES_RESULT, dict(resultsFlags = results)
+
+        elif packet.code in (RPC_TYPE.SHOW_ENTRIES, RPC_TYPE.DUMP_MD):
+            limit = min(message.limit, MAX_PAGE_SIZE) or MAX_PAGE_SIZE
+            try:
+                with scheduler.slot():
+                    entries, cursor = self.database.scan(message.cursor or None, limit)
+            except UpstreamError as e:
+                return self.shard_failure(e)
+            except ValueError as e:
+                self.logger.warning(f"{packet.code} rejected: {e}")
+                return RPC_TYPE.RPC_NOTIFY, dict(message = "Invalid cursor")
+            cursor = cursor or b""
+
+            if packet.code == RPC_TYPE.SHOW_ENTRIES:
+                entries = [dict(signature = dict(signature = signature), func_name = metadata["func_name"],
+                    func_size = metadata["func_size"], popularity = popularity) for signature, metadata, popularity in entries]
+                return RPC_TYPE.SHOW_ENTRIES_RESULT, dict(entries = entries, cursor = cursor)
+
+            entries = [dict(metadata = metadata, signature = dict(signature = signature), popularity = popularity)
+                for signature, metadata, popularity in entries]
+            return RPC_TYPE.DUMP_MD_RESULT, dict(funcInfos = entries, cursor = cursor)
+
+        elif packet.code == RPC_TYPE.COUNT_ENTRIES:
+            try:
+                with scheduler.slot():
+                    count = self.database.count()
+            except UpstreamError as e:
+                return self.shard_failure(e)
+
+            return RPC_TYPE.COUNT_ENTRIES_RESULT, dict(count = count)
+
+        else:
+            self.logger.error("[-] ERROR: message handler not implemented")
+            return RPC_TYPE.RPC_NOTIFY, dict(message = "Unknown command")
+            #return RPC_TYPE.RPC_FAIL, dict(status = -1, message = "not implemented")
+
+    def shard_failure(self, error):
+        """
+        Reply of a router to a request failing on a shard server (see router.py)
+        """
+        self.logger.error(f"request failed: {error}")
+        return RPC_TYPE.RPC_NOTIFY, dict(message = "Shard server unavailable, try again later")
+
+    def replication_stream(self):
+        """
+        Yield the (code, kwargs) REPL_RECORDS messages sent to a subscribed replica,
+        until the replication log is closed
+        """
+        replication = self.database.replication
+        log_id = replication.log_id.encode("ascii")
+        try:
+            while True:
+                position = self.subscription.position
+                records = self.subscription.read()
+                if records is None:
+                    return
+                yield RPC_TYPE.REPL_RECORDS, dict(log_id = log_id, position = position, end = replication.end, records = records)
+        except ReplicationError as e:
+            self.logger.warning(f"replication stopped for {self.client_address[0]}: {e}")
+            yield RPC_TYPE.RPC_NOTIFY, dict(message = str(e))
+        finally:
+            self.subscription.close()
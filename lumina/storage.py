@@ -0,0 +1,2008 @@
+import os, re, json, codecs, sqlite3, struct, threading, time, hashlib, queue, zlib, mmap, shutil, tempfile, bisect, itertools
+from array import array
+from contextlib import contextmanager, ExitStack
+from base64 import b64encode, b64decode
+
+try:
+    from lumina.history import HistoryPolicy, Variant
+    from lumina.wal import WriteAheadLog, FSYNC_POLICIES, fsync_directory
+    from lumina.compression import RecordCodec, train_dictionary, TRAINING_SAMPLES
+except ImportError:
+    # local import for standalone use
+    from history import HistoryPolicy, Variant
+    from wal import WriteAheadLog, FSYNC_POLICIES, fsync_directory
+    from compression import RecordCodec, train_dictionary, TRAINING_SAMPLES
+
+#######################################
+#
+# Storage backends
+#
+# A backend stores, for each raw signature (bytes), a popularity counter and the
+# distinct metadata pushed by clients (see history.py). Metadata are dict with
+# func_name, func_size and serialized_data (bytes) keys.
+#######################################
+
+class Storage(object):
+    """
+    Base class of database storage backends
+    """
+    name = None
+    # True if several processes can open the same database
+    multiprocess_safe = False
+    # True if lookups read from disk: pulls go through a signature filter (see bloom.py)
+    filtered = False
+    # True if the replication position of replicated writes is stored with them (see push_batches)
+    replicable = False
+
+    def __init__(self, logger, db_path, history=None, fsync="interval", snapshot_interval=300, compression_level=0,
+        hot_popularity=0):
+        """
+        fsync: durability of pushes (see wal.FSYNC_POLICIES)
+        snapshot_interval: seconds between background snapshots (0 disables them),
+        for backends written as a whole
+        compression_level: zlib level of the metadata records written (0 disables compression,
+        see compression.py)
+        hot_popularity: records of signatures pushed at least this number of times are
+        written uncompressed (0: every record is compressed)
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync}")
+
+        self.logger = logger
+        self.db_path = db_path
+        self.history = history if history is not None else HistoryPolicy()
+        self.fsync = fsync
+        self.snapshot_interval = snapshot_interval
+        self.compression_level = compression_level
+        self.hot_popularity = hot_popularity
+        # (log id, next record) of the replication log, after the last replicated write
+        self.replicated = None
+
+    def push(self, signature, metadata, pusher=None):
+        """
+        return True on new insertion, else False
+        """
+        raise NotImplementedError()
+
+    def pull(self, signature):
+        """
+        return (metadata, popularity) or None if not found
+        """
+        raise NotImplementedError()
+
+    def push_many(self, entries, pusher=None):
+        """
+        Push a list of (signature, metadata). pusher identifies the client.
+        return a list of flags: True on new insertion, else False
+        """
+        return [self.push(signature, metadata, pusher) for signature, metadata in entries]
+
+    def push_batches(self, batches, now=None, replicated=None):
+        """
+        Push a list of (entries, pusher) as a single write when the backend allows it
+        (one transaction or log commit). now is the push time (default: current time),
+        only kept by backends implementing push_batches.
+        replicated: (log id, position) of the replication record of the first batch, the
+        following batches being the next records (replicas). Replicable backends store
+        the position with the batches, as self.replicated
+        return the list of flags of each batch
+        """
+        return [self.push_many(entries, pusher) for entries, pusher in batches]
+
+    def pull_many(self, signatures):
+        """
+        return a list of (metadata, popularity) or None if not found
+        """
+        return [self.pull(signature) for signature in signatures]
+
+    def delete_many(self, signatures, replicated=None):
+        """
+        replicated: (log id, position) of the replication record of the delete (see push_batches)
+        return a list of flags: True if the signature was deleted, False if not found
+        """
+        raise NotImplementedError()
+
+    def scan(self, after=None, limit=1000):
+        """
+        Page through the database in a stable backend order.
+        return up to limit (signature, metadata, popularity) following signature after
+        (None for the first page)
+        """
+        raise NotImplementedError()
+
+    def count(self):
+        """
+        return the number of signatures
+        """
+        raise NotImplementedError()
+
+    def iter_signatures(self):
+        """
+        Yield every signature, concurrently with updates: signatures stored before
+        the first one is yielded are included
+        """
+        raise NotImplementedError()
+
+    def save(self):
+        return True
+
+    def close(self, save=False):
+        if save:
+            self.save()
+
+    def record_codec(self, dictionary):
+        """
+        return the RecordCodec of records written with dictionary, or None if they are
+        written uncompressed (compression disabled, or no dictionary trained yet)
+        """
+        if not self.compression_level or not dictionary:
+            return None
+        return RecordCodec(self.compression_level, dictionary, self.hot_popularity)
+
+    def train_dictionary(self, records):
+        """
+        return a dictionary trained on records (packed records), or b"" if there are too few
+        """
+        dictionary = train_dictionary(records)
+        if dictionary:
+            self.logger.info(f"trained a {len(dictionary)} bytes compression dictionary on {len(records)} records")
+        return dictionary
+
+
+# Function metadata are stored as packed records:
+# func_name size (u16), func_size (u32), func_name (utf8), serialized_data
+METADATA_HEADER = struct.Struct(">HI")
+
+def pack_metadata(func_name, func_size, serialized_data):
+    func_name = func_name.encode("utf8")
+    return METADATA_HEADER.pack(len(func_name), func_size) + func_name + serialized_data
+
+def unpack_metadata(record):
+    name_size, func_size = METADATA_HEADER.unpack_from(record)
+    offset = METADATA_HEADER.size + name_size
+    return {
+        "func_name"         : record[METADATA_HEADER.size:offset].decode("utf8"),
+        "func_size"         : func_size,
+        "serialized_data"   : record[offset:],
+    }
+
+def digest_metadata(record):
+    return hashlib.blake2b(record, digest_size=16).digest()
+
+class Entry(object):
+    """
+    Database entry of a signature: popularity, metadata variants and the variant returned by pull
+    """
+    __slots__ = ("popularity", "variants", "best", "generation")
+
+    def __init__(self, popularity=0):
+        self.popularity = popularity
+        self.variants = list()
+        self.best = None
+        # snapshot generation of the last update (see MemoryStorage.snapshot)
+        self.generation = 0
+
+    def copy(self):
+        entry = Entry(self.popularity)
+        for variant in self.variants:
+            copy = Variant(variant.record, variant.count, variant.last_seen, variant.pushers, variant.id)
+            entry.variants.append(copy)
+            if variant is self.best:
+                entry.best = copy
+        entry.generation = self.generation
+        return entry
+
+
+# Write-ahead log records start with their type (u8).
+# push batch: time (u32), pusher size (u16), count (u32), pusher (utf8, empty for None)
+# then count times: signature size (u16), record size (u32), signature, packed record
+# delete: count (u32) then count times: signature size (u16), signature
+# replicated: replication log id (8 bytes), position (u64), then a push or delete record
+WAL_PUSH = b"\x00"
+WAL_DELETE = b"\x01"
+WAL_REPLICATED = b"\x02"
+PUSH_HEADER = struct.Struct(">IHI")
+PUSH_ENTRY = struct.Struct(">HI")
+DELETE_HEADER = struct.Struct(">I")
+DELETE_ENTRY = struct.Struct(">H")
+REPLICATED_HEADER = struct.Struct(">8sQ")
+
+def encode_push(now, pusher, entries):
+    pusher = pusher.encode("utf8") if pusher is not None else b""
+    data = [WAL_PUSH, PUSH_HEADER.pack(now, len(pusher), len(entries)), pusher]
+    for signature, record in entries:
+        data += [PUSH_ENTRY.pack(len(signature), len(record)), signature, record]
+    return b"".join(data)
+
+def decode_push(payload):
+    """
+    return (now, pusher, [(signature, record)])
+    """
+    now, pusher_size, count = PUSH_HEADER.unpack_from(payload, 1)
+    offset = 1 + PUSH_HEADER.size + pusher_size
+    pusher = payload[1 + PUSH_HEADER.size:offset].decode("utf8") or None
+
+    entries = list()
+    for _ in range(count):
+        signature_size, record_size = PUSH_ENTRY.unpack_from(payload, offset)
+        offset += PUSH_ENTRY.size
+        signature = payload[offset:offset + signature_size]
+        offset += signature_size
+        entries.append((signature, payload[offset:offset + record_size]))
+        offset += record_size
+    return now, pusher, entries
+
+def encode_delete(signatures):
+    data = [WAL_DELETE, DELETE_HEADER.pack(len(signatures))]
+    for signature in signatures:
+        data += [DELETE_ENTRY.pack(len(signature)), signature]
+    return b"".join(data)
+
+def encode_replicated(log_id, position, payload):
+    return WAL_REPLICATED + REPLICATED_HEADER.pack(bytes.fromhex(log_id), position) + payload
+
+def decode_replicated(payload):
+    """
+    return (log id, position) and the push or delete record
+    """
+    log_id, position = REPLICATED_HEADER.unpack_from(payload, 1)
+    return (log_id.hex(), position), payload[1 + REPLICATED_HEADER.size:]
+
+def pack_replicated(replicated):
+    """
+    return the (log id, position) fields of replicated in file headers (zero if None)
+    """
+    if replicated is None:
+        return bytes(8), 0
+    log_id, position = replicated
+    return bytes.fromhex(log_id), position
+
+def unpack_replicated(log_id, position):
+    return (log_id.hex(), position) if position else None
+
+def decode_delete(payload):
+    """
+    return deleted signatures
+    """
+    count, = DELETE_HEADER.unpack_from(payload, 1)
+    offset = 1 + DELETE_HEADER.size
+
+    signatures = list()
+    for _ in range(count):
+        size, = DELETE_ENTRY.unpack_from(payload, offset)
+        offset += DELETE_ENTRY.size
+        signatures.append(payload[offset:offset + size])
+        offset += size
+    return signatures
+
+
+#######################################
+#
+# Database files
+#
+# Streaming readers and writers of the binary snapshot (memory backend) and json
+# formats, shared by the storage backends and the lumina_db tool.
+#######################################
+
+# header: magic, version (u32), count (u32), last write-ahead log segment included (u64),
+# replication log id (8 bytes) and next record (u64) of replicas (zero otherwise),
+# dictionary size (u32) then the compression dictionary (see compression.py)
+SNAPSHOT_MAGIC = b"LUMINADB"
+SNAPSHOT_VERSION = 5
+SNAPSHOT_HEADER = struct.Struct(">IIQ8sQI")
+# flag of compressed records in variant record sizes
+COMPRESSED_RECORD = 0x80000000
+
+class CompressedRecord(bytes):
+    """
+    Compressed packed record of a snapshot, kept as read (see iter_snapshot_entries)
+    """
+    __slots__ = ()
+
+def read_snapshot_header(db_file):
+    """
+    return (count, wal_segment, replicated, dictionary), or None if db_file is not a binary
+    snapshot (the file position is then restored)
+    """
+    if db_file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        db_file.seek(0, os.SEEK_SET)
+        return None
+
+    version, count, wal_segment, log_id, position, size = SNAPSHOT_HEADER.unpack(db_file.read(SNAPSHOT_HEADER.size))
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported database version {version}")
+    return count, wal_segment, unpack_replicated(log_id, position), db_file.read(size)
+
+def write_snapshot_header(db_file, count, wal_segment=0, dictionary=b"", replicated=None):
+    db_file.write(SNAPSHOT_MAGIC)
+    db_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, count, wal_segment, *pack_replicated(replicated), len(dictionary)))
+    db_file.write(dictionary)
+
+def iter_snapshot_entries(db_file, count=None, codec=None):
+    """
+    Yield (signature, Entry) of a binary snapshot, up to the end of the file if count is None.
+    codec decompresses the records (RecordCodec of the snapshot dictionary), without
+    codec compressed records are yielded as CompressedRecord.
+    """
+    while count is None or count:
+        header = db_file.read(10)
+        if not header and count is None:
+            break
+        size, popularity, nvariants = struct.unpack(">HII", header)
+        signature = db_file.read(size)
+        entry = Entry(popularity)
+
+        for _ in range(nvariants):
+            variant_count, last_seen, npushers, record_size = struct.unpack(">IIBI", db_file.read(13))
+            pushers = tuple(array("I", db_file.read(4 * npushers)))
+            record = db_file.read(record_size & ~COMPRESSED_RECORD)
+            if record_size & COMPRESSED_RECORD:
+                record = codec.decompress(record) if codec is not None else CompressedRecord(record)
+            entry.variants.append(Variant(record, variant_count, last_seen, pushers))
+
+        # best variant is written last
+        entry.best = entry.variants[-1]
+
+        if count is not None:
+            count -= 1
+        yield signature, entry
+
+def encode_entry(signature, entry, history, codec=None):
+    """
+    Serialize an entry, records are compressed by codec (RecordCodec) when given.
+    CompressedRecord records are written as is: they must use the dictionary of codec.
+    """
+    data = [struct.pack(">HII", len(signature), entry.popularity, len(entry.variants)), signature]
+    for variant in history.sorted(entry):
+        record = variant.record
+        size = len(record)
+        if type(record) is CompressedRecord:
+            compressed = record
+        else:
+            compressed = codec.compress(record, entry.popularity) if codec is not None else None
+        if compressed is not None:
+            record = compressed
+            size = len(compressed) | COMPRESSED_RECORD
+        data += [
+            struct.pack(">IIBI", variant.count, variant.last_seen, len(variant.pushers), size),
+            array("I", variant.pushers).tobytes(),
+            record,
+        ]
+    return b"".join(data)
+
+def iter_json(db_file, chunk_size=1 << 20):
+    """
+    Yield (key, value) items of the json object stored in db_file (binary mode),
+    without loading the whole document
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf8")()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill(buffer, pos):
+        data = db_file.read(chunk_size)
+        return buffer[pos:] + utf8.decode(data, final=not data), not data
+
+    while not eof and not buffer.strip():
+        buffer, eof = fill(buffer, 0)
+    buffer = buffer.lstrip()
+    if not buffer.startswith("{"):
+        raise ValueError("json database must be an object")
+    pos = 1
+
+    while True:
+        pos = JSON_SEPARATOR.match(buffer, pos).end()
+        if buffer.startswith("}", pos):
+            return
+
+        try:
+            if pos == len(buffer):
+                raise ValueError("incomplete json item")
+            key, end = decoder.raw_decode(buffer, pos)
+            colon = JSON_COLON.match(buffer, end)
+            if colon is None or colon.end() == len(buffer):
+                raise ValueError("incomplete json item")
+            value, end = decoder.raw_decode(buffer, colon.end())
+        except ValueError:
+            # item truncated by the end of the buffer
+            if eof:
+                raise
+            buffer, eof = fill(buffer, pos)
+            pos = 0
+            continue
+
+        yield key, value
+        pos = end
+
+JSON_SEPARATOR = re.compile(r"[\s,]*")
+JSON_COLON = re.compile(r"\s*:\s*")
+
+def iter_json_entries(db_file, history):
+    """
+    Yield (signature, Entry) of a json database
+    """
+    for signature, db_entry in iter_json(db_file):
+        entry = Entry(db_entry["popularity"])
+
+        for metadata in db_entry["metadata"]:
+            record = pack_metadata(metadata["func_name"], metadata["func_size"], b64decode(metadata["serialized_data"]))
+            if "count" not in metadata:
+                # legacy database: full push history
+                history.add(entry, record)
+                continue
+
+            entry.variants.append(Variant(record, metadata["count"], metadata["last_seen"], tuple(metadata["pushers"])))
+            entry.best = entry.variants[-1]
+
+        yield b64decode(signature), entry
+
+def encode_json_entry(signature, entry, history):
+    # best variant is written last to stay compatible with legacy readers.
+    metadata = list()
+    for variant in history.sorted(entry):
+        variant_metadata = unpack_metadata(variant.record)
+        variant_metadata.update({
+            "serialized_data"   : b64encode(variant_metadata["serialized_data"]).decode("ascii"),
+            "count"             : variant.count,
+            "last_seen"         : variant.last_seen,
+            "pushers"           : variant.pushers,
+        })
+        metadata.append(variant_metadata)
+
+    db_entry = {
+        "metadata": metadata,
+        "popularity" : entry.popularity
+    }
+    return f"{json.dumps(b64encode(signature).decode('ascii'))}: {json.dumps(db_entry)}".encode("utf8")
+
+
+#######################################
+#
+# Sorted index files
+#
+# Immutable database files memory-mapped and searched in place (mmap backend):
+#   header: magic, version (u32), key size (u32), count (u64), last write-ahead log
+#           segment included (u64), offset of the index (u64), replication log id
+#           (8 bytes) and next record (u64) of replicas, dictionary size (u32)
+#   dictionary: compression dictionary of the records (see compression.py)
+#   entries: binary snapshot entries (see encode_entry), sorted by signature
+#   index: count times: signature prefix (key size bytes, zero padded), entry offset (u64)
+#######################################
+
+INDEX_MAGIC = b"LUMINAIX"
+INDEX_VERSION = 3
+INDEX_HEADER = struct.Struct(">8sIIQQQ8sQI")
+INDEX_KEY_SIZE = 16
+INDEX_RECORD = struct.Struct(f">{INDEX_KEY_SIZE}sQ")
+# one index key per INDEX_FENCE records is kept in memory to narrow binary searches
+INDEX_FENCE = 64
+ENTRY_HEADER = struct.Struct(">HII")
+VARIANT_HEADER = struct.Struct(">IIBI")
+
+def index_key(signature):
+    # zero padded or truncated prefix: keys sort like signatures, ties are possible
+    return signature[:INDEX_KEY_SIZE].ljust(INDEX_KEY_SIZE, b"\x00")
+
+class IndexWriter(object):
+    """
+    Write a sorted index file, entries must be added in signature order
+    """
+    def __init__(self, db_file, wal_segment=0, dictionary=b"", replicated=None):
+        """
+        dictionary: compression dictionary of the records of the entries added
+        replicated: replication position of replicas (see Storage.push_batches)
+        """
+        self.db_file = db_file
+        self.wal_segment = wal_segment
+        self.dictionary = dictionary
+        self.replicated = replicated
+        self.count = 0
+        self.last = None
+        # index records are spilled to a temporary file until the entries are written
+        self.records = tempfile.TemporaryFile()
+
+        db_file.write(bytes(INDEX_HEADER.size))
+        db_file.write(dictionary)
+        self.offset = INDEX_HEADER.size + len(dictionary)
+
+    def add(self, signature, data):
+        """
+        Add signature and its serialized entry (encode_entry)
+        """
+        if self.last is not None and signature <= self.last:
+            raise ValueError("index entries must be added in signature order")
+        self.last = signature
+
+        self.records.write(INDEX_RECORD.pack(signature, self.offset))
+        self.db_file.write(data)
+        self.offset += len(data)
+        self.count += 1
+
+    def finish(self):
+        self.records.seek(0, os.SEEK_SET)
+        shutil.copyfileobj(self.records, self.db_file)
+        self.records.close()
+
+        self.db_file.seek(0, os.SEEK_SET)
+        self.db_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, INDEX_KEY_SIZE, self.count, self.wal_segment, self.offset,
+            *pack_replicated(self.replicated), len(self.dictionary)))
+        self.db_file.seek(0, os.SEEK_END)
+
+class SortedIndex(object):
+    """
+    Read-only sorted index file, memory-mapped. Lookups binary search the index and
+    only decode the entries they return, compressed records are decompressed when
+    they are read. An index without path is empty.
+    """
+    def __init__(self, path=None):
+        self.map = None
+        self.count = 0
+        self.wal_segment = 0
+        self.replicated = None
+        self.index_offset = INDEX_HEADER.size
+        self.fences = list()
+        self.dictionary = b""
+        self.codec = None
+        if path is None:
+            return
+
+        with open(path, "rb") as db_file:
+            self.map = mmap.mmap(db_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, key_size, self.count, self.wal_segment, self.index_offset, log_id, position, size = INDEX_HEADER.unpack_from(self.map)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a sorted index file")
+        if version != INDEX_VERSION or key_size != INDEX_KEY_SIZE:
+            raise ValueError(f"unsupported index version {version}")
+        self.replicated = unpack_replicated(log_id, position)
+        self.dictionary = self.map[INDEX_HEADER.size:INDEX_HEADER.size + size]
+        self.codec = RecordCodec(dictionary=self.dictionary)
+        if hasattr(self.map, "madvise"):
+            # lookups touch a few scattered pages: no read-ahead
+            self.map.madvise(mmap.MADV_RANDOM)
+
+        end = self.index_offset + self.count * INDEX_RECORD.size
+        self.fences = [self.map[position:position + INDEX_KEY_SIZE]
+            for position in range(self.index_offset, end, INDEX_FENCE * INDEX_RECORD.size)]
+
+    def record(self, i):
+        """
+        return (key, entry offset) of index record i
+        """
+        return INDEX_RECORD.unpack_from(self.map, self.index_offset + i * INDEX_RECORD.size)
+
+    def signature_at(self, offset):
+        size, = struct.unpack_from(">H", self.map, offset)
+        return self.map[offset + ENTRY_HEADER.size:offset + ENTRY_HEADER.size + size]
+
+    def lower_bound(self, key):
+        """
+        return the first index record whose key is not lower than key
+        """
+        # between the last fence lower than key and the next one
+        fence = bisect.bisect_left(self.fences, key)
+        low, high = max(0, (fence - 1) * INDEX_FENCE + 1), min(fence * INDEX_FENCE, self.count)
+        data, offset, size = self.map, self.index_offset, INDEX_RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            position = offset + middle * size
+            if data[position:position + INDEX_KEY_SIZE] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, signature):
+        """
+        return the offset of the entry of signature, or None if not found
+        """
+        key = index_key(signature)
+        for i in range(self.lower_bound(key), self.count):
+            record_key, offset = self.record(i)
+            if record_key != key:
+                break
+            if self.signature_at(offset) == signature:
+                return offset
+        return None
+
+    def iter_from(self, after=None):
+        """
+        Yield (signature, offset) of entries following signature after, in order
+        """
+        start = self.lower_bound(index_key(after)) if after is not None else 0
+        for i in range(start, self.count):
+            _, offset = self.record(i)
+            signature = self.signature_at(offset)
+            if after is None or signature > after:
+                yield signature, offset
+
+    def iter_raw(self):
+        """
+        Yield (signature, serialized entry) of every entry, in order
+        """
+        for i in range(self.count):
+            _, offset = self.record(i)
+            end = self.record(i + 1)[1] if i + 1 < self.count else self.index_offset
+            yield self.signature_at(offset), self.map[offset:end]
+
+    def read_entry(self, offset):
+        """
+        return the Entry at offset
+        """
+        size, popularity, nvariants = ENTRY_HEADER.unpack_from(self.map, offset)
+        offset += ENTRY_HEADER.size + size
+        entry = Entry(popularity)
+
+        for _ in range(nvariants):
+            count, last_seen, npushers, record_size = VARIANT_HEADER.unpack_from(self.map, offset)
+            offset += VARIANT_HEADER.size
+            pushers = tuple(array("I", self.map[offset:offset + 4 * npushers]))
+            offset += 4 * npushers
+            entry.variants.append(Variant(self.read_record(offset, record_size), count, last_seen, pushers))
+            offset += record_size & ~COMPRESSED_RECORD
+
+        # best variant is written last
+        entry.best = entry.variants[-1]
+        return entry
+
+    def read_best(self, offset):
+        """
+        return (record, popularity) of the best variant of the entry at offset
+        """
+        size, popularity, nvariants = ENTRY_HEADER.unpack_from(self.map, offset)
+        offset += ENTRY_HEADER.size + size
+
+        for i in range(nvariants):
+            _, _, npushers, record_size = VARIANT_HEADER.unpack_from(self.map, offset)
+            offset += VARIANT_HEADER.size + 4 * npushers
+            if i == nvariants - 1:
+                return self.read_record(offset, record_size), popularity
+            offset += record_size & ~COMPRESSED_RECORD
+
+    def read_record(self, offset, record_size):
+        """
+        return the packed record at offset, record_size as in the variant header
+        """
+        record = self.map[offset:offset + (record_size & ~COMPRESSED_RECORD)]
+        if record_size & COMPRESSED_RECORD:
+            return self.codec.decompress(record)
+        return record
+
+
+class Shard(object):
+    """
+    Part of the in-memory index: entries whose signature hash falls in the shard,
+    the lock serializing their updates, entries kept for the snapshot being written
+    and the sorted signatures paged by scan
+    """
+    __slots__ = ("entries", "lock", "shadow", "keys")
+
+    def __init__(self):
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.shadow = dict()
+        # sorted signatures, None once a signature was added or removed (see MemoryStorage.scan)
+        self.keys = None
+
+
+class MemoryStorage(Storage):
+    """
+    In-memory index keyed by raw signatures, loaded from a binary snapshot file at
+    startup. Pushes are appended to a write-ahead log (<db>.wal.<segment>) replayed
+    at load time, and snapshots are written periodically in the background.
+
+    The index is split in shards by signature hash: a push only locks the shards of
+    its signatures, and pulls do not lock at all.
+
+    Compressed records of the snapshot stay compressed in memory and are decompressed
+    when read. The records of a signature are decompressed when it is pushed again.
+
+    A legacy json database opened with this backend is migrated: it is converted at
+    load time and the original file is kept as <db>.bak on first save.
+    """
+    name = "memory"
+    # pushes are journaled between snapshots
+    journaled = True
+    replicable = True
+
+    # entries serialized per lock acquisition while writing a snapshot
+    SNAPSHOT_CHUNK = 1024
+    # number of index shards
+    SHARDS = 64
+
+    def __init__(self, logger, db_path, history=None, **options):
+        super().__init__(logger, db_path, history, **options)
+        self.shards = [Shard() for _ in range(self.SHARDS)]
+        self.migrate = False
+        self.snapshot_lock = threading.Lock()
+        # copy-on-write state of the snapshot being written (see snapshot)
+        self.generation = 0
+        self.snapshot_generation = -1
+        self.dirty = False
+        # last write-ahead log segment included in the database file
+        self.wal_segment = 0
+        self.wal = None
+        # compression dictionary and codec of snapshots (see snapshot_codec), and codec
+        # of the compressed records loaded from the snapshot (same dictionary)
+        self.dictionary = b""
+        self.codec = None
+        self.decoder = None
+        self.load()
+
+        if self.journaled:
+            self.wal = WriteAheadLog(logger, db_path + ".wal", self.fsync)
+            self.replay()
+            self.wal.open(self.wal_segment + 1)
+
+        self.stop_event = threading.Event()
+        self.snapshotter = None
+        if self.snapshot_interval:
+            self.snapshotter = threading.Thread(target=self.snapshot_loop, name="lumina-snapshot", daemon=True)
+            self.snapshotter.start()
+
+    def load(self):
+        if not os.path.exists(self.db_path) or os.stat(self.db_path).st_size == 0:
+            # create new db
+            return
+
+        try:
+            with open(self.db_path, "rb") as db_file:
+                self.read(db_file)
+        except Exception as e:
+            self.logger.exception(e)
+            self.shards = None
+            raise
+
+    def shard_index(self, signature):
+        # stable across runs: scan cursors stay valid after a restart
+        return zlib.crc32(signature) % self.SHARDS
+
+    @contextmanager
+    def locked(self, indexes):
+        """
+        Hold the locks of shards indexes (sorted, locks are always taken in the same order)
+        """
+        with ExitStack() as stack:
+            for index in indexes:
+                stack.enter_context(self.shards[index].lock)
+            yield
+
+    def replay(self):
+        count = 0
+        for payload in self.wal.replay(self.wal_segment):
+            if payload[:1] == WAL_REPLICATED:
+                (log_id, position), payload = decode_replicated(payload)
+                self.replicated = (log_id, position + 1)
+            if payload[:1] == WAL_DELETE:
+                for signature in decode_delete(payload):
+                    self.remove(signature)
+            else:
+                now, pusher, entries = decode_push(payload)
+                for signature, record in entries:
+                    self.apply(signature, record, pusher, now)
+            count += 1
+
+        if count:
+            self.logger.info(f"replayed {count} records from the write-ahead log")
+            self.dirty = True
+
+    def save(self):
+        try:
+            self.logger.info(f"saving database to {self.db_path}")
+            self.snapshot()
+        except Exception as e:
+            self.logger.exception(e)
+            raise
+        return True
+
+    def snapshot(self):
+        """
+        Write the database to a temporary file renamed over the database file.
+        Pushes are not blocked while the file is written: entries are copied before
+        their first update (copy-on-write), so the snapshot holds the database as of
+        its start, which is also where the write-ahead log is rotated.
+        """
+        with self.snapshot_lock:
+            self.codec = self.snapshot_codec()
+            with self.locked(range(self.SHARDS)):
+                wal_segment = self.wal.rotate() if self.wal is not None else 0
+                replicated = self.replicated
+                self.snapshot_generation = self.generation
+                self.generation += 1
+                self.dirty = False
+                signatures = [list(shard.entries) for shard in self.shards]
+
+            try:
+                tmp_path = self.db_path + ".tmp"
+                with open(tmp_path, "wb") as db_file:
+                    self.write(db_file, self.dump_entries(signatures), sum(map(len, signatures)), wal_segment, replicated)
+                    db_file.flush()
+                    os.fsync(db_file.fileno())
+
+                if self.migrate:
+                    self.logger.info(f"legacy database kept as {self.db_path}.bak")
+                    os.replace(self.db_path, self.db_path + ".bak")
+                    self.migrate = False
+                os.replace(tmp_path, self.db_path)
+                fsync_directory(self.db_path)
+            except Exception:
+                self.dirty = True
+                raise
+            finally:
+                with self.locked(range(self.SHARDS)):
+                    self.snapshot_generation = -1
+                    for shard in self.shards:
+                        shard.shadow = dict()
+
+            self.wal_segment = wal_segment
+            if self.wal is not None:
+                self.wal.remove(wal_segment)
+
+    def snapshot_codec(self):
+        """
+        return the RecordCodec of the next snapshot (None if uncompressed), the dictionary
+        is trained by the first snapshot holding enough records
+        """
+        if self.compression_level and not self.dictionary:
+            records = list()
+            for shard in self.shards:
+                with shard.lock:
+                    records += [entry.best.record for entry in itertools.islice(shard.entries.values(), TRAINING_SAMPLES // self.SHARDS)]
+            self.dictionary = self.train_dictionary(records)
+        return self.record_codec(self.dictionary)
+
+    def dump_entries(self, signatures):
+        """
+        Yield serialized entries as of the snapshot start, signatures lists the
+        entries of each shard
+        """
+        for shard, shard_signatures in zip(self.shards, signatures):
+            for i in range(0, len(shard_signatures), self.SNAPSHOT_CHUNK):
+                with shard.lock:
+                    entries = [(signature, shard.shadow.get(signature) or shard.entries[signature])
+                        for signature in shard_signatures[i:i + self.SNAPSHOT_CHUNK]]
+                    if self.codec is None:
+                        chunk = [self.dump_entry(signature, entry) for signature, entry in entries]
+                    else:
+                        # records are compressed outside of the lock, from copies of the entries
+                        entries = [(signature, entry.copy()) for signature, entry in entries]
+                if self.codec is not None:
+                    chunk = [self.dump_entry(signature, entry) for signature, entry in entries]
+                yield from chunk
+
+    def snapshot_loop(self):
+        while not self.stop_event.wait(self.snapshot_interval):
+            if not self.dirty:
+                continue
+            try:
+                self.save()
+            except Exception:
+                # already logged, retried at next interval
+                continue
+
+    def close(self, save=False):
+        self.stop_event.set()
+        if self.snapshotter is not None:
+            self.snapshotter.join()
+
+        super().close(save)
+        if self.wal is not None:
+            # segments are included in the final snapshot
+            self.wal.close(remove=save)
+        self.shards = None
+
+    def insert(self, signature, entry):
+        shard = self.shards[self.shard_index(signature)]
+        shard.entries[signature] = entry
+        shard.keys = None
+
+    def read(self, db_file):
+        header = read_snapshot_header(db_file)
+        if header is None:
+            self.logger.info(f"migrating legacy json database {self.db_path}")
+            self.read_json(db_file)
+            self.migrate = True
+            return
+
+        count, self.wal_segment, self.replicated, self.dictionary = header
+        self.decoder = RecordCodec(dictionary=self.dictionary)
+        for signature, entry in iter_snapshot_entries(db_file, count):
+            self.insert(signature, entry)
+
+    def write(self, db_file, entries, count, wal_segment=0, replicated=None):
+        write_snapshot_header(db_file, count, wal_segment, self.codec.dictionary if self.codec is not None else b"", replicated)
+        for data in entries:
+            db_file.write(data)
+
+    def dump_entry(self, signature, entry):
+        if self.codec is None and any(type(variant.record) is CompressedRecord for variant in entry.variants):
+            # compression disabled since the snapshot was written
+            entry = self.decompress_entry(entry.copy())
+        return encode_entry(signature, entry, self.history, self.codec)
+
+    def unpack_record(self, record):
+        """
+        return the metadata of a record of the index
+        """
+        if type(record) is CompressedRecord:
+            record = self.decoder.decompress(record)
+        return unpack_metadata(record)
+
+    def decompress_entry(self, entry):
+        """
+        Decompress the records of entry in place, return entry
+        """
+        for variant in entry.variants:
+            if type(variant.record) is CompressedRecord:
+                variant.record = self.decoder.decompress(variant.record)
+        return entry
+
+    def read_json(self, db_file):
+        for signature, entry in iter_json_entries(db_file, self.history):
+            self.insert(signature, entry)
+
+    def write_json(self, db_file, entries):
+        # stream entries, the json document is never built in memory.
+        db_file.write(b"{")
+        for i, data in enumerate(entries):
+            db_file.write(b", " if i else b"")
+            db_file.write(data)
+        db_file.write(b"}")
+
+    def dump_json_entry(self, signature, entry):
+        return encode_json_entry(signature, entry, self.history)
+
+    def apply(self, signature, record, pusher, now):
+        """
+        Add a pushed record to the index (called with the signature shard lock held).
+        return True on new insertion, else False
+        """
+        shard = self.shards[self.shard_index(signature)]
+        entry = shard.entries.get(signature, None)
+        new_sig = entry is None
+
+        if new_sig:
+            entry = Entry()
+            shard.entries[signature] = entry
+            shard.keys = None
+        elif entry.generation <= self.snapshot_generation and signature not in shard.shadow:
+            # keep the entry as of the snapshot start for the snapshot writer
+            shard.shadow[signature] = entry.copy()
+
+        entry.generation = self.generation
+        # pushed records are compared to the decompressed ones
+        self.decompress_entry(entry)
+        self.history.add(entry, record, pusher, now)
+        entry.popularity += 1
+
+        return new_sig
+
+    def remove(self, signature):
+        """
+        Delete a signature from the index (called with the signature shard lock held).
+        return True if it was found, else False
+        """
+        shard = self.shards[self.shard_index(signature)]
+        entry = shard.entries.pop(signature, None)
+        if entry is None:
+            return False
+        shard.keys = None
+
+        if entry.generation <= self.snapshot_generation and signature not in shard.shadow:
+            # no copy needed, the entry is not referenced anymore
+            shard.shadow[signature] = entry
+        return True
+
+    def push(self, signature, metadata, pusher=None):
+        return self.push_many([(signature, metadata)], pusher)[0]
+
+    def push_many(self, entries, pusher=None):
+        return self.push_batches([(entries, pusher)])[0]
+
+    def push_batches(self, batches, now=None, replicated=None):
+        now = int(time.time()) if now is None else now
+        results = list()
+        lsn = None
+        for i, (entries, pusher) in enumerate(batches):
+            entries = [(bytes(signature), pack_metadata(metadata["func_name"], metadata["func_size"], metadata["serialized_data"]))
+                for signature, metadata in entries]
+            payload = encode_push(now, pusher, entries)
+            if replicated is not None:
+                log_id, position = replicated
+                payload = encode_replicated(log_id, position + i, payload)
+
+            # the write-ahead log is appended while holding the shard locks: records of a
+            # signature are logged in the order they are applied
+            with self.locked(sorted({self.shard_index(signature) for signature, _ in entries})):
+                results.append([self.apply(signature, record, pusher, now) for signature, record in entries])
+                self.dirty = True
+                if replicated is not None:
+                    self.replicated = (log_id, position + i + 1)
+                if self.wal is not None:
+                    lsn = self.wal.append(payload)
+
+        if lsn is not None:
+            # group commit of every batch, outside of the index lock
+            self.wal.commit(lsn)
+        return results
+
+    def pull(self, signature):
+        # dict lookups are atomic and records are never modified in place: no lock
+        signature = bytes(signature)
+        entry = self.shards[self.shard_index(signature)].entries.get(signature, None)
+
+        if entry:
+            return self.unpack_record(entry.best.record), entry.popularity
+        return None
+
+    def delete_many(self, signatures, replicated=None):
+        signatures = [bytes(signature) for signature in signatures]
+        payload = encode_delete(signatures)
+        if replicated is not None:
+            log_id, position = replicated
+            payload = encode_replicated(log_id, position, payload)
+
+        with self.locked(sorted({self.shard_index(signature) for signature in signatures})):
+            results = [self.remove(signature) for signature in signatures]
+            self.dirty = True
+            if replicated is not None:
+                self.replicated = (log_id, position + 1)
+            if self.wal is not None:
+                lsn = self.wal.append(payload)
+
+        if self.wal is not None:
+            self.wal.commit(lsn)
+        return results
+
+    def scan(self, after=None, limit=1000):
+        # shards in order, signatures in order within a shard. Pages resume by bisect
+        # in the sorted signatures of the shard, sorted again once a signature was added
+        # or removed: a full scan without new signatures sorts each shard once.
+        after = bytes(after) if after is not None else None
+        results = list()
+
+        for index in range(self.shard_index(after) if after is not None else 0, self.SHARDS):
+            shard = self.shards[index]
+            with shard.lock:
+                if shard.keys is None:
+                    shard.keys = sorted(shard.entries)
+                start = bisect.bisect_right(shard.keys, after) if after is not None else 0
+
+                for signature in shard.keys[start:start + limit - len(results)]:
+                    entry = shard.entries[signature]
+                    results.append((signature, self.unpack_record(entry.best.record), entry.popularity))
+
+            if len(results) >= limit:
+                break
+            after = None
+
+        return results
+
+    def count(self):
+        return sum(len(shard.entries) for shard in self.shards)
+
+
+class JsonStorage(MemoryStorage):
+    """
+    Legacy backend: same in-memory index, read from and written to the original
+    json format (base64 encoded signatures and metadata). The format can not tell
+    which pushes a file includes, so pushes are not journaled: they are only saved
+    by snapshots.
+    """
+    name = "json"
+    journaled = False
+    replicable = False
+
+    def read(self, db_file):
+        self.read_json(db_file)
+
+    def write(self, db_file, entries, count, wal_segment=0, replicated=None):
+        self.write_json(db_file, entries)
+
+    def snapshot_codec(self):
+        # the json format is not compressed
+        return None
+
+    def dump_entry(self, signature, entry):
+        return self.dump_json_entry(signature, entry)
+
+
+# overlay value of deleted signatures
+DELETED = object()
+
+class MmapStorage(Storage):
+    """
+    Sorted index file (see SortedIndex) memory-mapped at startup and searched in
+    place: startup time does not depend on the database size, and mapped pages are
+    shared with the page cache.
+
+    Pushes and deletes go to a small in-memory overlay journaled in a write-ahead
+    log (<db>.wal.<segment>). Compactions merge the overlay into a new index file,
+    in the background every --snapshot-interval seconds or once the overlay holds
+    COMPACT_SIZE signatures.
+
+    A memory (binary snapshot) or json database opened with this backend is
+    converted at load time, the original file is kept as <db>.bak.
+    """
+    name = "mmap"
+    filtered = True
+    replicable = True
+
+    # overlay size triggering a compaction
+    COMPACT_SIZE = 100000
+
+    def __init__(self, logger, db_path, history=None, **options):
+        super().__init__(logger, db_path, history, **options)
+        # serializes overlay updates and write-ahead log appends
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        # signature -> Entry updated since the last compaction, or DELETED
+        self.overlay = dict()
+        # (overlay being compacted, index): replaced at once, read after the overlay (see pull)
+        self.state = (dict(), SortedIndex())
+        self.migrate = False
+        self.dirty = False
+        # last write-ahead log segment included in the database file
+        self.wal_segment = 0
+        self.load()
+        self.size = self.state[1].count + len(self.overlay)
+
+        self.wal = WriteAheadLog(logger, db_path + ".wal", self.fsync)
+        self.replay()
+        self.wal.open(self.wal_segment + 1)
+        if self.migrate:
+            self.save()
+
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.compactor = threading.Thread(target=self.compact_loop, name="lumina-compact", daemon=True)
+        self.compactor.start()
+
+    def load(self):
+        if not os.path.exists(self.db_path) or os.stat(self.db_path).st_size == 0:
+            # create new db
+            return
+
+        with open(self.db_path, "rb") as db_file:
+            magic = db_file.read(len(INDEX_MAGIC))
+            if magic == INDEX_MAGIC:
+                index = SortedIndex(self.db_path)
+                self.state = (dict(), index)
+                self.wal_segment = index.wal_segment
+                self.replicated = index.replicated
+                return
+            if magic + db_file.read(8) == b"SQLite format 3\x00":
+                raise ValueError(f"{self.db_path} is a sqlite database, use lumina_db convert")
+
+            # other formats are loaded in the overlay and written by a first compaction
+            self.logger.info(f"converting database {self.db_path} to a sorted index")
+            db_file.seek(0, os.SEEK_SET)
+            header = read_snapshot_header(db_file)
+            if header is None:
+                entries = iter_json_entries(db_file, self.history)
+            else:
+                count, self.wal_segment, self.replicated, dictionary = header
+                entries = iter_snapshot_entries(db_file, count, RecordCodec(dictionary=dictionary))
+
+            for signature, entry in entries:
+                self.overlay[signature] = entry
+            self.migrate = True
+
+    def replay(self):
+        count = 0
+        for payload in self.wal.replay(self.wal_segment):
+            if payload[:1] == WAL_REPLICATED:
+                (log_id, position), payload = decode_replicated(payload)
+                self.replicated = (log_id, position + 1)
+            if payload[:1] == WAL_DELETE:
+                for signature in decode_delete(payload):
+                    self.remove(signature)
+            else:
+                now, pusher, entries = decode_push(payload)
+                for signature, record in entries:
+                    self.apply(signature, record, pusher, now)
+            count += 1
+
+        if count:
+            self.logger.info(f"replayed {count} records from the write-ahead log")
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty and not self.migrate:
+            return True
+        try:
+            self.logger.info(f"saving database to {self.db_path}")
+            self.compact()
+        except Exception as e:
+            self.logger.exception(e)
+            raise
+        return True
+
+    def compact(self):
+        """
+        Write the index merged with the overlay to a temporary file renamed over the
+        database file. The overlay is frozen at the start of the compaction, updates
+        go to a new overlay (entries are copied on their first update).
+        """
+        with self.compact_lock:
+            with self.lock:
+                wal_segment = self.wal.rotate()
+                replicated = self.replicated
+                frozen = self.overlay
+                _, index = self.state
+                self.state = (frozen, index)
+                self.overlay = dict()
+                self.dirty = False
+
+            try:
+                # entries copied from the index keep their records: so does its dictionary
+                dictionary = index.dictionary
+                if self.compression_level and not dictionary:
+                    dictionary = self.train_dictionary(self.sample_records(index, frozen))
+                codec = self.record_codec(dictionary)
+
+                tmp_path = self.db_path + ".tmp"
+                with open(tmp_path, "wb") as db_file:
+                    writer = IndexWriter(db_file, wal_segment, dictionary, replicated)
+                    for signature, data in self.merge_entries(index, frozen, codec):
+                        writer.add(signature, data)
+                    writer.finish()
+                    db_file.flush()
+                    os.fsync(db_file.fileno())
+
+                if self.migrate:
+                    self.logger.info(f"original database kept as {self.db_path}.bak")
+                    os.replace(self.db_path, self.db_path + ".bak")
+                    self.migrate = False
+                os.replace(tmp_path, self.db_path)
+                fsync_directory(self.db_path)
+                compacted = SortedIndex(self.db_path)
+            except Exception:
+                with self.lock:
+                    # updates of the frozen overlay are merged back, newer ones kept
+                    for signature, entry in frozen.items():
+                        self.overlay.setdefault(signature, entry)
+                    self.state = (dict(), index)
+                    self.dirty = True
+                raise
+
+            with self.lock:
+                # the previous index is unmapped once no pull uses it anymore
+                self.state = (dict(), compacted)
+
+            self.wal_segment = wal_segment
+            self.wal.remove(wal_segment)
+
+    def sample_records(self, index, frozen):
+        """
+        return up to TRAINING_SAMPLES records of the frozen overlay and the index
+        """
+        records = [entry.best.record for entry in itertools.islice(frozen.values(), 2 * TRAINING_SAMPLES)
+            if entry is not DELETED][:TRAINING_SAMPLES]
+        for _, offset in itertools.islice(index.iter_from(), TRAINING_SAMPLES - len(records)):
+            records.append(index.read_best(offset)[0])
+        return records
+
+    def merge_entries(self, index, frozen, codec=None):
+        """
+        Yield (signature, serialized entry) of index updated by the frozen overlay, in order.
+        Entries that were not updated are copied without being decoded, updated entries
+        are compressed by codec.
+        """
+        updates = iter(sorted(frozen.items(), key=lambda item: item[0]))
+        update = next(updates, None)
+
+        for signature, data in index.iter_raw():
+            while update is not None and update[0] <= signature:
+                update_signature, entry = update
+                if entry is not DELETED:
+                    yield update_signature, encode_entry(update_signature, entry, self.history, codec)
+                update = next(updates, None)
+                if update_signature == signature:
+                    break
+            else:
+                yield signature, data
+
+        while update is not None:
+            update_signature, entry = update
+            if entry is not DELETED:
+                yield update_signature, encode_entry(update_signature, entry, self.history, codec)
+            update = next(updates, None)
+
+    def compact_loop(self):
+        while not self.stop_event.is_set():
+            self.wake_event.wait(self.snapshot_interval or None)
+            self.wake_event.clear()
+            if self.stop_event.is_set() or not self.dirty:
+                continue
+            try:
+                self.save()
+            except Exception:
+                # already logged, retried at next interval
+                continue
+
+    def close(self, save=False):
+        self.stop_event.set()
+        self.wake_event.set()
+        self.compactor.join()
+
+        super().close(save)
+        # segments are included in the final compaction
+        self.wal.close(remove=save and not self.dirty)
+        self.overlay = None
+        self.state = None
+
+    def stored(self, signature):
+        """
+        return a copy of the Entry of signature as of the last compaction, or None
+        """
+        frozen, index = self.state
+        entry = frozen.get(signature)
+        if entry is not None:
+            return entry.copy() if entry is not DELETED else None
+
+        offset = index.find(signature)
+        return index.read_entry(offset) if offset is not None else None
+
+    def apply(self, signature, record, pusher, now):
+        """
+        Add a pushed record to the overlay (called with lock held).
+        return True on new insertion, else False
+        """
+        entry = self.overlay.get(signature)
+        if entry is None:
+            # first update since the last compaction
+            entry = self.stored(signature)
+
+        new_sig = entry is None or entry is DELETED
+        if new_sig:
+            entry = Entry()
+            self.size += 1
+
+        self.history.add(entry, record, pusher, now)
+        entry.popularity += 1
+        self.overlay[signature] = entry
+
+        return new_sig
+
+    def remove(self, signature):
+        """
+        Delete a signature (called with lock held).
+        return True if it was found, else False
+        """
+        entry = self.overlay.get(signature)
+        if entry is None:
+            entry = self.stored(signature)
+        if entry is None or entry is DELETED:
+            return False
+
+        self.overlay[signature] = DELETED
+        self.size -= 1
+        return True
+
+    def push(self, signature, metadata, pusher=None):
+        return self.push_many([(signature, metadata)], pusher)[0]
+
+    def push_many(self, entries, pusher=None):
+        return self.push_batches([(entries, pusher)])[0]
+
+    def push_batches(self, batches, now=None, replicated=None):
+        now = int(time.time()) if now is None else now
+        batches = [([(bytes(signature), pack_metadata(metadata["func_name"], metadata["func_size"], metadata["serialized_data"]))
+            for signature, metadata in entries], pusher) for entries, pusher in batches]
+
+        with self.lock:
+            results = list()
+            for i, (entries, pusher) in enumerate(batches):
+                results.append([self.apply(signature, record, pusher, now) for signature, record in entries])
+                payload = encode_push(now, pusher, entries)
+                if replicated is not None:
+                    log_id, position = replicated
+                    payload = encode_replicated(log_id, position + i, payload)
+                    self.replicated = (log_id, position + i + 1)
+                lsn = self.wal.append(payload)
+            self.dirty = True
+            overlay_size = len(self.overlay)
+
+        # group commit, outside of the lock
+        if batches:
+            self.wal.commit(lsn)
+        if overlay_size >= self.COMPACT_SIZE:
+            self.wake_event.set()
+        return results
+
+    def pull(self, signature):
+        # no lock: the overlay is read before the index, and replaced after it (see compact)
+        signature = bytes(signature)
+        entry = self.overlay.get(signature)
+        if entry is None:
+            frozen, index = self.state
+            entry = frozen.get(signature)
+            if entry is None:
+                offset = index.find(signature)
+                if offset is None:
+                    return None
+                record, popularity = index.read_best(offset)
+                return unpack_metadata(record), popularity
+
+        if entry is DELETED:
+            return None
+        return unpack_metadata(entry.best.record), entry.popularity
+
+    def delete_many(self, signatures, replicated=None):
+        signatures = [bytes(signature) for signature in signatures]
+
+        with self.lock:
+            results = [self.remove(signature) for signature in signatures]
+            self.dirty = True
+            payload = encode_delete(signatures)
+            if replicated is not None:
+                log_id, position = replicated
+                payload = encode_replicated(log_id, position, payload)
+                self.replicated = (log_id, position + 1)
+            lsn = self.wal.append(payload)
+
+        self.wal.commit(lsn)
+        return results
+
+    def scan(self, after=None, limit=1000):
+        after = bytes(after) if after is not None else None
+        results = list()
+
+        with self.lock:
+            frozen, index = self.state
+            updates = sorted({signature for signature in frozen.keys() | self.overlay.keys()
+                if after is None or signature > after})
+            entries = index.iter_from(after)
+            signature, offset = next(entries, (None, None))
+
+            for update in updates:
+                # index entries before the next updated signature
+                while signature is not None and signature < update and len(results) < limit:
+                    record, popularity = index.read_best(offset)
+                    results.append((signature, unpack_metadata(record), popularity))
+                    signature, offset = next(entries, (None, None))
+                if len(results) >= limit:
+                    break
+
+                if signature == update:
+                    signature, offset = next(entries, (None, None))
+                entry = self.overlay.get(update) or frozen[update]
+                if entry is not DELETED:
+                    results.append((update, unpack_metadata(entry.best.record), entry.popularity))
+
+            while signature is not None and len(results) < limit:
+                record, popularity = index.read_best(offset)
+                results.append((signature, unpack_metadata(record), popularity))
+                signature, offset = next(entries, (None, None))
+
+        return results[:limit]
+
+    def count(self):
+        return self.size
+
+    def iter_signatures(self):
+        with self.lock:
+            frozen, index = self.state
+            updates = [signature for overlay in (frozen, self.overlay)
+                for signature, entry in overlay.items() if entry is not DELETED]
+
+        yield from updates
+        # the index is immutable, compactions replace it
+        for signature, _ in index.iter_from():
+            yield signature
+
+
+class SqliteStorage(Storage):
+    """
+    SQLite backend (WAL mode). Each push is committed as it happens and lookups go
+    through the signature index, so opening does not depend on the database size.
+
+    With compression, serialized_data of new variants is compressed with the last
+    dictionary of the database, trained when the database is opened or once enough
+    variants were written uncompressed, and decompressed when a query returns it.
+
+    Connections are pooled: concurrent pulls run in parallel, pushes are serialized
+    by the SQLite write lock.
+
+    The signature count is kept up to date by the pushes and deletes of this process,
+    and counted again at most every COUNT_INTERVAL seconds for those of other processes
+    sharing the database.
+    """
+    name = "sqlite"
+    multiprocess_safe = True
+    filtered = True
+    replicable = True
+    # maximum number of keys bound in a single "IN (...)" query
+    MAX_VARIABLES = 500
+    # seconds a counted number of signatures is kept up to date without counting again
+    COUNT_INTERVAL = 60
+
+    SCHEMA_VERSION = 3
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS signatures (
+            signature BLOB PRIMARY KEY,
+            popularity INTEGER NOT NULL,
+            best INTEGER
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS variants (
+            id INTEGER PRIMARY KEY,
+            signature BLOB NOT NULL,
+            digest BLOB NOT NULL,
+            func_name TEXT NOT NULL,
+            func_size INTEGER NOT NULL,
+            serialized_data BLOB NOT NULL,
+            count INTEGER NOT NULL,
+            last_seen INTEGER NOT NULL,
+            pushers BLOB NOT NULL,
+            dictionary INTEGER -- compression dictionary id of serialized_data, NULL if not compressed
+        );
+
+        CREATE UNIQUE INDEX IF NOT EXISTS variants_signature ON variants(signature, digest);
+
+        CREATE TABLE IF NOT EXISTS dictionaries (
+            id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+
+        -- replicas: replication log id and next record, updated with the records applied
+        CREATE TABLE IF NOT EXISTS replication (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            log_id TEXT NOT NULL,
+            position INTEGER NOT NULL
+        );
+    """
+
+    # commits are synced to disk: on each commit, at WAL checkpoints, or left to the OS
+    SYNCHRONOUS = {
+        "always"    : "FULL",
+        "interval"  : "NORMAL",
+        "never"     : "OFF",
+    }
+
+    def __init__(self, logger, db_path, history=None, **options):
+        super().__init__(logger, db_path, history, **options)
+        # idle connections
+        self.pool = queue.SimpleQueue()
+        # RecordCodec of each dictionary id, and dictionary id and codec of new variants
+        self.codecs = dict()
+        self.dictionary = None
+        self.codec = None
+        # variants written uncompressed, and the thread training a dictionary (see train)
+        self.train_lock = threading.Lock()
+        self.untrained = 0
+        self.trainer = None
+        # signature count (None until counted) and when it was counted, changed along
+        # with the commits of this process under count_lock. While a count runs, the
+        # signatures added by commits are also summed in counting (None otherwise)
+        self.count_lock = threading.Lock()
+        self.signature_count = None
+        self.counted_at = 0
+        self.counting = None
+
+        with self.connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+                self.upgrade(conn)
+
+            row = conn.execute("SELECT id, data FROM dictionaries ORDER BY id DESC LIMIT 1").fetchone() \
+                if self.compression_level else None
+            if row is not None:
+                self.dictionary, dictionary = row
+                self.codec = self.record_codec(dictionary)
+            self.replicated = conn.execute("SELECT log_id, position FROM replication").fetchone()
+
+        # uncompressed variants written while there is no dictionary: one is trained
+        # when the database is opened, or once TRAINING_SAMPLES of them are written
+        self.untrained = TRAINING_SAMPLES if self.compression_level and self.codec is None else 0
+        self.train()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool (a new one is opened if none is idle)
+        """
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            # used by one thread at a time, but not always the same
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS[self.fsync]}")
+
+        try:
+            yield conn
+        finally:
+            self.pool.put(conn)
+
+    def upgrade(self, conn):
+        # new databases, and version 2 databases lacking the replication table
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 2 and conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchone():
+            raise ValueError(f"unsupported sqlite database version {version}")
+        conn.executescript(self.SCHEMA)
+        conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def commit(self, conn, added=0, replicated=None):
+        """
+        Commit the transaction of conn, which added signatures (removed if negative), along
+        with the replication position of replicated writes
+        """
+        if replicated is not None:
+            conn.execute("INSERT OR REPLACE INTO replication (id, log_id, position) VALUES (0, ?, ?)", replicated)
+        with self.count_lock:
+            conn.commit()
+            if self.signature_count is not None:
+                self.signature_count += added
+            if self.counting is not None:
+                self.counting += added
+        if replicated is not None:
+            self.replicated = replicated
+
+    def close(self, save=False):
+        with self.train_lock:
+            trainer = self.trainer
+        if trainer is not None:
+            trainer.join()
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+    def train(self, background=True):
+        """
+        Train and store a dictionary if compression is enabled and enough uncompressed
+        variants were written without one. Training takes seconds: it runs on a
+        background thread unless background is False
+        """
+        with self.train_lock:
+            if not self.compression_level or self.codec is not None or self.untrained < TRAINING_SAMPLES:
+                return
+            if self.trainer is not None and self.trainer.is_alive():
+                return
+            self.untrained = 0
+            if background:
+                self.trainer = threading.Thread(target=self.train_loaded, name="lumina-train", daemon=True)
+                self.trainer.start()
+                return
+        self.train_loaded()
+
+    def train_loaded(self):
+        """
+        Train and store a dictionary on the uncompressed variants of the database
+        """
+        with self.connection() as conn:
+            records = [pack_metadata(func_name, func_size, serialized_data) for func_name, func_size, serialized_data
+                in conn.execute("SELECT func_name, func_size, serialized_data FROM variants WHERE dictionary IS NULL LIMIT ?",
+                    (TRAINING_SAMPLES,))]
+        dictionary = self.train_dictionary(records)
+        if dictionary:
+            self.add_dictionary(dictionary)
+
+    def add_dictionary(self, dictionary):
+        """
+        Store a compression dictionary, used by the variants written from now on
+        """
+        with self.connection() as conn, conn:
+            self.dictionary = conn.execute("INSERT INTO dictionaries (data) VALUES (?)", (dictionary,)).lastrowid
+        self.codec = self.record_codec(dictionary)
+
+    def compress(self, serialized_data, popularity):
+        """
+        return (serialized_data as stored, its dictionary id or None if not compressed)
+        """
+        serialized_data = bytes(serialized_data)
+        compressed = self.codec.compress(serialized_data, popularity) if self.codec is not None else None
+        if compressed is None:
+            return serialized_data, None
+        return compressed, self.dictionary
+
+    def decompress(self, serialized_data, dictionary):
+        """
+        return serialized_data as stored with dictionary (id, None if not compressed)
+        """
+        if dictionary is None:
+            return serialized_data
+
+        codec = self.codecs.get(dictionary)
+        if codec is None:
+            with self.connection() as conn:
+                data, = conn.execute("SELECT data FROM dictionaries WHERE id = ?", (dictionary,)).fetchone()
+            codec = self.codecs[dictionary] = RecordCodec(dictionary=data)
+        return codec.decompress(serialized_data)
+
+    def push(self, signature, metadata, pusher=None):
+        return self.push_many([(signature, metadata)], pusher)[0]
+
+    def pull(self, signature):
+        return self.pull_many([signature])[0]
+
+    def select_many(self, conn, query, keys):
+        """
+        Run a "... IN (?, ?, ...)" query for every chunk of keys and yield rows
+        """
+        for i in range(0, len(keys), self.MAX_VARIABLES):
+            chunk = keys[i:i+self.MAX_VARIABLES]
+            yield from conn.execute(query.format(",".join("?" * len(chunk))), chunk)
+
+    def read_entries(self, conn, signatures):
+        """
+        return {signature: Entry} of existing signatures, variants hold the metadata digest
+        """
+        entries = dict()
+        best = dict()
+        for signature, popularity, best_id in self.select_many(conn,
+            "SELECT signature, popularity, best FROM signatures WHERE signature IN ({})", signatures):
+            entries[signature] = Entry(popularity)
+            best[signature] = best_id
+
+        for id, signature, digest, count, last_seen, pushers in self.select_many(conn,
+            "SELECT id, signature, digest, count, last_seen, pushers FROM variants WHERE signature IN ({})", list(entries)):
+            variant = Variant(digest, count, last_seen, tuple(array("I", pushers)), id)
+            entries[signature].variants.append(variant)
+            if id == best[signature]:
+                entries[signature].best = variant
+
+        return entries
+
+    def write_entries(self, conn, entries, update_popularity=True):
+        """
+        Write back {signature: (Entry, {new variant: metadata})}
+        """
+        untrained = 0
+        for signature, (entry, created) in entries.items():
+            for variant, metadata in created.items():
+                serialized_data, dictionary = self.compress(metadata["serialized_data"], entry.popularity)
+                if dictionary is None:
+                    untrained += 1
+                variant.id = conn.execute("INSERT INTO variants (signature, digest, func_name, func_size, serialized_data, count, last_seen, pushers, dictionary) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (signature, variant.record, metadata["func_name"], metadata["func_size"], serialized_data,
+                        variant.count, variant.last_seen, array("I", variant.pushers).tobytes(), dictionary)).lastrowid
+
+            conn.executemany("UPDATE variants SET count = ?, last_seen = ?, pushers = ? WHERE id = ?",
+                ((variant.count, variant.last_seen, array("I", variant.pushers).tobytes(), variant.id)
+                    for variant in entry.variants if variant not in created))
+
+            # drop evicted variants
+            conn.execute(f"DELETE FROM variants WHERE signature = ? AND id NOT IN ({','.join('?' * len(entry.variants))})",
+                [signature] + [variant.id for variant in entry.variants])
+
+            if update_popularity:
+                conn.execute("INSERT INTO signatures (signature, popularity, best) VALUES (?, ?, ?) "
+                    "ON CONFLICT(signature) DO UPDATE SET popularity = excluded.popularity, best = excluded.best",
+                    (signature, entry.popularity, entry.best.id))
+            else:
+                conn.execute("UPDATE signatures SET best = ? WHERE signature = ?", (entry.best.id, signature))
+
+        if untrained:
+            with self.train_lock:
+                self.untrained += untrained
+
+    def push_many(self, entries, pusher=None):
+        return self.push_batches([(entries, pusher)])[0]
+
+    def push_batches(self, batches, now=None, replicated=None):
+        now = int(time.time()) if now is None else now
+        batches = [([bytes(signature) for signature, _ in entries], entries, pusher) for entries, pusher in batches]
+
+        with self.connection() as conn, conn:
+            # take the write lock before reading, entries are updated from what is read
+            conn.execute("BEGIN IMMEDIATE")
+            db_entries = {signature: (entry, dict()) for signature, entry in
+                self.read_entries(conn, list({signature for signatures, _, _ in batches for signature in signatures})).items()}
+
+            results = list()
+            for signatures, entries, pusher in batches:
+                flags = list()
+                for signature, (_, metadata) in zip(signatures, entries):
+                    flags.append(signature not in db_entries)
+                    if signature not in db_entries:
+                        db_entries[signature] = (Entry(), dict())
+
+                    entry, created = db_entries[signature]
+                    record = pack_metadata(metadata["func_name"], metadata["func_size"], metadata["serialized_data"])
+                    variant, new, evicted = self.history.add(entry, digest_metadata(record), pusher, now)
+                    entry.popularity += 1
+
+                    if new:
+                        created[variant] = metadata
+                    created.pop(evicted, None)
+                results.append(flags)
+
+            self.write_entries(conn, db_entries)
+            if replicated is not None:
+                log_id, position = replicated
+                replicated = (log_id, position + len(batches))
+            self.commit(conn, sum(flags.count(True) for flags in results), replicated)
+
+        self.train()
+        return results
+
+    def delete_many(self, signatures, replicated=None):
+        signatures = [bytes(signature) for signature in signatures]
+
+        with self.connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            found = {signature for signature, in self.select_many(conn,
+                "SELECT signature FROM signatures WHERE signature IN ({})", list(set(signatures)))}
+
+            for i in range(0, len(signatures), self.MAX_VARIABLES):
+                chunk = signatures[i:i+self.MAX_VARIABLES]
+                marks = ",".join("?" * len(chunk))
+                conn.execute(f"DELETE FROM variants WHERE signature IN ({marks})", chunk)
+                conn.execute(f"DELETE FROM signatures WHERE signature IN ({marks})", chunk)
+            if replicated is not None:
+                log_id, position = replicated
+                replicated = (log_id, position + 1)
+            self.commit(conn, -len(found), replicated)
+
+        # flag only the first occurrence of a signature listed twice
+        results = list()
+        for signature in signatures:
+            results.append(signature in found)
+            found.discard(signature)
+        return results
+
+    def scan(self, after=None, limit=1000):
+        query = ("SELECT s.signature, s.popularity, v.func_name, v.func_size, v.serialized_data, v.dictionary "
+            "FROM signatures s JOIN variants v ON v.id = s.best {} ORDER BY s.signature LIMIT ?")
+
+        with self.connection() as conn:
+            if after is None:
+                rows = conn.execute(query.format(""), (limit,)).fetchall()
+            else:
+                rows = conn.execute(query.format("WHERE s.signature > ?"), (bytes(after), limit)).fetchall()
+
+        return [(signature, dict(func_name = func_name, func_size = func_size, serialized_data = self.decompress(serialized_data, dictionary)),
+            popularity) for signature, popularity, func_name, func_size, serialized_data, dictionary in rows]
+
+    def count(self):
+        # the table is counted outside of count_lock: commits are not blocked by the
+        # scan, their additions while it runs are added to its result. A commit made
+        # just before the scan starts may be counted twice, until the next count.
+        with self.count_lock:
+            fresh = self.signature_count is not None and time.monotonic() - self.counted_at <= self.COUNT_INTERVAL
+            if fresh or (self.counting is not None and self.signature_count is not None):
+                # counted again by another thread
+                return self.signature_count
+            owner = self.counting is None
+            if owner:
+                self.counting = 0
+
+        try:
+            with self.connection() as conn:
+                count = conn.execute("SELECT COUNT(*) FROM signatures").fetchone()[0]
+        except Exception:
+            if owner:
+                with self.count_lock:
+                    self.counting = None
+            raise
+
+        if not owner:
+            # first count, already run by another thread
+            return count
+        with self.count_lock:
+            self.signature_count = count + self.counting
+            self.counted_at = time.monotonic()
+            self.counting = None
+            return self.signature_count
+
+    def iter_signatures(self):
+        # a single read transaction: pushes committed meanwhile are not listed
+        with self.connection() as conn:
+            for signature, in conn.execute("SELECT signature FROM signatures"):
+                yield signature
+
+    def iter_entries(self):
+        """
+        Yield (signature, Entry) of the whole database in signature order, variants hold packed records
+        """
+        with self.connection() as conn:
+            rows = conn.execute("SELECT s.signature, s.popularity, s.best, v.id, v.func_name, v.func_size, v.serialized_data, "
+                "v.dictionary, v.count, v.last_seen, v.pushers FROM signatures s JOIN variants v ON v.signature = s.signature ORDER BY s.signature")
+
+            signature = entry = None
+            for row_signature, popularity, best, id, func_name, func_size, serialized_data, dictionary, count, last_seen, pushers in rows:
+                if row_signature != signature:
+                    if entry is not None:
+                        yield signature, entry
+                    signature, entry = row_signature, Entry(popularity)
+
+                serialized_data = self.decompress(serialized_data, dictionary)
+                variant = Variant(pack_metadata(func_name, func_size, serialized_data), count, last_seen, tuple(array("I", pushers)))
+                entry.variants.append(variant)
+                if id == best:
+                    entry.best = variant
+
+            if entry is not None:
+                yield signature, entry
+
+    def import_entries(self, entries, batch_size=10000):
+        """
+        Insert (signature, Entry) of signatures not in the database, variants hold packed records
+        """
+        with self.connection() as conn:
+            batch = dict()
+            for signature, entry in entries:
+                db_entry = Entry(entry.popularity)
+                created = dict()
+                for variant in entry.variants:
+                    db_variant = Variant(digest_metadata(variant.record), variant.count, variant.last_seen, variant.pushers)
+                    db_entry.variants.append(db_variant)
+                    created[db_variant] = unpack_metadata(variant.record)
+                    if variant is entry.best:
+                        db_entry.best = db_variant
+                batch[signature] = (db_entry, created)
+
+                if len(batch) >= batch_size:
+                    with conn:
+                        self.write_entries(conn, batch)
+                    batch = dict()
+                    # offline: the next batches are compressed with the dictionary
+                    self.train(background=False)
+
+            with conn:
+                self.write_entries(conn, batch)
+
+        # counted again on the next call
+        with self.count_lock:
+            self.signature_count = None
+
+    def pull_many(self, signatures):
+        signatures = [bytes(signature) for signature in signatures]
+
+        with self.connection() as conn:
+            rows = self.select_many(conn,
+                "SELECT s.signature, s.popularity, v.func_name, v.func_size, v.serialized_data, v.dictionary "
+                "FROM signatures s JOIN variants v ON v.id = s.best WHERE s.signature IN ({})", list(set(signatures)))
+
+            results = dict()
+            for signature, popularity, func_name, func_size, serialized_data, dictionary in rows:
+                metadata = {
+                    "func_name"         : func_name,
+                    "func_size"         : func_size,
+                    "serialized_data"   : self.decompress(serialized_data, dictionary),
+                }
+                results[signature] = (metadata, popularity)
+
+        return [results.get(signature) for signature in signatures]
+
+
+STORAGE_BACKENDS = {
+    MemoryStorage.name : MemoryStorage,
+    JsonStorage.name : JsonStorage,
+    MmapStorage.name : MmapStorage,
+    SqliteStorage.name : SqliteStorage,
+}
+
+def guess_backend(db_path):
+    """
+    Return backend name matching an existing database file, or the default one for a new file
+    """
+    if os.path.exists(db_path) and os.stat(db_path).st_size != 0:
+        with open(db_path, "rb") as db_file:
+            header = db_file.read(16)
+        if header.startswith(SNAPSHOT_MAGIC):
+            return MemoryStorage.name
+        if header.startswith(INDEX_MAGIC):
+            return MmapStorage.name
+        return SqliteStorage.name if header == b"SQLite format 3\x00" else JsonStorage.name
+
+    return JsonStorage.name if db_path.endswith(".json") else SqliteStorage.name
+
+def serving_backend(db_path):
+    """
+    Return the backend serving db_path by default: the backend of its format, except
+    for json databases, migrated to the memory backend (json pushes are not journaled)
+    """
+    backend = guess_backend(db_path)
+    return MemoryStorage.name if backend == JsonStorage.name else backend
+
+def open_storage(logger, db_path, backend="auto", history=None, **options):
+    if backend == "auto":
+        backend = serving_backend(db_path)
+
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend {backend}")
+
+    return STORAGE_BACKENDS[backend](logger, db_path, history, **options)
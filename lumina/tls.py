@@ -0,0 +1,65 @@
+import ssl
+
+def create_ssl_context(certfile, keyfile):
+    """
+    Build the server side TLS context (IDA clients speak TLS 1.2)
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # server side session cache and session tickets let clients resume their sessions
+    # (abbreviated handshake) as long as the same context is used for every connection
+    context.options &= ~ssl.OP_NO_TICKET
+    # ECDHE key exchanges only (X25519 or P-256 cost a fraction of finite field DHE),
+    # and no client initiated renegotiation (a handshake per request)
+    context.set_ciphers("ECDHE+AESGCM:ECDHE+CHACHA20:ECDHE+AES")
+    context.options |= ssl.OP_NO_RENEGOTIATION
+    return context
+
+class ServerTLS(object):
+    """
+    Server TLS context, reloaded from the certificate files on SIGHUP.
+    Connections are accepted with the first context: its SNI callback (called even
+    when clients send no server name) switches them to the last loaded context. Its
+    session cache and ticket keys are kept, so sessions are resumed across reloads.
+    """
+    def __init__(self, logger, certfile, keyfile):
+        self.logger = logger
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.context = create_ssl_context(certfile, keyfile)
+        self.context.sni_callback = self.select_context
+        self.current = self.context
+
+    def select_context(self, ssl_object, server_name, context):
+        if self.current is not context:
+            ssl_object.context = self.current
+
+    def reload(self):
+        """
+        Load the certificate and key again, the current ones are kept if they fail to load.
+        return True on success
+        """
+        try:
+            self.current = create_ssl_context(self.certfile, self.keyfile)
+        except OSError as e:
+            self.logger.error(f"TLS certificate reload failed, the current certificate is kept: {e}")
+            return False
+        self.logger.info(f"TLS certificate reloaded from {self.certfile}")
+        return True
+
+def create_client_context(cafile=None):
+    """
+    Build the TLS context of connections to upstream servers. Their certificate is
+    checked against cafile, or not checked at all without one (self-signed certificates)
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile is None:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        context.load_verify_locations(cafile)
+        # certificates of Lumina servers rarely match their address
+        context.check_hostname = False
+    return context
@@ -0,0 +1,199 @@
+import time, socket, threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from lumina.lumina_structs import RpcReader, rpc_message_build, func_info_build, RPC_TYPE
+except ImportError:
+    # local import for standalone use
+    from lumina_structs import RpcReader, rpc_message_build, func_info_build, RPC_TYPE
+
+################################################################################
+#
+# Upstream servers
+#
+# Client side of the protocol, used by a server to talk to other Lumina servers:
+# replicas follow their primary and forward pushes to it, and pulls fan out to
+# the servers of --upstream.
+#
+################################################################################
+
+# HELO of the sessions opened by a server on other servers. The licence marks them
+# as upstream sessions: they are not counted by --max-id-sessions and their pushes
+# carry the identity of the client as hostname (see LuminaSession)
+UPSTREAM_LICENCE = b"lumina-upstream"
+UPSTREAM_ID = 0
+
+def parse_address(address, default_port=4443):
+    """
+    return (host, port) of a host[:port] string
+    """
+    host, separator, port = address.rpartition(":")
+    if not separator:
+        return address, default_port
+    return host.strip("[]"), int(port)
+
+class UpstreamError(Exception):
+    pass
+
+class UpstreamConnection(object):
+    """
+    Authenticated session on an upstream server
+    """
+    def __init__(self, address, ssl_context=None, timeout=60):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if ssl_context is not None:
+            self.sock = ssl_context.wrap_socket(self.sock, server_hostname = address[0])
+        self.reader = RpcReader(self.sock)
+
+        self.request(RPC_TYPE.RPC_HELO, RPC_TYPE.RPC_OK,
+            hexrays_licence = UPSTREAM_LICENCE, hexrays_id = UPSTREAM_ID, watermak = 0, field_0x36 = 0)
+
+    def request(self, code, expected, **kwargs):
+        """
+        return the reply message, only valid until the next read on this connection
+        """
+        self.sock.sendall(rpc_message_build(code, **kwargs))
+        return self.read(expected)
+
+    def read(self, expected):
+        packet, message = self.reader.read_message()
+        if packet.code != expected:
+            error = message.message if packet.code in (RPC_TYPE.RPC_NOTIFY, RPC_TYPE.RPC_FAIL) else packet.code
+            raise UpstreamError(f"{self.address[0]}:{self.address[1]} answered {error}")
+        return message
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class UpstreamPool(object):
+    """
+    Idle sessions on an upstream server, reused by requests. Sessions idle for half
+    of timeout are closed: servers close sessions idle for --idle-timeout.
+    """
+    def __init__(self, address, ssl_context=None, timeout=60, size=8):
+        self.address = address
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.size = size
+        self.lock = threading.Lock()
+        # (connection, idle since)
+        self.idle = deque()
+
+    @contextmanager
+    def connection(self, reuse=True):
+        connection = None
+        expired = list()
+        with self.lock:
+            deadline = time.monotonic() - self.timeout / 2
+            while self.idle and self.idle[0][1] < deadline:
+                expired.append(self.idle.popleft()[0])
+            if reuse and self.idle:
+                connection = self.idle.pop()[0]
+        for stale in expired:
+            stale.close()
+
+        if connection is None:
+            connection = UpstreamConnection(self.address, self.ssl_context, self.timeout)
+
+        try:
+            yield connection
+        except BaseException:
+            # the session state is unknown: not reused
+            connection.close()
+            raise
+
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((connection, time.monotonic()))
+                connection = None
+        if connection is not None:
+            connection.close()
+
+    def pull(self, signatures):
+        """
+        return serialized func_info_t (bytes) or None of each signature (bytes)
+        """
+        for reuse in (True, False):
+            try:
+                with self.connection(reuse) as connection:
+                    message = connection.request(RPC_TYPE.PULL_MD, RPC_TYPE.PULL_MD_RESULT,
+                        flags = 1, ukn_list = [], funcInfos = [dict(version = 1, signature = signature) for signature in signatures])
+
+                    # results are serialized before the next read (blobs are slices of the read buffer)
+                    found_results = iter(message.results)
+                    results = list()
+                    for found in message.found:
+                        if found:
+                            result = next(found_results)
+                            results.append(func_info_build(result.metadata, result.popularity))
+                        else:
+                            results.append(None)
+                    return results
+            except (OSError, EOFError):
+                # the session may have been closed by the server (restart): pulls are retried once
+                if not reuse:
+                    raise
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.pop()[0].close()
+
+class UpstreamServers(object):
+    """
+    Pulls fanned out to servers holding the same database (replicas of a primary):
+    signatures are split in a part per server, pulled in parallel. The part of a
+    failing server is pulled from the next one.
+    """
+    def __init__(self, logger, addresses, ssl_context=None, timeout=60):
+        self.logger = logger
+        self.pools = [UpstreamPool(address, ssl_context, timeout) for address in addresses]
+        self.executor = ThreadPoolExecutor(max_workers=8 * len(self.pools), thread_name_prefix="lumina-upstream")
+        # first server of the next pull, so single-part pulls are spread too, and failed
+        # pulls: updated by concurrent sessions
+        self.lock = threading.Lock()
+        self.next = 0
+        self.errors = 0
+
+    def pull(self, signatures):
+        """
+        return serialized func_info_t (bytes) or None of each signature (bytes)
+        """
+        count = len(self.pools)
+        with self.lock:
+            start = self.next
+            self.next = (start + 1) % count
+
+        size = -(-len(signatures) // count)
+        parts = [signatures[i:i + size] for i in range(0, len(signatures), size)]
+        futures = [self.executor.submit(self.pull_part, (start + i) % count, part) for i, part in enumerate(parts)]
+
+        results = list()
+        for future in futures:
+            results += future.result()
+        return results
+
+    def pull_part(self, index, signatures):
+        for attempt in range(len(self.pools)):
+            pool = self.pools[(index + attempt) % len(self.pools)]
+            try:
+                return pool.pull(signatures)
+            except (OSError, EOFError, UpstreamError) as e:
+                with self.lock:
+                    self.errors += 1
+                self.logger.warning(f"pull from upstream {pool.address[0]}:{pool.address[1]} failed: {e}")
+
+        # every server failed: answered as unknown
+        return [None] * len(signatures)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for pool in self.pools:
+            pool.close()
@@ -0,0 +1,200 @@
+import os, struct, threading, zlib
+
+#######################################
+#
+# Write-ahead log
+#
+# Append-only log of database updates, split in numbered segment files
+# (<path>.<segment>). A snapshot of the database records the last segment it
+# includes: older segments are deleted, newer ones are replayed at load time.
+#######################################
+
+# fsync policies:
+#   always:   every append is on disk before returning (appends of concurrent
+#             clients are committed together by a single fsync)
+#   interval: fsync every FSYNC_INTERVAL seconds, a crash of the machine loses at most that
+#   never:    leave it to the OS, only a crash of the server process is covered
+FSYNC_POLICIES = ("always", "interval", "never")
+FSYNC_INTERVAL = 1.0
+
+RECORD_HEADER = struct.Struct(">II") # payload size, crc32
+
+def fsync_directory(path):
+    """
+    Make a rename/unlink in path directory durable (no-op where directories can not be opened)
+    """
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog(object):
+    def __init__(self, logger, path, fsync="interval"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync}")
+
+        self.logger = logger
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.file = None
+        self.segment = 0
+        self.written = 0
+        self.synced = 0
+        self.stop_event = threading.Event()
+        self.flusher = None
+
+    def segment_path(self, segment):
+        return f"{self.path}.{segment:08d}"
+
+    def segments(self):
+        """
+        return sorted ids of existing segments
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + "."
+        segments = list()
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                segments.append(int(name[len(prefix):]))
+        return sorted(segments)
+
+    def replay(self, after=0):
+        """
+        Yield payloads of segments following segment after (included in a snapshot).
+        A torn record (crash while appending) ends its segment, which is truncated.
+        """
+        for segment in self.segments():
+            if segment <= after:
+                os.unlink(self.segment_path(segment))
+                continue
+
+            with open(self.segment_path(segment), "r+b") as segment_file:
+                offset = 0
+                while True:
+                    header = segment_file.read(RECORD_HEADER.size)
+                    if not header:
+                        break
+
+                    payload = b""
+                    if len(header) == RECORD_HEADER.size:
+                        size, crc = RECORD_HEADER.unpack(header)
+                        payload = segment_file.read(size)
+
+                    if len(header) != RECORD_HEADER.size or len(payload) != size or zlib.crc32(payload) != crc:
+                        self.logger.warning(f"truncating torn write-ahead log record in {self.segment_path(segment)} at offset {offset}")
+                        segment_file.truncate(offset)
+                        break
+
+                    offset += RECORD_HEADER.size + size
+                    yield payload
+
+            self.segment = max(self.segment, segment)
+
+    def open(self, segment=None):
+        """
+        Start appending to a new segment (following the last replayed one by default)
+        """
+        self.segment = max(self.segment + 1, segment or 0)
+        self.file = open(self.segment_path(self.segment), "ab")
+        fsync_directory(self.path)
+
+        if self.fsync == "interval":
+            self.flusher = threading.Thread(target=self.flush_loop, name="lumina-wal", daemon=True)
+            self.flusher.start()
+
+    def append(self, payload):
+        """
+        Append a record (order of appends is the replay order).
+        return its sequence number, see commit()
+        """
+        with self.lock:
+            self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self.file.write(payload)
+            # at least survive a crash of the process
+            self.file.flush()
+            self.written += 1
+            return self.written
+
+    def commit(self, lsn):
+        """
+        Wait until record lsn is durable according to the fsync policy
+        """
+        if self.fsync == "always":
+            self.sync(lsn)
+
+    def sync(self, lsn=None):
+        """
+        Group commit: the first waiting thread fsyncs every record written so far,
+        threads queued behind it find their record already synced.
+        """
+        with self.sync_lock:
+            if lsn is not None and self.synced >= lsn:
+                return
+
+            with self.lock:
+                target = self.written
+                segment_file = self.file
+
+            if segment_file is not None and not segment_file.closed:
+                os.fsync(segment_file.fileno())
+            self.synced = max(self.synced, target)
+
+    def flush_loop(self):
+        while not self.stop_event.wait(FSYNC_INTERVAL):
+            try:
+                self.sync(self.written)
+            except (OSError, ValueError):
+                # segment closed by a concurrent rotation (already synced)
+                pass
+
+    def rotate(self):
+        """
+        Close the current segment and start a new one.
+        Must be called while no append is in progress. return closed segment id
+        """
+        with self.sync_lock, self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = self.written
+            self.file.close()
+
+            closed = self.segment
+            self.segment += 1
+            self.file = open(self.segment_path(self.segment), "ab")
+
+        fsync_directory(self.path)
+        return closed
+
+    def remove(self, upto):
+        """
+        Delete segments included in a snapshot
+        """
+        for segment in self.segments():
+            if segment <= upto:
+                os.unlink(self.segment_path(segment))
+
+    def close(self, remove=False):
+        self.stop_event.set()
+        if self.flusher is not None:
+            self.flusher.join()
+
+        with self.sync_lock, self.lock:
+            if self.file is None:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            empty = self.file.tell() == 0
+            self.file.close()
+            self.file = None
+
+        if remove:
+            self.remove(self.segment)
+        elif empty:
+            os.unlink(self.segment_path(self.segment))
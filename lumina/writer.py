@@ -0,0 +1,185 @@
+import time, threading
+from collections import deque, Counter
+
+#######################################
+#
+# Write-behind queue
+#
+# PUSH_MD is answered before pushed functions are written: new signature flags
+# are computed from the database (signature filter and lookups) and the
+# signatures still queued, then a background thread writes queued pushes of
+# every client in a single storage operation (transaction or log commit).
+#
+# Pushes are visible to pulls once written (see the lumina_write_queue_functions
+# metric), and the queue is lost if the server is killed. A failed write stays
+# first in the queue and is retried with an increasing delay (see the
+# lumina_write_failures_total metric); it is only given up when closing. Pushes
+# waiting for room fail (WriteBehindError) while a write is retried, or after
+# timeout seconds.
+#######################################
+
+class WriteBehindError(RuntimeError):
+    pass
+
+class WriteBehindQueue(object):
+    # maximum number of functions written in a single storage operation
+    MAX_BATCH = 50000
+    # seconds before the first retry of a failed write, doubled up to MAX_RETRY_DELAY
+    RETRY_DELAY = 0.5
+    MAX_RETRY_DELAY = 30
+
+    def __init__(self, logger, database, depth, timeout=60):
+        """
+        depth: maximum number of functions queued or being written, pushes wait for room
+        timeout: seconds a push waits for room
+        """
+        self.logger = logger
+        self.database = database
+        self.depth = depth
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.push_lock = threading.Lock()
+        # (entries, pusher) waiting to be written
+        self.batches = deque()
+        # functions queued or being written, and their signatures
+        self.queued = 0
+        self.pending = Counter()
+        # failed writes, and whether the first batches failed and are being retried
+        self.failures = 0
+        self.retrying = False
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.write_loop, name="lumina-writer", daemon=True)
+        self.thread.start()
+
+    def push(self, entries, pusher=None):
+        """
+        Queue a list of (signature, metadata).
+        return a list of flags: True if the signature is new, else False
+        """
+        # blobs of received messages are only valid until the next read
+        entries = [(bytes(signature), {
+                "func_name"         : metadata["func_name"],
+                "func_size"         : metadata["func_size"],
+                "serialized_data"   : bytes(metadata["serialized_data"]),
+            }) for signature, metadata in entries]
+        signatures = [signature for signature, _ in entries]
+
+        # room is taken first, without holding push_lock
+        deadline = time.monotonic() + self.timeout
+        with self.cond:
+            while self.queued and self.queued + len(entries) > self.depth and not self.closed:
+                if self.retrying:
+                    raise WriteBehindError("failed to write queued pushes")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise WriteBehindError("no room in the write-behind queue")
+                self.cond.wait(remaining)
+            if self.closed:
+                raise WriteBehindError("database is closed")
+            self.queued += len(entries)
+
+        # flags of concurrent pushes of a signature are computed one push at a time:
+        # queued signatures are only removed from pending once written
+        try:
+            with self.push_lock:
+                with self.cond:
+                    queued = [signature in self.pending for signature in signatures]
+                stored = iter(self.database.lookup([signature for signature, known in zip(signatures, queued) if not known]))
+                known = [was_queued or next(stored) is not None for was_queued in queued]
+
+                with self.cond:
+                    if self.closed:
+                        raise WriteBehindError("database is closed")
+                    results = list()
+                    for signature, found in zip(signatures, known):
+                        results.append(not found and signature not in self.pending)
+                        self.pending[signature] += 1
+                    self.batches.append((entries, pusher))
+                    self.cond.notify_all()
+        except BaseException:
+            with self.cond:
+                self.queued -= len(entries)
+                self.cond.notify_all()
+            raise
+
+        return results
+
+    def write_loop(self):
+        delay = self.RETRY_DELAY
+        while True:
+            with self.cond:
+                while not self.batches and not self.closed:
+                    self.cond.wait()
+                if not self.batches:
+                    # closed and drained
+                    return
+
+                # every queued push, up to MAX_BATCH functions
+                batches = [self.batches.popleft()]
+                count = len(batches[0][0])
+                while self.batches and count + len(self.batches[0][0]) <= self.MAX_BATCH:
+                    batches.append(self.batches.popleft())
+                    count += len(batches[-1][0])
+
+            try:
+                self.database.write_batches(batches)
+            except Exception:
+                with self.cond:
+                    self.failures += 1
+                    retry = not self.closed
+                    if retry:
+                        # kept first in the queue: flush callers are told, pushes waiting for room fail
+                        self.batches.extendleft(reversed(batches))
+                        self.retrying = True
+                        self.cond.notify_all()
+                if retry:
+                    self.logger.exception(f"failed to write {count} pushed functions, retrying in {delay:g} seconds")
+                    self.wait(delay)
+                    delay = min(delay * 2, self.MAX_RETRY_DELAY)
+                    continue
+                self.logger.exception(f"failed to write {count} pushed functions, lost on close")
+            else:
+                delay = self.RETRY_DELAY
+
+            with self.cond:
+                self.retrying = False
+                for entries, _ in batches:
+                    for signature, _ in entries:
+                        self.pending[signature] -= 1
+                        if not self.pending[signature]:
+                            del self.pending[signature]
+                self.queued -= count
+                self.cond.notify_all()
+
+    def wait(self, delay):
+        """
+        Sleep for delay seconds, or until closed
+        """
+        deadline = time.monotonic() + delay
+        with self.cond:
+            while not self.closed and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+
+    def flush(self):
+        """
+        Wait until every queued push is written, or a write fails.
+        return True if the queue was written, False if a write failed (its pushes are still queued)
+        """
+        with self.cond:
+            failures = self.failures
+            while self.queued and self.failures == failures:
+                self.cond.wait()
+            return not self.queued
+
+    def close(self):
+        """
+        Write queued pushes and stop the writer thread
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        return dict(queued = self.queued, failures = self.failures)
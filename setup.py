@@ -7,11 +7,14 @@ setup(name='lumina',
       description='IDA lumina offline server',
       author='Synacktiv',
       author_email='johan.bonvicini@synacktiv.com',
-      packages=find_packages(exclude=["tests"]),
+      packages=find_packages(exclude=["tests", "benchmarks", "benchmarks.*"]),
       package_data={"lumina": [""]},
       test_suite="tests",
       scripts=[],
       install_requires=["construct"],
       entry_points={
-          'console_scripts' : ['lumina_server=lumina.lumina_server:main']
+          'console_scripts' : [
+              'lumina_server=lumina.lumina_server:main',
+              'lumina_db=lumina.lumina_db:main',
+          ]
       })
\ No newline at end of file
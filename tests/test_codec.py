@@ -0,0 +1,109 @@
+import random, unittest
+
+import construct as con
+
+from lumina.lumina_structs import IdaVarInt32, RpcMessage, RPC_TYPE, FAST_CODECS, fast_message_parse, fast_message_build, \
+    func_info_build, func_info_t
+
+# varint length boundaries
+INTEGERS = [0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 0x1fffffff, 0x20000000, 0xffffffff]
+
+def random_int(rnd):
+    return rnd.choice(INTEGERS + [rnd.randrange(1 << 32)])
+
+def random_bytes(rnd):
+    return rnd.randbytes(rnd.choice([0, 1, 5, 16, 200, 70000 if rnd.random() < 0.02 else 5]))
+
+def random_string(rnd):
+    return "".join(rnd.choice("abc_é中") for _ in range(rnd.choice([0, 3, 300])))
+
+def random_metadata(rnd):
+    return dict(func_name = random_string(rnd), func_size = random_int(rnd), serialized_data = random_bytes(rnd))
+
+def random_signature(rnd):
+    return dict(version = 1, signature = random_bytes(rnd))
+
+def random_message(rnd, code):
+    """
+    return the kwargs of a random message handled by the fast codec
+    """
+    if code == RPC_TYPE.PULL_MD:
+        return dict(flags = random_int(rnd), ukn_list = [random_int(rnd) for _ in range(rnd.randrange(4))],
+            funcInfos = [random_signature(rnd) for _ in range(rnd.randrange(20))])
+    if code == RPC_TYPE.PULL_MD_RESULT:
+        return dict(found = [rnd.randrange(2) for _ in range(rnd.randrange(20))],
+            results = [dict(metadata = random_metadata(rnd), popularity = random_int(rnd)) for _ in range(rnd.randrange(10))])
+    if code == RPC_TYPE.PUSH_MD:
+        return dict(field_0x10 = random_int(rnd), idb_filepath = random_string(rnd), input_filepath = random_string(rnd),
+            input_md5 = rnd.randbytes(16), hostname = random_string(rnd),
+            funcInfos = [dict(metadata = random_metadata(rnd), signature = random_signature(rnd)) for _ in range(rnd.randrange(10))],
+            funcEas = [rnd.randrange(1 << 64) for _ in range(rnd.randrange(10))])
+    return dict(resultsFlags = [rnd.choice([True, False, 0, 1]) for _ in range(rnd.randrange(20))])
+
+
+class FastCodecTest(unittest.TestCase):
+    """
+    Differential tests of the fast codec against the construct definitions
+    """
+    ROUNDS = 200
+
+    def test_build(self):
+        rnd = random.Random(1)
+        for _ in range(self.ROUNDS):
+            for code in FAST_CODECS:
+                kwargs = random_message(rnd, code)
+                self.assertEqual(fast_message_build(code, **kwargs), RpcMessage.build(kwargs, code = code), code)
+
+    def test_parse(self):
+        rnd = random.Random(2)
+        for _ in range(self.ROUNDS):
+            for code in FAST_CODECS:
+                data = RpcMessage.build(random_message(rnd, code), code = code)
+                message = fast_message_parse(code, memoryview(data))
+                self.assertEqual(message, RpcMessage.parse(data, code = code), code)
+                # round trip of the parsed message
+                self.assertEqual(fast_message_build(code, **message), data, code)
+
+    def test_truncated(self):
+        rnd = random.Random(3)
+        for _ in range(20):
+            for code in FAST_CODECS:
+                data = RpcMessage.build(random_message(rnd, code), code = code)
+                # every prefix of small messages, a sample of the others
+                for end in range(len(data)) if len(data) < 256 else rnd.sample(range(len(data)), 64):
+                    with self.assertRaises(con.ConstructError, msg = f"{code} truncated to {end} bytes"):
+                        RpcMessage.parse(data[:end], code = code)
+                    with self.assertRaises(con.ConstructError, msg = f"{code} truncated to {end} bytes"):
+                        fast_message_parse(code, data[:end])
+
+    def test_varint32(self):
+        for value in INTEGERS:
+            data = IdaVarInt32.build(value)
+            self.assertEqual(fast_message_build(RPC_TYPE.PUSH_MD_RESULT, resultsFlags = [value]), b"\x01" + data)
+            self.assertEqual(fast_message_parse(RPC_TYPE.PUSH_MD_RESULT, b"\x01" + data).resultsFlags, [value])
+
+        for value in (-1, 1 << 32):
+            with self.assertRaises(con.IntegerError):
+                fast_message_build(RPC_TYPE.PUSH_MD_RESULT, resultsFlags = [value])
+
+    def test_invalid(self):
+        # signature version other than 1
+        data = bytearray(RpcMessage.build(dict(flags = 0, ukn_list = [], funcInfos = [dict(version = 1, signature = b"x" * 16)]),
+            code = RPC_TYPE.PULL_MD))
+        data[3] = 2
+        with self.assertRaises(con.ConstructError):
+            fast_message_parse(RPC_TYPE.PULL_MD, bytes(data))
+        # input_md5 of the wrong size
+        with self.assertRaises(con.ConstructError):
+            fast_message_build(RPC_TYPE.PUSH_MD, field_0x10 = 0, idb_filepath = "", input_filepath = "", input_md5 = bytes(15),
+                hostname = "", funcInfos = [], funcEas = [])
+
+    def test_func_info_build(self):
+        rnd = random.Random(4)
+        for _ in range(self.ROUNDS):
+            metadata, popularity = random_metadata(rnd), random_int(rnd)
+            self.assertEqual(func_info_build(metadata, popularity), func_info_t.build(dict(metadata = metadata, popularity = popularity)))
+
+
+if __name__ == "__main__":
+    unittest.main()
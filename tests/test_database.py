@@ -0,0 +1,93 @@
+import os, time, shutil, logging, tempfile, threading, unittest
+from types import SimpleNamespace
+
+from lumina.bloom import SignatureFilter
+from lumina.database import LuminaDatabase
+from lumina.lumina_structs import func_info_build
+
+logger = logging.getLogger("tests")
+
+def metadata(i):
+    return dict(func_name = f"f{i}", func_size = i, serialized_data = bytes([i & 0xff]) * 16)
+
+def signature(i):
+    return i.to_bytes(16, "big")
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="lumina-tests-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, backend, **options):
+        database = LuminaDatabase(logger, os.path.join(self.directory, f"db.{backend}"), backend, fsync="never", **options)
+        self.addCleanup(database.close)
+        return database
+
+    def push(self, database, indexes):
+        return database.write_batches([([(signature(i), metadata(i)) for i in indexes], "pusher")])[0]
+
+
+class SignatureFilterTest(DatabaseTestCase):
+    def build_while_pushing(self, backend):
+        database = self.open(backend)
+        self.push(database, range(1000))
+
+        # the build is paused halfway through the stored signatures
+        listing, pushed = threading.Event(), threading.Event()
+        iter_signatures = database.storage.iter_signatures
+        def paused():
+            for i, signature in enumerate(iter_signatures()):
+                if i == 500:
+                    listing.set()
+                    pushed.wait()
+                yield signature
+        database.storage.iter_signatures = paused
+
+        database.filter = SignatureFilter(logger, database.storage)
+        self.assertTrue(listing.wait(10))
+        # not listed by the build (read snapshot), added by add_many
+        self.assertEqual(self.push(database, range(1000, 1100)), [True] * 100)
+        pushed.set()
+
+        while database.filter.building is not None:
+            time.sleep(0.01)
+        self.assertIsNotNone(database.filter.bloom)
+        self.assertEqual(database.lookup([signature(i) for i in range(1100)]), [(metadata(i), 1) for i in range(1100)])
+        self.assertEqual(database.lookup([signature(i) for i in range(1100, 1200)]), [None] * 100)
+
+    def test_sqlite(self):
+        self.build_while_pushing("sqlite")
+
+    def test_mmap(self):
+        self.build_while_pushing("mmap")
+
+
+class MetadataCacheTest(DatabaseTestCase):
+    def pull(self, database, i):
+        return database.pull_encoded([SimpleNamespace(version = 1, signature = signature(i))])[0]
+
+    def test_push_during_pull(self):
+        database = self.open("sqlite", cache_size=100)
+        self.push(database, [0])
+
+        # pushed again between the lookup and put_many of the pull
+        lookup = database.lookup
+        def pushing(signatures):
+            results = lookup(signatures)
+            self.push(database, [0])
+            return results
+        database.lookup = pushing
+        self.assertEqual(self.pull(database, 0), func_info_build(metadata(0), 1))
+        del database.lookup
+
+        # the value read before the push was not cached
+        self.assertEqual(self.pull(database, 0), func_info_build(metadata(0), 2))
+        self.assertEqual(self.pull(database, 0), func_info_build(metadata(0), 2))
+        self.assertEqual(database.cache.stats()["hits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import os, time, zlib, shutil, logging, tempfile, threading, unittest
+
+from lumina.limits import FairScheduler
+from lumina.lumina_server import create_parser, create_server
+from lumina.lumina_structs import RPC_TYPE
+from lumina.upstream import UpstreamConnection
+from benchmarks.client import LuminaClient, LuminaError, func_info, signature
+
+logger = logging.getLogger("tests")
+
+
+class FairSchedulerTest(unittest.TestCase):
+    def test_large_request_interleaves(self):
+        scheduler = FairScheduler(1)
+        calls = list()
+
+        def large(items):
+            calls.append(("large", len(items)))
+            if len(calls) == 1:
+                # the small request queues for the slot held by the first chunk
+                small.start()
+                while not scheduler.waiters:
+                    time.sleep(0.001)
+            return items
+
+        def run_small():
+            calls.append(("small", len(scheduler.run(lambda items: items, [0]))))
+
+        small = threading.Thread(target=run_small)
+        items = list(range(3 * FairScheduler.CHUNK_SIZE))
+        self.assertEqual(scheduler.run(large, items), items)
+        small.join()
+
+        # served between the chunks of the large request, not after it
+        self.assertEqual(calls[:2], [("large", FairScheduler.CHUNK_SIZE), ("small", 1)])
+        self.assertEqual(calls[2:], [("large", FairScheduler.CHUNK_SIZE)] * 2)
+
+
+class SessionLimitsTest(unittest.TestCase):
+    def start(self, *args):
+        config = create_parser().parse_args([os.path.join(self.directory, "db"), "-b", "memory", "-p", "0", "-l", "WARNING"] + list(args))
+        server = create_server(config, logger)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown(save=False)
+            thread.join()
+            server.server_close()
+        self.addCleanup(stop)
+        self.server = server
+        self.port = server.server_address[1]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="lumina-tests-")
+        # removed after the server and clients are stopped
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def client(self, hexrays_id=0x1337):
+        client = LuminaClient("127.0.0.1", self.port, timeout=10)
+        self.addCleanup(client.close)
+        client.helo(hexrays_id)
+        return client
+
+    def assertRefused(self, hexrays_id=0x1337):
+        # disconnected at once without a reply, not left waiting (socket.timeout)
+        with self.assertRaises((EOFError, ConnectionError)):
+            self.client(hexrays_id)
+
+    def assertServedAgain(self):
+        # the slot is released once the server sees the disconnection
+        for _ in range(100):
+            try:
+                return self.client()
+            except (EOFError, OSError):
+                time.sleep(0.05)
+        self.fail("session slot not released")
+
+    def test_max_sessions(self):
+        self.start("--max-sessions", "2")
+        first, _ = self.client(), self.client()
+        self.assertRefused()
+        first.close()
+        self.assertServedAgain()
+
+    def test_max_ip_sessions(self):
+        self.start("--max-ip-sessions", "1")
+        first = self.client()
+        self.assertRefused()
+        first.close()
+        self.assertServedAgain()
+
+    def test_max_id_sessions(self):
+        self.start("--max-id-sessions", "1")
+        self.client(1)
+        with self.assertRaises(LuminaError):
+            self.client(1)
+        self.client(2)
+
+    def test_upstream_sessions(self):
+        self.start("--max-id-sessions", "1")
+        # routers and replicas share a license id
+        connections = [UpstreamConnection(("127.0.0.1", self.port), timeout=10) for _ in range(3)]
+        for connection in connections:
+            self.addCleanup(connection.close)
+        self.client(0)
+
+        # the pusher is the client identity forwarded as hostname
+        connections[0].request(RPC_TYPE.PUSH_MD, RPC_TYPE.PUSH_MD_RESULT, field_0x10 = 0, idb_filepath = "", input_filepath = "",
+            input_md5 = bytes(16), hostname = "1337/build", funcInfos = [func_info(0)], funcEas = [0])
+        storage = self.server.database.storage
+        entry = storage.shards[storage.shard_index(signature(0))].entries[signature(0)]
+        self.assertEqual(entry.best.pushers, (zlib.crc32(b"1337/build"),))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import os, shutil, logging, tempfile, unittest
+
+from lumina.replication import ReplicationLog, ReplicationError
+from lumina.storage import encode_delete
+
+logger = logging.getLogger("tests")
+
+
+class ReplicationLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="lumina-tests-")
+        self.path = os.path.join(self.directory, "db.repl")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_new_replica_of_an_empty_database(self):
+        log = ReplicationLog(logger, self.path, 1 << 20, empty=True)
+        log.append([encode_delete([b"signature"])])
+        self.assertEqual(log.reader("", 0).read(), [encode_delete([b"signature"])])
+        log.close()
+
+        # still complete once reopened
+        log = ReplicationLog(logger, self.path, 1 << 20)
+        self.assertEqual(log.reader("", 0).position, 1)
+        log.close()
+
+    def test_new_replica_of_a_database_with_data(self):
+        log = ReplicationLog(logger, self.path, 1 << 20, empty=False)
+        log.append([encode_delete([b"signature"])])
+        # the log does not hold the data written before it
+        with self.assertRaises(ReplicationError):
+            log.reader("", 0)
+        # seeded replicas follow it
+        self.assertEqual(log.reader(log.log_id, 2).position, 2)
+        log.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import os, random, shutil, logging, tempfile, threading, unittest
+
+from lumina.lumina_server import create_parser, create_server
+from lumina.router import HashRing, SHARD_CURSOR
+from benchmarks.client import LuminaClient, func_info, signature
+
+logger = logging.getLogger("tests")
+
+
+class HashRingTest(unittest.TestCase):
+    SIGNATURES = [signature(i) for i in range(20000)]
+
+    def test_order_independent(self):
+        ring = HashRing(["a:4443", "b:4443", "c:4443"])
+        other = HashRing(["c:4443", "a:4443", "b:4443"])
+        self.assertEqual([ring.nodes[ring.node_index(sig)] for sig in self.SIGNATURES],
+            [other.nodes[other.node_index(sig)] for sig in self.SIGNATURES])
+
+    def test_adding_a_shard(self):
+        nodes = ["a:4443", "b:4443", "c:4443"]
+        ring, grown = HashRing(nodes), HashRing(nodes + ["d:4443"])
+
+        moved = 0
+        for sig in self.SIGNATURES:
+            before, after = ring.nodes[ring.node_index(sig)], grown.nodes[grown.node_index(sig)]
+            if before != after:
+                # only to the new shard
+                self.assertEqual(after, "d:4443")
+                moved += 1
+        # about 1/4 of the signatures
+        self.assertAlmostEqual(moved / len(self.SIGNATURES), 1 / 4, delta=0.05)
+
+    def test_duplicate_shard(self):
+        with self.assertRaises(ValueError):
+            HashRing(["a:4443", "a:4443"])
+
+
+class RouterTest(unittest.TestCase):
+    SHARDS = 3
+
+    def start(self, *args):
+        config = create_parser().parse_args(["-p", "0", "-l", "WARNING"] + list(args))
+        server = create_server(config, logger)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown(save=False)
+            thread.join()
+            server.server_close()
+        self.addCleanup(stop)
+        return server
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="lumina-tests-")
+        # removed after the servers and clients are stopped
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.shards = [self.start(os.path.join(self.directory, f"shard{i}"), "-b", "memory", "--admin") for i in range(self.SHARDS)]
+        self.router = self.start("--shards", ",".join(f"127.0.0.1:{shard.server_address[1]}" for shard in self.shards))
+        self.database = self.router.database
+
+        self.client = LuminaClient("127.0.0.1", self.router.server_address[1], timeout=10)
+        self.addCleanup(self.client.close)
+        self.client.helo()
+        self.assertEqual(self.client.push([func_info(i) for i in range(300)]), [1] * 300)
+
+    def test_pull_in_request_order(self):
+        # known and unknown signatures, spread over every shard
+        indexes = list(range(400))
+        random.Random(0).shuffle(indexes)
+        found, results = self.client.pull([signature(i) for i in indexes])
+        self.assertEqual(found, [int(i < 300) for i in indexes])
+        self.assertEqual([result.metadata.func_name for result in results], [f"sub_{i:x}_0" for i in indexes if i < 300])
+
+    def test_count(self):
+        counts = [shard.database.count() for shard in self.shards]
+        self.assertTrue(all(counts))
+        self.assertEqual(self.database.count(), sum(counts))
+        self.assertEqual(self.database.count(), 300)
+
+    def test_scan(self):
+        signatures = list()
+        cursor = None
+        while True:
+            entries, cursor = self.database.scan(cursor, 64)
+            signatures += [sig for sig, _, _ in entries]
+            if cursor is None:
+                break
+        self.assertEqual(sorted(signatures), sorted(signature(i) for i in range(300)))
+
+    def test_invalid_cursor(self):
+        for cursor in (b"\x00", SHARD_CURSOR.pack(self.SHARDS)):
+            with self.assertRaises(ValueError):
+                self.database.scan(cursor)
+
+
+if __name__ == "__main__":
+    unittest.main()
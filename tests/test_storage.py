@@ -0,0 +1,384 @@
+import os, sys, shutil, sqlite3, logging, tempfile, threading, unittest
+from contextlib import contextmanager
+
+from lumina.storage import CompressedRecord, JsonStorage, MemoryStorage, SqliteStorage, open_storage
+
+logger = logging.getLogger("tests")
+
+def metadata(i, variant=0):
+    return dict(func_name = f"f{i}", func_size = i, serialized_data = bytes([variant]) * 16)
+
+def signature(i):
+    return i.to_bytes(16, "big")
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="lumina-tests-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+class JsonMigrationTest(StorageTestCase):
+    def test_pushes_survive_a_crash(self):
+        path = self.path("db.json")
+        storage = JsonStorage(logger, path, snapshot_interval=0)
+        storage.push_many([(signature(0), metadata(0))], "seed")
+        storage.close(save=True)
+
+        # json databases are served by the memory backend: pushes are journaled
+        storage = open_storage(logger, path, fsync="always", snapshot_interval=0)
+        self.assertIsInstance(storage, MemoryStorage)
+        self.assertNotIsInstance(storage, JsonStorage)
+        storage.push_many([(signature(i), metadata(i)) for i in range(1, 100)], "pusher")
+        # killed: neither saved nor closed
+
+        storage = open_storage(logger, path, snapshot_interval=0)
+        self.assertEqual(storage.count(), 100)
+        self.assertEqual(storage.pull(signature(42)), (metadata(42), 1))
+        storage.close(save=True)
+        self.assertTrue(os.path.exists(path + ".bak"))
+
+
+class ConcurrencyTest(StorageTestCase):
+    """
+    Concurrent pushes of the same signatures (sharded memory index, pooled sqlite
+    connections, mmap overlay): no push is lost
+    """
+    CLIENTS = 16
+    ROUNDS = 20
+    SIGNATURES = 100
+    BATCH = 10
+
+    def stress(self, backend):
+        path = self.path(f"db.{backend}")
+        storage = open_storage(logger, path, backend, fsync="never", snapshot_interval=0)
+        errors = list()
+        barrier = threading.Barrier(self.CLIENTS)
+
+        def client(index):
+            try:
+                for round in range(self.ROUNDS):
+                    # every client pushes the same new signatures at the same time
+                    signatures = range(round * self.SIGNATURES, (round + 1) * self.SIGNATURES)
+                    barrier.wait()
+                    for i in range(0, len(signatures), self.BATCH):
+                        storage.push_many([(signature(j), metadata(j, index % 3)) for j in signatures[i:i + self.BATCH]], f"client{index}")
+                        storage.pull_many([signature(j) for j in signatures[i:i + self.BATCH]])
+            except Exception as e:
+                errors.append(e)
+                barrier.abort()
+
+        threads = [threading.Thread(target=client, args=(index,)) for index in range(self.CLIENTS)]
+        # switch threads as often as possible: unprotected updates get interleaved
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            # snapshot or compaction while pushes are applied
+            storage.save()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+
+        def check(storage):
+            self.assertEqual(storage.count(), self.ROUNDS * self.SIGNATURES)
+            results = storage.pull_many([signature(j) for j in range(self.ROUNDS * self.SIGNATURES)])
+            self.assertEqual([popularity for _, popularity in results], [self.CLIENTS] * self.ROUNDS * self.SIGNATURES)
+
+        check(storage)
+        storage.close(save=True)
+        storage = open_storage(logger, path, backend, snapshot_interval=0)
+        check(storage)
+        storage.close()
+
+    def test_memory(self):
+        self.stress("memory")
+
+    def test_sqlite(self):
+        self.stress("sqlite")
+
+    def test_mmap(self):
+        self.stress("mmap")
+
+
+class SqliteCountTest(StorageTestCase):
+    def test_count(self):
+        path = self.path("db.sqlite")
+        storage = open_storage(logger, path, "sqlite")
+        storage.push_many([(signature(i), metadata(i)) for i in range(100)], "pusher")
+        self.assertEqual(storage.count(), 100)
+
+        # pushes and deletes of this process are counted as they are committed
+        storage.push_many([(signature(i), metadata(i, 1)) for i in range(90, 110)] + [(signature(110), metadata(110))] * 2, "pusher")
+        storage.delete_many([signature(0), signature(0), signature(1000)])
+        self.assertEqual(storage.count(), 110)
+
+        # those of another process once counted again
+        other = open_storage(logger, path, "sqlite")
+        other.delete_many([signature(i) for i in range(10)])
+        self.assertEqual(storage.count(), 110)
+        storage.COUNT_INTERVAL = 0
+        self.assertEqual(storage.count(), 101)
+        other.close()
+        storage.close()
+
+    def test_commits_while_counting(self):
+        storage = open_storage(logger, self.path("db.sqlite"), "sqlite")
+        storage.push_many([(signature(i), metadata(i)) for i in range(100)], "pusher")
+        storage.COUNT_INTERVAL = 0
+        connection = storage.connection
+        test = self
+
+        class CountingConnection(object):
+            # a push is committed once the table is counted, before the count returns
+            def __init__(self, conn):
+                self.conn = conn
+
+            def execute(self, query):
+                return CountingCursor(self.conn.execute(query))
+
+        class CountingCursor(object):
+            def __init__(self, cursor):
+                self.cursor = cursor
+
+            def fetchone(self):
+                row = self.cursor.fetchone()
+                pusher = threading.Thread(target=storage.push_many, args=([(signature(100), metadata(100))], "pusher"))
+                pusher.start()
+                pusher.join(10)
+                test.assertFalse(pusher.is_alive(), "commit blocked by the count")
+                return row
+
+        @contextmanager
+        def counting_connection():
+            storage.connection = connection
+            with connection() as conn:
+                yield CountingConnection(conn)
+
+        storage.connection = counting_connection
+        self.assertEqual(storage.count(), 101)
+        storage.close()
+
+
+class ReplicatedPositionTest(StorageTestCase):
+    """
+    The replication position of replicas is stored with the writes it follows
+    """
+    LOG_ID = "0123456789abcdef"
+
+    def replicate(self, backend):
+        path = self.path(f"db.{backend}")
+        storage = open_storage(logger, path, backend, fsync="always", snapshot_interval=0)
+        self.assertIsNone(storage.replicated)
+        storage.push_batches([([(signature(i), metadata(i))], "pusher") for i in range(3)], replicated=(self.LOG_ID, 1))
+        storage.delete_many([signature(0)], replicated=(self.LOG_ID, 4))
+        self.assertEqual(tuple(storage.replicated), (self.LOG_ID, 5))
+        # killed: neither saved nor closed
+
+        storage = open_storage(logger, path, backend, snapshot_interval=0)
+        self.assertEqual(tuple(storage.replicated), (self.LOG_ID, 5))
+        self.assertEqual(storage.count(), 2)
+        storage.push_batches([([(signature(1), metadata(1))], "pusher")], replicated=(self.LOG_ID, 5))
+        storage.save()
+        storage.push_many([(signature(9), metadata(9))], "pusher")
+        storage.close(save=True)
+
+        storage = open_storage(logger, path, backend, snapshot_interval=0)
+        self.assertEqual(tuple(storage.replicated), (self.LOG_ID, 6))
+        self.assertEqual(storage.pull(signature(1)), (metadata(1), 2))
+        storage.close()
+
+    def test_memory(self):
+        self.replicate("memory")
+
+    def test_sqlite(self):
+        self.replicate("sqlite")
+
+    def test_mmap(self):
+        self.replicate("mmap")
+
+
+class ScanTest(StorageTestCase):
+    def scan_all(self, storage, limit):
+        signatures, cursor = list(), None
+        while True:
+            page = storage.scan(cursor, limit)
+            if not page:
+                return signatures
+            signatures += [signature for signature, _, _ in page]
+            cursor = page[-1][0]
+
+    def pages(self, backend):
+        storage = open_storage(logger, self.path(f"db.{backend}"), backend, fsync="never", snapshot_interval=0)
+        storage.push_many([(signature(i * 7919 % 5000), metadata(i)) for i in range(2500)], "pusher")
+        # mmap: half of the signatures in the index, half in the overlay, and updated entries in both
+        storage.save()
+        storage.push_many([(signature(i * 7919 % 5000), metadata(i)) for i in range(2500, 5000)], "pusher")
+        storage.push_many([(signature(i * 7919 % 5000), metadata(i, 1)) for i in range(0, 5000, 50)], "other")
+
+        # a signature added and one removed between pages
+        pages = list()
+        cursor = None
+        while True:
+            page = storage.scan(cursor, 100)
+            if not page:
+                break
+            pages.append(page)
+            cursor = page[-1][0]
+            if len(pages) == 10:
+                storage.push_many([(signature(5000), metadata(5000))], "pusher")
+                storage.delete_many([signature(4999)])
+
+        scanned = [signature for page in pages for signature, _, _ in page]
+        self.assertEqual(len(scanned), len(set(scanned)))
+        self.assertEqual(set(scanned) - {signature(4999), signature(5000)}, {signature(i) for i in range(4999)})
+        self.assertTrue(all(len(page) == 100 for page in pages[:-1]))
+        self.assertEqual([(metadata, popularity) for page in pages for _, metadata, popularity in page[::37]],
+            [storage.pull(signature) for page in pages for signature, _, _ in page[::37]])
+        # same order with any page size
+        self.assertEqual(self.scan_all(storage, 7), self.scan_all(storage, 1000))
+        return storage, scanned
+
+    def test_memory(self):
+        storage, _ = self.pages("memory")
+        storage.close()
+
+    def test_sqlite(self):
+        storage, scanned = self.pages("sqlite")
+        self.assertEqual(scanned, sorted(scanned))
+        storage.close()
+
+    def test_mmap(self):
+        storage, scanned = self.pages("mmap")
+        self.assertEqual(scanned, sorted(scanned))
+        storage.close()
+
+
+class MmapCompactionTest(StorageTestCase):
+    def open(self):
+        return open_storage(logger, self.path("db.mmap"), "mmap", fsync="never", snapshot_interval=0)
+
+    scan_all = ScanTest.scan_all
+
+    def assertStored(self, storage, indexes):
+        self.assertEqual(self.scan_all(storage, 64), sorted(signature(i) for i in indexes))
+        self.assertEqual([storage.pull(signature(i)) for i in range(1200)],
+            [(metadata(i), 1) if i in indexes else None for i in range(1200)])
+
+    def test_failed_compaction(self):
+        storage = self.open()
+        storage.push_many([(signature(i), metadata(i)) for i in range(1000)], "pusher")
+        storage.save()
+        storage.push_many([(signature(i), metadata(i)) for i in range(1000, 1100)], "pusher")
+        storage.delete_many([signature(i) for i in range(10)])
+        stored = set(range(10, 1100))
+
+        merge_entries = storage.merge_entries
+        def failing(index, frozen, codec=None):
+            for i, item in enumerate(merge_entries(index, frozen, codec)):
+                if i == 500:
+                    # frozen overlay, new overlay and index merged by scans during the compaction
+                    storage.push_many([(signature(1100), metadata(1100))], "pusher")
+                    stored.add(1100)
+                    self.assertStored(storage, stored)
+                    raise OSError("disk full")
+                yield item
+        storage.merge_entries = failing
+
+        with self.assertRaises(OSError):
+            storage.save()
+        # the original index is still used, the frozen overlay was merged back
+        self.assertStored(storage, stored)
+
+        del storage.merge_entries
+        storage.close(save=True)
+        storage = self.open()
+        self.assertStored(storage, stored)
+        storage.close()
+
+
+class MemoryCompressionTest(StorageTestCase):
+    def metadata(self, i):
+        # records sharing their structure, as type information does
+        return dict(func_name = f"sub_{i:x}", func_size = i, serialized_data = b"".join(b"arg_%d:int;" % (i + k) for k in range(8)))
+
+    def open(self, **options):
+        return MemoryStorage(logger, self.path("db.memory"), snapshot_interval=0, **options)
+
+    def test_records_stay_compressed(self):
+        storage = self.open(compression_level=6)
+        storage.push_many([(signature(i), self.metadata(i)) for i in range(1000)], "pusher")
+        storage.close(save=True)
+
+        storage = self.open(compression_level=6)
+        entry = storage.shards[storage.shard_index(signature(1))].entries[signature(1)]
+        self.assertIs(type(entry.best.record), CompressedRecord)
+        self.assertEqual(storage.pull(signature(1)), (self.metadata(1), 1))
+        self.assertEqual(storage.scan(None, 1)[0][1], storage.pull(storage.scan(None, 1)[0][0])[0])
+        # pushed again: decompressed, the same record is not a new variant
+        storage.push_many([(signature(1), self.metadata(1))], "other")
+        self.assertEqual(len(entry.variants), 1)
+        self.assertEqual(storage.pull(signature(1)), (self.metadata(1), 2))
+        storage.close(save=True)
+
+        # written uncompressed once compression is disabled
+        self.open().close(save=True)
+        storage = self.open()
+        self.assertEqual(storage.pull(signature(1)), (self.metadata(1), 2))
+        self.assertEqual([storage.pull(signature(i)) for i in range(2, 1000)], [(self.metadata(i), 1) for i in range(2, 1000)])
+        self.assertFalse(any(type(entry.best.record) is CompressedRecord for shard in storage.shards for entry in shard.entries.values()))
+        storage.close()
+
+
+class SqliteCompressionTest(StorageTestCase):
+    metadata = MemoryCompressionTest.metadata
+
+    def open(self, **options):
+        return SqliteStorage(logger, self.path("db.sqlite"), fsync="never", **options)
+
+    def test_concurrent_pushes_train_once(self):
+        storage = self.open(compression_level=6)
+        errors = list()
+
+        def client(n):
+            try:
+                for start in range(n * 1024, (n + 1) * 1024, 64):
+                    storage.push_many([(signature(i), self.metadata(i)) for i in range(start, start + 64)], f"pusher{n}")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # waits for the dictionary trained in the background
+        storage.close()
+        self.assertEqual(errors, [])
+
+        storage = self.open(compression_level=6)
+        with storage.connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM dictionaries").fetchone()[0], 1)
+        self.assertEqual([storage.pull(signature(i))[0] for i in range(0, 8192, 511)], [self.metadata(i) for i in range(0, 8192, 511)])
+        storage.close()
+
+    def test_old_layout_refused(self):
+        # version 1: variants without a dictionary column
+        conn = sqlite3.connect(self.path("db.sqlite"))
+        conn.execute("CREATE TABLE variants (id INTEGER PRIMARY KEY, signature BLOB)")
+        conn.execute("PRAGMA user_version = 1")
+        conn.close()
+        with self.assertRaises(ValueError):
+            self.open()
+
+
+if __name__ == "__main__":
+    unittest.main()
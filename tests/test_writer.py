@@ -0,0 +1,98 @@
+import logging, threading, unittest
+
+from lumina.writer import WriteBehindQueue, WriteBehindError
+
+logger = logging.getLogger("tests")
+
+def metadata(i):
+    return dict(func_name = f"f{i}", func_size = i, serialized_data = bytes(16))
+
+def signature(i):
+    return i.to_bytes(16, "big")
+
+
+class FailingDatabase(object):
+    """
+    Database whose writes fail until it is repaired
+    """
+    def __init__(self):
+        self.broken = True
+        self.written = list()
+        self.attempts = threading.Semaphore(0)
+
+    def lookup(self, signatures):
+        return [None] * len(signatures)
+
+    def write_batches(self, batches):
+        self.attempts.release()
+        if self.broken:
+            raise OSError("disk full")
+        self.written += [signature for entries, _ in batches for signature, _ in entries]
+
+
+class FastRetryQueue(WriteBehindQueue):
+    # set before the writer thread starts
+    RETRY_DELAY = 0.01
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.database = FailingDatabase()
+        self.queue = FastRetryQueue(logger, self.database, 1000, timeout=0.2)
+
+    def tearDown(self):
+        self.queue.close()
+
+    def test_failed_writes_are_retried(self):
+        self.assertEqual(self.queue.push([(signature(i), metadata(i)) for i in range(10)], "pusher"), [True] * 10)
+        # the failure is reported, pushes stay queued and keep their flags
+        self.assertFalse(self.queue.flush())
+        self.assertEqual(self.queue.stats()["queued"], 10)
+        self.assertEqual(self.queue.push([(signature(0), metadata(0))], "pusher"), [False])
+
+        for _ in range(3):
+            self.database.attempts.acquire()
+        self.assertGreaterEqual(self.queue.stats()["failures"], 3)
+
+        self.database.broken = False
+        while not self.queue.flush():
+            pass
+        self.assertEqual(self.database.written, [signature(i) for i in range(10)] + [signature(0)])
+        self.assertEqual(self.queue.stats()["queued"], 0)
+
+    def test_full_queue_fails_while_retrying(self):
+        self.queue.push([(signature(i), metadata(i)) for i in range(1000)], "pusher")
+        self.database.attempts.acquire()
+        with self.assertRaises(WriteBehindError):
+            self.queue.push([(signature(1000), metadata(1000))], "pusher")
+        # the refused push is not queued
+        self.assertEqual(self.queue.stats()["queued"], 1000)
+
+        self.database.broken = False
+        while not self.queue.flush():
+            pass
+        self.assertEqual(self.queue.push([(signature(1000), metadata(1000))], "pusher"), [True])
+
+    def test_full_queue_times_out(self):
+        self.database.broken = False
+        written = threading.Event()
+        write_batches = self.database.write_batches
+        self.database.write_batches = lambda batches: written.wait() and write_batches(batches)
+
+        self.queue.push([(signature(i), metadata(i)) for i in range(1000)], "pusher")
+        with self.assertRaises(WriteBehindError):
+            self.queue.push([(signature(1000), metadata(1000))], "pusher")
+        written.set()
+        self.assertTrue(self.queue.flush())
+        self.assertEqual(self.database.written, [signature(i) for i in range(1000)])
+
+    def test_close_gives_up(self):
+        self.queue.push([(signature(0), metadata(0))], "pusher")
+        self.database.attempts.acquire()
+        self.queue.close()
+        self.assertEqual(self.database.written, [])
+        self.assertEqual(self.queue.stats()["queued"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()